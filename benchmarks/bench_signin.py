@@ -0,0 +1,71 @@
+# Compare the sign-in HTTP round trips before and after caching discovery and sharing one session,
+# against a local stand-in for Google's endpoints:  python benchmarks/bench_signin.py [sign-ins]
+import os, sys, time, asyncio, aiohttp
+from aiohttp import web
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import google_auth
+
+
+async def start_stand_in(port: int) -> web.AppRunner:
+    base_url = f'http://127.0.0.1:{port}'
+    async def discovery(request):
+        return web.json_response({'authorization_endpoint': f'{base_url}/auth', 'token_endpoint': f'{base_url}/token',
+            'userinfo_endpoint': f'{base_url}/userinfo'}, headers={'Cache-Control': 'public, max-age=3600'})
+    async def token(request):
+        return web.json_response({'access_token': 'token', 'token_type': 'Bearer'})
+    async def userinfo(request):
+        return web.json_response({'sub': '1', 'email': 'steve@test.com', 'email_verified': True})
+    stand_in = web.Application()
+    stand_in.add_routes([web.get('/discovery', discovery), web.post('/token', token), web.get('/userinfo', userinfo)])
+    runner = web.AppRunner(stand_in)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    return runner
+
+
+async def sign_in_uncached(discovery_url: str):
+    # The old flow: a fresh session, and a fresh discovery fetch, for every request
+    for i in range(2): # /signin and /signin/callback
+        async with aiohttp.ClientSession() as session:
+            async with session.get(discovery_url) as response:
+                cfg = await response.json()
+    async with aiohttp.ClientSession() as session:
+        async with session.post(cfg['token_endpoint'], data='code=1') as response:
+            await response.json()
+    async with aiohttp.ClientSession() as session:
+        async with session.get(cfg['userinfo_endpoint']) as response:
+            await response.json()
+
+
+async def sign_in_cached(transport: google_auth.HttpTransport, discovery: google_auth.DiscoveryCache):
+    for i in range(2):
+        cfg = await discovery.get()
+    await transport.request_json('POST', cfg['token_endpoint'], data='code=1')
+    await transport.request_json('GET', cfg['userinfo_endpoint'])
+
+
+async def main(sign_in_count: int, port: int = 8765):
+    runner = await start_stand_in(port)
+    discovery_url = f'http://127.0.0.1:{port}/discovery'
+    try:
+        start = time.perf_counter()
+        for i in range(sign_in_count):
+            await sign_in_uncached(discovery_url)
+        uncached_time = time.perf_counter() - start
+
+        transport = google_auth.AiohttpTransport()
+        await transport.open()
+        discovery = google_auth.DiscoveryCache(transport, url = discovery_url)
+        start = time.perf_counter()
+        for i in range(sign_in_count):
+            await sign_in_cached(transport, discovery)
+        cached_time = time.perf_counter() - start
+        await transport.close()
+    finally:
+        await runner.cleanup()
+    print(f'uncached: {1000 * uncached_time / sign_in_count:.2f} ms per sign-in')
+    print(f'cached:   {1000 * cached_time / sign_in_count:.2f} ms per sign-in ({discovery.fetches} discovery fetch)')
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 200))
@@ -0,0 +1,51 @@
+# Measure a worker's cold start: importing main, the startup hook, and the first requests after it, each in a
+# fresh interpreter so nothing is already imported:  python benchmarks/bench_startup.py [runs]
+import os, sys, json, statistics, subprocess, tempfile
+
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COLD_START = '''
+import sys, time, json
+start = time.perf_counter()
+from main import app
+import_time = time.perf_counter() - start
+from fastapi.testclient import TestClient
+import session
+from user import User
+timings = {'import main': import_time}
+modules = sorted(module for module in ('pandas', 'numpy', 'aiohttp', 'oauthlib') if module in sys.modules)
+start = time.perf_counter()
+with TestClient(app) as client:
+    timings['startup'] = time.perf_counter() - start
+    with app.db.connection() as connection:
+        user = User(db = connection, google_id = 1, given_name = 'Steve', family_name = 'Tester', full_name = 'Steve Tester', picture = '')
+        client.cookies.set(session.SESSION_COOKIE_NAME, app.sessions.create(user, db = connection))
+    for name, path in (('first GET /', '/'), ('first GET /programs', '/programs'), ('second GET /programs', '/programs')):
+        start = time.perf_counter()
+        response = client.get(path)
+        assert response.status_code == 200, (path, response.status_code)
+        timings[name] = time.perf_counter() - start
+print(json.dumps({'timings': timings, 'modules': modules}))
+'''
+
+
+def cold_start(db_path: str) -> dict:
+    env = dict(os.environ, DB_PATH=db_path)
+    output = subprocess.run([sys.executable, '-c', COLD_START], cwd=PACKAGE_DIR, env=env, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(run_count: int):
+    runs = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for run_index in range(run_count):
+            runs.append(cold_start(os.path.join(temp_dir, f'bench_startup_{run_index}.db')))
+    print(f'heavy modules loaded by import main: {", ".join(runs[0]["modules"]) or "none"}')
+    for name in runs[0]['timings']:
+        times = [run['timings'][name] for run in runs]
+        print(f'{name + ":":<22} {1000 * statistics.median(times):8.1f} ms median, {1000 * min(times):8.1f} ms best of {run_count}')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -0,0 +1,82 @@
+import csv, io, json, itertools, tempfile
+from typing import Any, AsyncIterator, Callable, Dict, IO, Iterable, Iterator, List, Mapping, Optional, Sequence, TypeVar
+
+
+FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+CONTENT_TYPE_FORMATS = {'text/csv': 'csv', 'application/x-ndjson': 'ndjson', 'application/jsonl': 'ndjson', 'application/json-lines': 'ndjson'}
+SPOOL_SIZE = 1024 * 1024
+EXPORT_CHUNK_SIZE = 500
+
+T = TypeVar('T')
+
+
+def get_format(requested: Optional[str], content_type: Optional[str] = None) -> str:
+    # An explicit ?format= wins, then the upload's Content-Type, then CSV
+    if requested:
+        if requested not in FORMATS:
+            raise ValueError(f'Unknown format {requested}, expected one of {", ".join(FORMATS)}')
+        return requested
+    return CONTENT_TYPE_FORMATS.get((content_type or '').split(';')[0].strip().lower(), 'csv')
+
+
+async def spool(stream: AsyncIterator[bytes], max_size: int = SPOOL_SIZE) -> IO[bytes]:
+    # Buffers an upload in memory up to max_size and on disk beyond it, so the database write lock is only taken
+    # once the whole file has arrived, however slowly the client sends it
+    upload = tempfile.SpooledTemporaryFile(max_size=max_size)
+    async for chunk in stream:
+        upload.write(chunk)
+    upload.seek(0)
+    return upload
+
+
+def read_records(upload: IO[bytes], format: str) -> Iterator[Dict[str, Any]]:
+    # Parses one line at a time, so only the rows being inserted are ever held in memory
+    lines = (line.decode('utf-8-sig' if line_index == 0 else 'utf-8') for line_index, line in enumerate(upload))
+    if format == 'csv':
+        try:
+            yield from csv.DictReader(lines)
+        except csv.Error as error:
+            raise ValueError(f'Invalid CSV: {error}') from error
+        return
+    for line in lines:
+        if line.strip() == '':
+            continue
+        record = json.loads(line)
+        if not isinstance(record, dict):
+            raise ValueError('Each NDJSON line must be an object')
+        yield record
+
+
+def parse_records(records: Iterable[Mapping[str, Any]], parse_record: Callable[[Mapping[str, Any]], T]) -> Iterator[T]:
+    for row_number, record in enumerate(records, start=1):
+        try:
+            yield parse_record(record)
+        except (ValueError, TypeError) as error:
+            raise ValueError(f'Row {row_number}: {error}') from error
+
+
+def chunked(items: Iterable[T], chunk_size: int) -> Iterator[List[T]]:
+    iterator = iter(items)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+def write_records(rows: Iterable[Any], fields: Sequence[str], format: str, chunk_size: int = EXPORT_CHUNK_SIZE) -> Iterator[str]:
+    # Rows are anything indexable by field name, e.g. sqlite3.Row; each chunk of them becomes one piece of the response
+    if format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(fields)
+        for chunk in chunked(rows, chunk_size):
+            writer.writerows([[row[field] for field in fields] for row in chunk])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell() > 0:
+            yield buffer.getvalue() # just the header, when there were no rows
+        return
+    for chunk in chunked(rows, chunk_size):
+        yield ''.join(json.dumps({field: row[field] for field in fields}) + '\n' for row in chunk)
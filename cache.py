@@ -0,0 +1,178 @@
+import os, json, asyncio, threading, weakref
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, Optional, Set
+from db import ConnectionPool, call_after_transaction, execute_read, execute_write
+
+
+class LRUCache:
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._dependents: Dict[Hashable, Set[Hashable]] = {}
+        self._names: Dict[str, Hashable] = {}
+        self._prune_threshold = 4 * max_size
+        self._lock = threading.RLock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any, depends_on: Iterable[Hashable] = ()):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            self._names[repr(key)] = key
+            for dependency in depends_on:
+                self.add_dependency(dependency, key)
+            while len(self._entries) > self.max_size:
+                evicted_key, _ = self._entries.popitem(last=False)
+                self._names.pop(repr(evicted_key), None)
+                self.evictions += 1
+                # Without the evicted key's edges its dependents would miss its invalidations, so they go too
+                for dependent_key in self._dependents.pop(evicted_key, ()):
+                    self.invalidate(dependent_key)
+
+    def add_dependency(self, key: Hashable, dependent_key: Hashable):
+        # Invalidating key will also invalidate dependent_key, e.g. a camp holding an instructor's User
+        with self._lock:
+            self._dependents.setdefault(key, set()).add(dependent_key)
+            self._names[repr(key)] = key
+            if len(self._dependents) > self._prune_threshold:
+                # Edges of live entries survive a prune, so the next one waits until the count has doubled
+                self._prune_dependents()
+                self._prune_threshold = max(4 * self.max_size, 2 * len(self._dependents))
+
+    def _prune_dependents(self):
+        for key in list(self._dependents.keys()):
+            live_dependents = {dependent_key for dependent_key in self._dependents[key] if dependent_key in self._entries}
+            if len(live_dependents) > 0:
+                self._dependents[key] = live_dependents
+            else:
+                del self._dependents[key]
+                if key not in self._entries:
+                    self._names.pop(repr(key), None)
+
+    def invalidate(self, key: Hashable):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._names.pop(repr(key), None)
+            for dependent_key in self._dependents.pop(key, ()):
+                self.invalidate(dependent_key)
+
+    def invalidate_name(self, name: str):
+        # Keys are shared between processes as their repr, e.g. "(<class 'user.User'>, 1)"
+        with self._lock:
+            key = self._names.get(name)
+            if key is not None:
+                self.invalidate(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._dependents.clear()
+            self._names.clear()
+            self._prune_threshold = 4 * self.max_size
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total > 0 else 0.0
+        }
+
+
+identity_map = LRUCache(max_size=int(os.environ.get("IDENTITY_MAP_SIZE") or 4096))
+
+
+class InvalidationLog:
+    # Shares identity map invalidations between worker processes through the cache_invalidation table.
+    # Each process logs what it evicts, and replays what the others logged whenever the pool sees their commits.
+    def __init__(self, cache: LRUCache, max_rows: int = 10000):
+        self.cache = cache
+        self.max_rows = max_rows
+        self.source = os.getpid()
+        self.last_seq = 0
+        self.pruned_seq = 0
+
+    def record(self, db: Any, keys: Iterable[Hashable]):
+        insert_stmt = '''
+            INSERT INTO cache_invalidation (cache_key, source)
+                SELECT value, ? FROM json_each(?)
+        '''
+        seq = execute_write(db, insert_stmt, (self.source, json.dumps([repr(key) for key in keys])))
+        if seq is not None and seq - self.pruned_seq >= self.max_rows // 10:
+            delete_stmt = '''
+                DELETE FROM cache_invalidation
+                    WHERE seq <= ?
+            '''
+            execute_write(db, delete_stmt, (seq - self.max_rows,))
+            self.pruned_seq = seq
+
+    def replay(self, db: Any):
+        select_stmt = '''
+            SELECT *
+                FROM cache_invalidation
+                WHERE seq > ?
+                ORDER BY seq
+        '''
+        result = execute_read(db, select_stmt, (self.last_seq,))
+        if result is None:
+            return
+        if result[0]['seq'] > self.last_seq + 1:
+            self.cache.clear() # this process fell behind the pruned log, so it cannot know what changed
+        for row in result:
+            if row['source'] != self.source:
+                self.cache.invalidate_name(row['cache_key'])
+        self.last_seq = result[-1]['seq']
+
+
+_invalidation_logs = weakref.WeakKeyDictionary()
+
+
+def watch(pool: ConnectionPool) -> InvalidationLog:
+    invalidation_log = InvalidationLog(identity_map)
+    with pool.connection() as connection:
+        result = execute_read(connection, 'SELECT MAX(seq) AS seq FROM cache_invalidation')
+        invalidation_log.last_seq = result[0]['seq'] or 0
+        invalidation_log.pruned_seq = invalidation_log.last_seq
+    pool.external_change_callbacks.append(invalidation_log.replay)
+    _invalidation_logs[pool] = invalidation_log
+    return invalidation_log
+
+
+def _on_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+def invalidate(db: Any, *keys: Hashable):
+    # Evict now, and again once the enclosing transaction ends, so a concurrent
+    # reader cannot re-cache the pre-commit state (or keep state that was rolled back)
+    if db is not None and _on_event_loop():
+        raise RuntimeError('invalidate writes to the database, so call it from a function run through db.run')
+    for key in keys:
+        identity_map.invalidate(key)
+    if db is not None:
+        call_after_transaction(db, lambda: [identity_map.invalidate(key) for key in keys])
+        invalidation_log = _invalidation_logs.get(db.pool)
+        if invalidation_log is not None and len(keys) > 0:
+            invalidation_log.record(db, keys)
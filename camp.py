@@ -1,10 +1,15 @@
-import copy, pandas
+import copy
 from pydantic import BaseModel
-from typing import Dict, List, Optional, Any
-from db import execute_read, execute_write
-from program import Program
-from user import User
-from filtertable import FilterTable, Checkboxes
+from typing import Dict, List, Optional, Any, Mapping, AbstractSet, TYPE_CHECKING
+from db import execute_read, execute_write, transaction, run, get_table_versions
+from program import Program, load_program, load_tag_index
+from user import User, load_user, load_users
+from cache import identity_map, invalidate
+if TYPE_CHECKING:
+    from filtertable import FilterTable, Filter, SqlSource, Page
+
+
+CAMPS_TABLE_KEY = ('CampsTable',)
 
 
 class Camp(BaseModel):
@@ -15,38 +20,57 @@ class Camp(BaseModel):
     primary_instructor: Optional[User] = None
 
     def _load(self, db: Any) -> bool:
-        select_stmt = f'''
+        select_stmt = '''
             SELECT *
                 FROM camp
-                WHERE id = {self.id}
+                WHERE id = ?
         '''
-        result = execute_read(db, select_stmt)
+        result = execute_read(db, select_stmt, (self.id,))
         if result is None:
             return False;
         row = result[0] # should only be one
         self.program_id = row['program_id']
 
-        select_stmt = f'''
+        select_stmt = '''
             SELECT user_id, is_primary
                 FROM camp_x_instructors
-                WHERE camp_id = {self.id}
+                WHERE camp_id = ?
         '''
-        result = execute_read(db, select_stmt)
+        result = execute_read(db, select_stmt, (self.id,))
         self.instructors.clear()
         if result is not None:
+            instructors = load_users(db = db, ids = [row['user_id'] for row in result])
             for row in result:
-                instructor = User(db = db, id = row['user_id'])
+                instructor = instructors[row['user_id']]
                 self.instructors[instructor.id] = instructor
+                identity_map.add_dependency((User, instructor.id), (Camp, self.id))
                 if row['is_primary']:
                     self.primary_instructor = instructor
         return True
 
     def _create(self, db: Any):
-        insert_stmt = f'''
-            INSERT INTO camp (program_id)
-                VALUES ({self.program_id});
+        with transaction(db):
+            insert_stmt = '''
+                INSERT INTO camp (program_id)
+                    VALUES (?);
+            '''
+            self.id = execute_write(db, insert_stmt, (self.program_id,))
+            self._refresh_listing(db = db)
+
+    def _refresh_listing(self, db: Any):
+        # camp_listing holds this camp's row of the schedule (only once it has a primary instructor)
+        delete_stmt = '''
+            DELETE FROM camp_listing
+                WHERE id = ?;
         '''
-        self.id = execute_write(db, insert_stmt)
+        execute_write(db, delete_stmt, (self.id,))
+        insert_stmt = '''
+            INSERT INTO camp_listing (id, program_id, title, tags, primary_instructor_id, primary_instructor)
+                SELECT t1.id, t1.program_id, t2.title, t2.tags, t4.id, t4.full_name
+                    FROM camp as t1, program as t2, camp_x_instructors as t3, user as t4
+                    WHERE t1.id = ? and t1.program_id = t2.id and t1.id = t3.camp_id and t3.is_primary and t3.user_id = t4.id;
+        '''
+        execute_write(db, insert_stmt, (self.id,))
 
     def __init__(self, db: Any, **data):
         super().__init__(**data)
@@ -56,79 +80,131 @@ class Camp(BaseModel):
             self._create(db = db)
 
     def delete(self, db: Any):
-        delete_stmt = f'''
-            DELETE FROM camp_x_instructors
-                WHERE camp_id = {self.id};
-        '''
-        execute_write(db, delete_stmt)
-        delete_stmt = f'''
-            DELETE FROM camp
-                WHERE id = {self.id};
-        '''
-        execute_write(db, delete_stmt)
+        with transaction(db):
+            delete_stmt = '''
+                DELETE FROM camp_x_instructors
+                    WHERE camp_id = ?;
+            '''
+            execute_write(db, delete_stmt, (self.id,))
+            delete_stmt = '''
+                DELETE FROM camp
+                    WHERE id = ?;
+            '''
+            execute_write(db, delete_stmt, (self.id,))
+            self._refresh_listing(db = db)
+            invalidate(db, (Camp, self.id))
 
     def add_instructor(self, db: Any, user_id: int):
         if self.instructors.get(user_id) is None:
-            instructor = User(db = db, id = user_id)
+            instructor = load_user(db = db, user_id = user_id)
             if instructor is not None and "INSTRUCTOR" in instructor.roles:
                 is_primary = (len(self.instructors) == 0)
                 self.instructors[instructor.id] = instructor
                 if is_primary:
                     self.primary_instructor = instructor
-                insert_stmt = f'''
-                    INSERT INTO camp_x_instructors (camp_id, user_id, is_primary)
-                        VALUES ({self.id}, {instructor.id}, {is_primary});
-                '''
-                execute_write(db, insert_stmt)
+                with transaction(db):
+                    insert_stmt = '''
+                        INSERT INTO camp_x_instructors (camp_id, user_id, is_primary)
+                            VALUES (?, ?, ?);
+                    '''
+                    execute_write(db, insert_stmt, (self.id, instructor.id, is_primary))
+                    if is_primary:
+                        self._refresh_listing(db = db)
+                    invalidate(db, (Camp, self.id))
 
     def make_instructor_primary(self, db: Any, user_id: int):
-        instructor = self.instructors.get(user_id)
-        if instructor is not None and (self.primary_instructor is None or instructor.id != self.primary_instructor.id):
-            update_stmt = f'''
-                UPDATE camp_x_instructors
-                    SET is_primary=FALSE
-                    WHERE camp_id = {self.id} and user_id = {self.primary_instructor.id};
-            '''
-            execute_write(db, update_stmt)
-            update_stmt = f'''
-                UPDATE camp_x_instructors
-                    SET is_primary=TRUE
-                    WHERE camp_id = {self.id} and user_id = {instructor.id};
-            '''
-            execute_write(db, update_stmt)
-            self.primary_instructor = instructor
+        with transaction(db):
+            instructor = self.instructors.get(user_id)
+            if instructor is not None and (self.primary_instructor is None or instructor.id != self.primary_instructor.id):
+                update_stmt = '''
+                    UPDATE camp_x_instructors
+                        SET is_primary=?
+                        WHERE camp_id = ? and user_id = ?;
+                '''
+                if self.primary_instructor is not None:
+                    execute_write(db, update_stmt, (False, self.id, self.primary_instructor.id))
+                execute_write(db, update_stmt, (True, self.id, instructor.id))
+                self.primary_instructor = instructor
+                self._refresh_listing(db = db)
+                invalidate(db, (Camp, self.id))
 
     def remove_instructor(self, db: Any, user_id: int):
-        instructor = self.instructors.pop(user_id) # not really a tuple
-        if instructor is not None:
-            if self.primary_instructor is not None and self.primary_instructor.id == instructor.id:
-                if len(self.instructors) > 0:
-                    first_instructor = self.instructors.values()[0]
-                    self.make_instructor_primary(db = db, user_id = first_instructor)
-                else:
+        with transaction(db):
+            instructor = self.instructors.pop(user_id, None)
+            if instructor is not None:
+                delete_stmt = '''
+                    DELETE FROM camp_x_instructors
+                        WHERE camp_id = ? and user_id = ?
+                '''
+                execute_write(db, delete_stmt, (self.id, instructor.id))
+                invalidate(db, (Camp, self.id))
+                if self.primary_instructor is not None and self.primary_instructor.id == instructor.id:
                     self.primary_instructor = None
-            delete_stmt = f'''
-                DELETE FROM camp_x_instructors
-                    VALUES camp_id = {self.id} and user_id = {instructor.id}
-            '''
-            execute_write(db, insert_stmt)
+                    self._refresh_listing(db = db)
+                    if len(self.instructors) > 0:
+                        first_instructor = next(iter(self.instructors.values()))
+                        self.make_instructor_primary(db = db, user_id = first_instructor.id)
 
     def load_program(self, db: Any):
-        self.program = Program(db = db, id = self.program_id)
-
-
-def load_camps_table(db: Any) -> FilterTable:
-    select_stmt = f'''
-        SELECT t1.*, t2.id as program_id, t2.title, t2.tags, t4.id as primary_instructor_id, t4.full_name as primary_instructor
-            FROM camp as t1, program as t2, camp_x_instructors as t3, user as t4
-            WHERE t1.program_id = t2.id and t1.id = t3.camp_id and t3.is_primary and t3.user_id = t4.id
-    '''
-    dataframe = pandas.read_sql_query(select_stmt, db)
-    filter_table = FilterTable(base_dataframe=dataframe)
-    dataframe = filter_table.base_dataframe
-    dataframe.columns[dataframe.columns.get_loc('title')].display = True
-    dataframe.columns[dataframe.columns.get_loc('primary_instructor')].display = True
-    filter_table.filters.append(Checkboxes(display_column='tags', source_column='tags'))
-    filter_table.filters.append(Checkboxes(display_column='primary_instructor', source_column='primary_instructor'))
-    return filter_table
+        self.program = load_program(db = db, program_id = self.program_id)
+        identity_map.add_dependency((Program, self.program_id), (Camp, self.id))
+
+
+def load_camp(db: Any, camp_id: int) -> Optional[Camp]:
+    camp = identity_map.get((Camp, camp_id))
+    if camp is None:
+        camp = Camp.construct(id = camp_id)
+        if not camp._load(db = db):
+            return None
+        identity_map.put((Camp, camp_id), camp)
+    return camp
+
+
+def _camps_source() -> 'SqlSource':
+    from filtertable import SqlSource
+    return SqlSource(
+        select_stmt = '''
+            SELECT *
+                FROM camp_listing
+        ''',
+        columns = ['id', 'program_id', 'title', 'tags', 'primary_instructor_id', 'primary_instructor']
+    )
+
+
+def _build_camps_filters(tag_index: Mapping[str, AbstractSet[int]]) -> List['Filter']:
+    from filtertable import Checkboxes, Tags
+    return [
+        Tags(display_column='tags', key_column='program_id', tag_index=tag_index),
+        Checkboxes(display_column='primary_instructor', source_column='primary_instructor')
+    ]
+
+
+def load_camps_table(db: Any) -> 'FilterTable':
+    # The same rows for every user, shared until camp_listing's version moves on. Every change to a camp, or to a
+    # program or instructor listed in one, rewrites its rows there, so no dependency on those is needed.
+    import pandas
+    from filtertable import BaseTable, FilterTable
+    versions = get_table_versions(db, ('camp_listing',))
+    cached = identity_map.get(CAMPS_TABLE_KEY)
+    if cached is not None and cached[0] == versions:
+        table = cached[1]
+    else:
+        dataframe = pandas.read_sql_query(_camps_source().select_stmt, db.reader)
+        table = BaseTable(dataframe, display_columns=['title', 'primary_instructor'])
+        identity_map.put(CAMPS_TABLE_KEY, (versions, table))
+    return FilterTable(table=table, filters=_build_camps_filters(load_tag_index(db = db)))
+
+
+async def load_camps_table_async(db: Any) -> 'FilterTable':
+    return await run(load_camps_table, db = db)
+
+
+def load_camps_page(db: Any, params: Mapping[str, List[str]], **page_args) -> 'Page':
+    filters = _build_camps_filters(load_tag_index(db = db))
+    for filter in filters:
+        filter.select(None, params)
+    return _camps_source().query_page(db, filters, **page_args)
+
 
+async def load_camps_page_async(db: Any, params: Mapping[str, List[str]], **page_args) -> 'Page':
+    return await run(load_camps_page, db, params, **page_args)
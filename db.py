@@ -1,7 +1,11 @@
-import sqlite3, os
-from fastapi import FastAPI
+import sqlite3, os, re, json, queue, threading, asyncio, functools, hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, asynccontextmanager
+from fastapi import FastAPI, Request
 from urllib.request import pathname2url
 from pydantic import BaseModel
+from typing import Optional, Sequence, List, Tuple, Iterable, Iterator, Hashable
 
 
 class ColumnMeta(BaseModel):
@@ -11,26 +15,341 @@ class ColumnMeta(BaseModel):
     can_filter: bool
 
 
-def get_db(app: FastAPI):
-    if app.db is None:
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), 'migrations')
+
+
+def list_migrations() -> List[Tuple[int, str]]:
+    migrations = []
+    for file_name in os.listdir(MIGRATIONS_DIR):
+        version, extension = os.path.splitext(file_name)
+        if extension == '.sql':
+            migrations.append((int(version.split('_')[0]), os.path.join(MIGRATIONS_DIR, file_name)))
+    return sorted(migrations)
+
+
+def migrate(connection: sqlite3.Connection) -> int:
+    # Brings a database created from an older schema.sql up to date, tracked through PRAGMA user_version
+    version = connection.execute('PRAGMA user_version').fetchone()[0]
+    for migration_version, migration_path in list_migrations():
+        if migration_version <= version:
+            continue
+        with open(migration_path, encoding='utf-8') as migration_file:
+            script = migration_file.read()
         try:
-            app.db = sqlite3.connect('file:{}?mode=rw'.format(pathname2url(app.db_path)), check_same_thread=False)
+            connection.executescript(f'BEGIN IMMEDIATE;\n{script}\nPRAGMA user_version = {migration_version};\nCOMMIT;')
+        except sqlite3.Error:
+            if connection.in_transaction:
+                connection.rollback()
+            raise
+        version = migration_version
+    return version
+
+
+class StatementCacheStats:
+    # Mirrors the LRU statement cache each sqlite3 connection keeps, so hits and misses can be counted
+    def __init__(self, cache_size: int):
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self._statements = {}
+        self._lock = threading.Lock()
+
+    def record(self, connection: sqlite3.Connection, stmt: str):
+        with self._lock:
+            statements = self._statements.setdefault(id(connection), OrderedDict())
+            if stmt in statements:
+                statements.move_to_end(stmt)
+                self.hits += 1
+            else:
+                self.misses += 1
+                statements[stmt] = None
+                if len(statements) > self.cache_size:
+                    statements.popitem(last=False)
+
+    def forget(self, connection: sqlite3.Connection):
+        with self._lock:
+            self._statements.pop(id(connection), None)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def as_dict(self) -> dict:
+        return {'cache_size': self.cache_size, 'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hit_rate}
+
+
+WRITE_TABLE_PATTERN = re.compile(r'\b(?:INTO|UPDATE|DELETE\s+FROM)\s+(\w+)', re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=1024)
+def get_write_table(stmt: str) -> Optional[str]:
+    match = WRITE_TABLE_PATTERN.search(stmt)
+    return match.group(1).lower() if match is not None else None
+
+
+def get_table_versions(db: 'Connection', tables: Sequence[str]) -> Tuple[int, ...]:
+    # Each table's change counter, as committed in the table_version table every worker process shares
+    select_stmt = '''
+        SELECT table_name, version
+            FROM table_version
+            WHERE table_name IN (SELECT value FROM json_each(?))
+    '''
+    versions = {row['table_name']: row['version'] for row in execute_read(db, select_stmt, (json.dumps(list(tables)),)) or []}
+    return tuple(versions.get(table, 0) for table in tables)
+
+
+def make_etag(versions: Tuple[int, ...], *extra: Hashable) -> str:
+    return 'W/"{}"'.format(hashlib.sha1(repr((versions, extra)).encode()).hexdigest()[:16])
+
+
+def _opaque_tag(etag: str) -> str:
+    etag = etag.strip()
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    # If-None-Match uses the weak comparison, so W/ prefixes are ignored on both sides
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    return _opaque_tag(etag) in {_opaque_tag(tag) for tag in if_none_match.split(',')}
+
+
+class Connection:
+    # A checked-out handle: reads go through a pooled reader, writes through the pool's single writer
+    def __init__(self, pool, reader: sqlite3.Connection):
+        self.pool = pool
+        self.reader = reader
+        self.transaction_depth = 0
+        self.after_transaction = []
+        self.written_tables = set()
+
+    @property
+    def writer(self) -> sqlite3.Connection:
+        return self.pool.writer
+
+    @property
+    def in_transaction(self) -> bool:
+        return self.transaction_depth > 0
+
+
+class ConnectionPool:
+    def __init__(self, db_path: str, max_readers: int = 8, statement_cache_size: int = 128):
+        self.db_path = db_path
+        self.max_readers = max_readers
+        self.statement_cache_size = statement_cache_size
+        self.statement_stats = StatementCacheStats(statement_cache_size)
+        self.write_lock = threading.Lock()
+        self._readers = queue.LifoQueue()
+        self._reader_count = 0
+        self._reader_count_lock = threading.Lock()
+        try:
+            self.writer = self._connect()
         except sqlite3.OperationalError:
-            app.db = sqlite3.connect(app.db_path, check_same_thread=False)
+            self.writer = sqlite3.connect(db_path, check_same_thread=False, cached_statements=statement_cache_size)
             with open(os.path.join(os.path.dirname(__file__), 'schema.sql'), encoding='utf-8') as schema_file:
-                app.db.executescript(schema_file.read())
-                app.db.commit()
+                self.writer.executescript(schema_file.read())
+                self.writer.commit()
+        migrate(self.writer)
+        self.writer.execute('PRAGMA journal_mode=WAL')
+        self.writer.execute('PRAGMA synchronous=NORMAL')
+        self.data_version = self.writer.execute('PRAGMA data_version').fetchone()[0]
+        self._poll_connection = self._connect(read_only=True)
+        self._poll_lock = threading.Lock()
+        self._poll_version = self._poll_connection.execute('PRAGMA data_version').fetchone()[0]
+        self.external_change_callbacks = []
+
+    def _connect(self, read_only: bool = False) -> sqlite3.Connection:
+        uri = 'file:{}?mode=rw'.format(pathname2url(self.db_path))
+        connection = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=self.statement_cache_size)
+        if read_only:
+            connection.execute('PRAGMA query_only=ON')
+        return connection
+
+    def checkout(self) -> Connection:
+        try:
+            reader = self._readers.get_nowait()
+        except queue.Empty:
+            reader = None
+            with self._reader_count_lock:
+                if self._reader_count < self.max_readers:
+                    self._reader_count += 1
+                    reader = self._connect(read_only=True)
+            if reader is None:
+                reader = self._readers.get()
+        return Connection(pool=self, reader=reader)
+
+    def checkin(self, connection: Connection):
+        if connection.reader is not None:
+            self._readers.put(connection.reader)
+            connection.reader = None
+
+    @contextmanager
+    def connection(self):
+        connection = self.checkout()
+        try:
+            yield connection
+        finally:
+            self.checkin(connection)
+
+    def poll_external_changes(self) -> bool:
+        # The writer's data_version only moves when another connection - i.e. another worker process - commits,
+        # so this is a cheap per-request check. While this process is writing the writer is busy, so a dedicated
+        # poll connection is asked instead; it also sees this process's own commits, so it can report a change that
+        # was not external, which only costs a needless replay. Either way the check is never skipped.
+        with self._poll_lock:
+            poll_version = self._poll_connection.execute('PRAGMA data_version').fetchone()[0]
+            poll_changed = poll_version != self._poll_version
+            self._poll_version = poll_version
+        if not self.write_lock.acquire(blocking=False):
+            return poll_changed
+        try:
+            data_version = self.writer.execute('PRAGMA data_version').fetchone()[0]
+        finally:
+            self.write_lock.release()
+        changed = data_version != self.data_version
+        self.data_version = data_version
+        return changed
+
+    def apply_external_changes(self, db: Connection):
+        # Replays through the caller's connection; checking out another here could wait on a reader the caller holds
+        for callback in self.external_change_callbacks:
+            callback(db)
+
+    def close(self):
+        while True:
+            try:
+                reader = self._readers.get_nowait()
+                self.statement_stats.forget(reader)
+                reader.close()
+            except queue.Empty:
+                break
+        self._reader_count = 0
+        self._poll_connection.close()
+        self.statement_stats.forget(self.writer)
+        self.writer.close()
+
+
+_executor = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    # Bounded, but not by the reader pool: work run here is handed a connection already checked out (see
+    # connection_async), so none of these threads waits on a reader that a request awaiting a thread holds
+    global _executor
+    if _executor is None:
+        max_workers = int(os.environ.get("DB_MAX_WORKERS") or 16)
+        _executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='db')
+    return _executor
+
+
+async def run(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
+
+
+def get_db(app: FastAPI) -> ConnectionPool:
+    if app.db is None:
+        max_readers = int(os.environ.get("DB_MAX_READERS") or 8)
+        statement_cache_size = int(os.environ.get("DB_STATEMENT_CACHE_SIZE") or 128)
+        app.db = ConnectionPool(app.db_path, max_readers=max_readers, statement_cache_size=statement_cache_size)
     return app.db
 
 
 def close_db(app: FastAPI):
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
     if app.db is not None:
         app.db.close()
     app.db = None
 
 
-def execute_read(db: sqlite3.Connection, stmt: str):
-    cursor = db.execute(stmt)
+class ExternalChangeMiddleware:
+    # Before each request, let this process's caches catch up with whatever other worker processes committed
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        pool = getattr(scope.get('app'), 'db', None)
+        if scope['type'] in ('http', 'websocket') and pool is not None and pool.poll_external_changes():
+            async with connection_async(pool) as connection:
+                await run(pool.apply_external_changes, connection)
+        await self.app(scope, receive, send)
+
+
+@asynccontextmanager
+async def connection_async(pool: ConnectionPool):
+    # Waits for a reader on the loop's default executor rather than the database one, whose threads must stay free
+    # for work that already holds a connection
+    connection = await asyncio.get_running_loop().run_in_executor(None, pool.checkout)
+    try:
+        yield connection
+    finally:
+        pool.checkin(connection)
+
+
+def get_connection(request: Request):
+    with request.app.db.connection() as connection:
+        yield connection
+
+
+@contextmanager
+def transaction(db: Connection):
+    # Groups every write made through db into one commit; nested uses join the outermost transaction
+    if db.in_transaction:
+        db.transaction_depth += 1
+        try:
+            yield db
+        finally:
+            db.transaction_depth -= 1
+        return
+    with db.pool.write_lock:
+        db.writer.execute('BEGIN IMMEDIATE')
+        db.transaction_depth = 1
+        try:
+            yield db
+            _bump_table_versions(db)
+        except BaseException:
+            db.writer.rollback()
+            raise
+        else:
+            db.writer.commit()
+        finally:
+            db.transaction_depth = 0
+            db.written_tables = set()
+            callbacks, db.after_transaction = db.after_transaction, []
+            for callback in callbacks:
+                callback()
+
+
+def _bump_table_versions(db: Connection):
+    # Committed along with the writes themselves, so no worker can see a version without the data it stands for
+    if len(db.written_tables) == 0:
+        return
+    upsert_stmt = '''
+        INSERT INTO table_version (table_name, version)
+            SELECT value, 1 FROM json_each(?) WHERE true
+            ON CONFLICT (table_name) DO UPDATE SET version = version + 1
+    '''
+    db.writer.execute(upsert_stmt, (json.dumps(sorted(db.written_tables)),))
+
+
+def call_after_transaction(db: Connection, callback):
+    if db.in_transaction:
+        db.after_transaction.append(callback)
+    else:
+        callback()
+
+
+def execute_read(db: Connection, stmt: str, params: Sequence = ()):
+    # Inside a transaction, read through the writer so uncommitted writes are visible
+    connection = db.writer if db.in_transaction else db.reader
+    db.pool.statement_stats.record(connection, stmt)
+    cursor = connection.execute(stmt, params)
     cursor.row_factory = sqlite3.Row
     rows = cursor.fetchall()
     if len(rows) > 0:
@@ -39,8 +358,58 @@ def execute_read(db: sqlite3.Connection, stmt: str):
         return None
 
 
-def execute_write(db: sqlite3.Connection, stmt: str) -> None:
-    cursor = db.execute(stmt)
-    db.commit()
+def iterate_read(db: Connection, stmt: str, params: Sequence = (), chunk_size: int = 500) -> Iterator[sqlite3.Row]:
+    # Like execute_read, but rows come off the cursor a chunk at a time rather than all being fetched up front
+    connection = db.writer if db.in_transaction else db.reader
+    db.pool.statement_stats.record(connection, stmt)
+    cursor = connection.execute(stmt, params)
+    cursor.row_factory = sqlite3.Row
+    try:
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if len(rows) == 0:
+                return
+            yield from rows
+    finally:
+        cursor.close()
+
+
+def _record_write(db: Connection, stmt: str):
+    table = get_write_table(stmt)
+    if table is not None:
+        db.written_tables.add(table)
+
+
+def execute_write(db: Connection, stmt: str, params: Sequence = ()) -> Optional[int]:
+    with transaction(db):
+        db.pool.statement_stats.record(db.writer, stmt)
+        cursor = db.writer.execute(stmt, params)
+        _record_write(db, stmt)
     return cursor.lastrowid
 
+
+def execute_many(db: Connection, stmt: str, params_list: Iterable[Sequence]):
+    # One statement for every set of params, e.g. the links for a chunk of imported rows
+    with transaction(db):
+        db.pool.statement_stats.record(db.writer, stmt)
+        db.writer.executemany(stmt, params_list)
+        _record_write(db, stmt)
+
+
+def execute_inserts(db: Connection, stmt: str, params_list: Iterable[Sequence]) -> List[int]:
+    # One INSERT for every set of params, returning each new row's id in params order, as executemany cannot
+    with transaction(db):
+        row_ids = []
+        for params in params_list:
+            db.pool.statement_stats.record(db.writer, stmt)
+            row_ids.append(db.writer.execute(stmt, params).lastrowid)
+        _record_write(db, stmt)
+    return row_ids
+
+
+async def execute_read_async(db: Connection, stmt: str, params: Sequence = ()):
+    return await run(execute_read, db, stmt, params)
+
+
+async def execute_write_async(db: Connection, stmt: str, params: Sequence = ()):
+    return await run(execute_write, db, stmt, params)
@@ -1,56 +1,548 @@
-import pandas
+import abc, json, itertools, numpy, pandas
 from enum import Enum
-from pydantic import BaseModel
-from typing import Optional, Dict, List, Tuple, Any
+from pydantic import BaseModel, PrivateAttr
+from typing import Optional, Dict, List, Tuple, Any, Mapping, Callable, Sequence, Hashable
+from cache import LRUCache
 
 
-class Column(str):
-    def __init__(self, object: str):
-        super().__init__()
-        self.display = False
-        self.display_name = self.__str__().replace('_', ' ').title()
+_table_versions = itertools.count(1)
+_tag_index_versions = itertools.count(1)
+
+
+class ColumnSchema(BaseModel):
+    name: str
+    display: bool = False
+    display_name: Optional[str] = None
+
+    def __init__(self, **data):
+        super().__init__(**data)
+        if self.display_name is None:
+            self.display_name = self.name.replace('_', ' ').title()
+
+
+class BaseTable:
+    # The rows behind any number of FilterTable views. It is built once and never modified, so it can be shared
+    # between sessions along with everything derived from it: facet indexes, masks, facets and sort orders.
+    def __init__(self, dataframe: pandas.DataFrame, display_columns: Sequence[str] = (), key_column: str = 'id', max_derived: int = 256):
+        self.dataframe = dataframe
+        self.columns = {name: ColumnSchema(name=name, display=name in display_columns) for name in dataframe.columns}
+        self.key_column = key_column
+        self.derived = LRUCache(max_size=max_derived)
+        self.version = next(_table_versions) # a rebuilt table gets a new version, so nothing keyed on the old one is reused
+
+    def derive(self, key: Hashable, build: Callable[[], Any]) -> Any:
+        value = self.derived.get(key)
+        if value is None:
+            value = build()
+            self.derived.put(key, value)
+        return value
+
+    def __len__(self) -> int:
+        return len(self.dataframe)
+
+
+def _parse_number(values: Optional[List[str]]) -> Optional[float]:
+    if not values or values[0] == '':
+        return None
+    try:
+        return float(values[0])
+    except ValueError:
+        return None
 
 
 class Filter(BaseModel):
     display_column: str
     filter_type: Optional[str] = None
+    _facet_key: Optional[Tuple] = PrivateAttr(default=None)
+
+    def index_key(self) -> Tuple:
+        # Identifies what this filter indexes in a BaseTable, so its shared derived data can be found again
+        return (self.filter_type, self.display_column)
+
+    @abc.abstractmethod
+    def selection_key(self) -> Optional[Tuple]:
+        # None when nothing is selected, i.e. the filter lets every row through
+        pass
+
+    def display_key(self) -> Optional[Tuple]:
+        # Everything about this filter's selection that shows in the sidebar
+        return self.selection_key()
+
+    @abc.abstractmethod
+    def build_mask(self, dataframe: pandas.DataFrame) -> numpy.ndarray:
+        pass
+
+    @abc.abstractmethod
+    def select(self, dataframe: Optional[pandas.DataFrame], params: Mapping[str, List[str]]):
+        pass
+
+    def to_sql(self, sql_columns: Sequence[str]) -> Optional[Tuple[str, List[Any]]]:
+        # A WHERE clause and its parameters, or None when this filter can only be applied in memory
+        return None
+
+    @abc.abstractmethod
+    def build_facet_index(self, dataframe: pandas.DataFrame) -> Any:
+        pass
+
+    @abc.abstractmethod
+    def build_facet(self, dataframe: pandas.DataFrame, facet_index: Any, mask: Optional[numpy.ndarray]) -> Any:
+        pass
+
+    @abc.abstractmethod
+    def set_facet(self, facet: Any):
+        pass
+
+    def refresh_facet(self, table: BaseTable, other_masks: List[numpy.ndarray], other_key: Tuple):
+        # A facet reflects every other filter's selection (not its own), so it only changes when one of those does
+        if self._facet_key == other_key:
+            return
+        def build() -> Any:
+            facet_index = table.derive(('facet_index', self.index_key()), lambda: self.build_facet_index(table.dataframe))
+            mask = numpy.logical_and.reduce(other_masks) if len(other_masks) > 0 else None
+            return self.build_facet(table.dataframe, facet_index, mask)
+        self.set_facet(table.derive(('facet', self.index_key(), other_key), build))
+        self._facet_key = other_key
+
+    def get_mask(self, table: BaseTable) -> Optional[numpy.ndarray]:
+        # Shared by every view that makes the same selection, and only recomputed for filters whose selection changed
+        key = self.selection_key()
+        if key is None:
+            return None
+        return table.derive(('mask', self.index_key(), key), lambda: self.build_mask(table.dataframe))
 
 
 class Checkboxes(Filter):
     source_column: str
     selected_values: Optional[Dict] = {}
+    facet_counts: Optional[Dict] = {}
 
     def __init__(self, **data):
         super().__init__(filter_type='Checkboxes', **data)
 
+    def build_facet_index(self, dataframe: pandas.DataFrame) -> Any:
+        codes, values = pandas.factorize(dataframe[self.source_column], sort=True)
+        return codes, values.tolist()
+
+    def build_facet(self, dataframe: pandas.DataFrame, facet_index: Any, mask: Optional[numpy.ndarray]) -> Any:
+        codes, values = facet_index
+        if mask is not None:
+            codes = codes[mask]
+        counts = numpy.bincount(codes[codes >= 0], minlength=len(values))
+        return dict(zip(values, counts.tolist()))
+
+    def set_facet(self, facet: Any):
+        self.facet_counts = facet
+
+    def get_selected_values(self) -> List[Any]:
+        return [value for value, selected in self.selected_values.items() if selected]
+
+    def selection_key(self) -> Optional[Tuple]:
+        selected_values = self.get_selected_values()
+        if len(selected_values) == 0:
+            return None
+        return tuple(sorted(selected_values, key=str))
+
+    def build_mask(self, dataframe: pandas.DataFrame) -> numpy.ndarray:
+        return dataframe[self.source_column].isin(self.get_selected_values()).to_numpy()
+
+    def select(self, dataframe: Optional[pandas.DataFrame], params: Mapping[str, List[str]]):
+        values = params.get(self.display_column) or []
+        if dataframe is not None and pandas.api.types.is_numeric_dtype(dataframe[self.source_column]):
+            values = pandas.to_numeric(pandas.Series(values, dtype=object), errors='coerce').dropna().tolist()
+        self.selected_values = {value: True for value in values}
+
+    def to_sql(self, sql_columns: Sequence[str]) -> Optional[Tuple[str, List[Any]]]:
+        if self.source_column not in sql_columns:
+            return None
+        # One bound JSON list, so the statement text is the same however many values are selected
+        return f'"{self.source_column}" IN (SELECT value FROM json_each(?))', [json.dumps(self.get_selected_values())]
+
+
+class TagIndex(dict):
+    # An inverted index from each tag to the keys carrying it. Shared derived data is keyed on its version, which
+    # unlike its id() is never reused, so nothing built from an old index can be served for a new one.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.version = next(_tag_index_versions)
+
+
+class Tags(Filter):
+    # Several tags per row, looked up through an inverted index from each tag to the keys (e.g. program ids) carrying it
+    key_column: str
+    tag_index: Any = {}
+    selected_values: Optional[Dict] = {}
+    match_all: bool = False
+    facet_counts: Optional[Dict] = {}
+
+    def __init__(self, **data):
+        if not isinstance(data.get('tag_index'), TagIndex):
+            data['tag_index'] = TagIndex(data.get('tag_index') or {})
+        super().__init__(filter_type='Tags', **data)
+
+    def index_key(self) -> Tuple:
+        return (self.filter_type, self.display_column, self.tag_index.version)
+
+    def build_facet_index(self, dataframe: pandas.DataFrame) -> Any:
+        # Pair every row with each of its tags in one join, so counting under a mask is a single bincount
+        tag_keys = pandas.DataFrame([(tag, key) for tag, keys in self.tag_index.items() for key in keys], columns=['tag', 'key'])
+        rows = pandas.DataFrame({'row': numpy.arange(len(dataframe)), 'key': dataframe[self.key_column].to_numpy()})
+        pairs = rows.merge(tag_keys.astype({'key': rows['key'].dtype}), on='key')
+        codes, values = pandas.factorize(pairs['tag'], sort=True)
+        return pairs['row'].to_numpy(), codes, values.tolist()
+
+    def build_facet(self, dataframe: pandas.DataFrame, facet_index: Any, mask: Optional[numpy.ndarray]) -> Any:
+        rows, codes, values = facet_index
+        if mask is not None:
+            codes = codes[mask[rows]]
+        counts = numpy.bincount(codes, minlength=len(values))
+        return dict(zip(values, counts.tolist()))
+
+    def set_facet(self, facet: Any):
+        self.facet_counts = facet
+
+    def get_selected_values(self) -> List[str]:
+        return [value for value, selected in self.selected_values.items() if selected]
+
+    def get_selected_keys(self) -> set:
+        key_sets = [self.tag_index.get(tag, frozenset()) for tag in self.get_selected_values()]
+        if self.match_all:
+            return set.intersection(*map(set, key_sets))
+        return set().union(*key_sets)
+
+    def selection_key(self) -> Optional[Tuple]:
+        selected_values = self.get_selected_values()
+        if len(selected_values) == 0:
+            return None
+        return (self.match_all, tuple(sorted(selected_values)))
+
+    def display_key(self) -> Optional[Tuple]:
+        return (self.match_all, self.selection_key())
+
+    def build_mask(self, dataframe: pandas.DataFrame) -> numpy.ndarray:
+        return dataframe[self.key_column].isin(self.get_selected_keys()).to_numpy()
+
+    def select(self, dataframe: Optional[pandas.DataFrame], params: Mapping[str, List[str]]):
+        self.selected_values = {value.strip().lower(): True for value in params.get(self.display_column) or []}
+        self.match_all = (params.get(f'{self.display_column}_match') or ['any'])[0] == 'all'
+
+    def to_sql(self, sql_columns: Sequence[str]) -> Optional[Tuple[str, List[Any]]]:
+        if self.key_column not in sql_columns:
+            return None
+        # The index already resolved the tags, so SQL only has to match keys
+        return f'"{self.key_column}" IN (SELECT value FROM json_each(?))', [json.dumps(sorted(self.get_selected_keys()))]
+
 
 class Range(Filter):
     source_column: str
     selected_extrema: List[Any]
+    facet_extrema: Optional[List[Any]] = []
 
     def __init__(self, **data):
         super().__init__(filter_type='Range', **data)
 
+    def build_facet_index(self, dataframe: pandas.DataFrame) -> Any:
+        return numpy.sort(dataframe[self.source_column].dropna().to_numpy())
+
+    def build_facet(self, dataframe: pandas.DataFrame, facet_index: Any, mask: Optional[numpy.ndarray]) -> Any:
+        if mask is None:
+            return [facet_index[0].item(), facet_index[-1].item()] if len(facet_index) > 0 else [None, None]
+        values = dataframe[self.source_column].to_numpy()[mask]
+        return [values.min().item(), values.max().item()] if len(values) > 0 else [None, None]
+
+    def set_facet(self, facet: Any):
+        self.facet_extrema = facet
+
+    def selection_key(self) -> Optional[Tuple]:
+        if len(self.selected_extrema) < 2 or self.selected_extrema == [None, None]:
+            return None
+        return tuple(self.selected_extrema)
+
+    def build_mask(self, dataframe: pandas.DataFrame) -> numpy.ndarray:
+        column = dataframe[self.source_column].to_numpy()
+        mask = numpy.ones(len(column), dtype=bool)
+        if self.selected_extrema[0] is not None:
+            mask &= column >= self.selected_extrema[0]
+        if self.selected_extrema[1] is not None:
+            mask &= column <= self.selected_extrema[1]
+        return mask
+
+    def select(self, dataframe: Optional[pandas.DataFrame], params: Mapping[str, List[str]]):
+        self.selected_extrema = [
+            _parse_number(params.get(f'{self.display_column}_min')),
+            _parse_number(params.get(f'{self.display_column}_max'))
+        ]
+
+    def to_sql(self, sql_columns: Sequence[str]) -> Optional[Tuple[str, List[Any]]]:
+        if self.source_column not in sql_columns:
+            return None
+        clauses = []
+        params = []
+        if self.selected_extrema[0] is not None:
+            clauses.append(f'"{self.source_column}" >= ?')
+            params.append(self.selected_extrema[0])
+        if self.selected_extrema[1] is not None:
+            clauses.append(f'"{self.source_column}" <= ?')
+            params.append(self.selected_extrema[1])
+        return ' and '.join(clauses), params
+
 
 class DoubleRange(Filter):
     source_columns: Tuple[str,str]
     selected_extrema: Optional[List[Any]] = []
+    facet_extrema: Optional[List[Any]] = []
 
     def __init__(self, **data):
         super().__init__(filter_type='DoubleRange', **data)
 
+    def build_facet_index(self, dataframe: pandas.DataFrame) -> Any:
+        return [numpy.sort(dataframe[column].dropna().to_numpy()) for column in self.source_columns]
+
+    def build_facet(self, dataframe: pandas.DataFrame, facet_index: Any, mask: Optional[numpy.ndarray]) -> Any:
+        if mask is None:
+            low_values, high_values = facet_index
+            return [
+                low_values[0].item() if len(low_values) > 0 else None,
+                high_values[-1].item() if len(high_values) > 0 else None
+            ]
+        low_values, high_values = [dataframe[column].to_numpy()[mask] for column in self.source_columns]
+        return [
+            low_values.min().item() if len(low_values) > 0 else None,
+            high_values.max().item() if len(high_values) > 0 else None
+        ]
+
+    def set_facet(self, facet: Any):
+        self.facet_extrema = facet
+
+    def selection_key(self) -> Optional[Tuple]:
+        if len(self.selected_extrema) < 2 or self.selected_extrema == [None, None]:
+            return None
+        return tuple(self.selected_extrema)
+
+    def build_mask(self, dataframe: pandas.DataFrame) -> numpy.ndarray:
+        # Rows whose [low, high] range overlaps the selected range
+        low_column = dataframe[self.source_columns[0]].to_numpy()
+        high_column = dataframe[self.source_columns[1]].to_numpy()
+        mask = numpy.ones(len(low_column), dtype=bool)
+        if self.selected_extrema[0] is not None:
+            mask &= high_column >= self.selected_extrema[0]
+        if self.selected_extrema[1] is not None:
+            mask &= low_column <= self.selected_extrema[1]
+        return mask
+
+    def select(self, dataframe: Optional[pandas.DataFrame], params: Mapping[str, List[str]]):
+        self.selected_extrema = [
+            _parse_number(params.get(f'{self.display_column}_min')),
+            _parse_number(params.get(f'{self.display_column}_max'))
+        ]
+
+    def to_sql(self, sql_columns: Sequence[str]) -> Optional[Tuple[str, List[Any]]]:
+        if self.source_columns[0] not in sql_columns or self.source_columns[1] not in sql_columns:
+            return None
+        clauses = []
+        params = []
+        if self.selected_extrema[0] is not None:
+            clauses.append(f'"{self.source_columns[1]}" >= ?')
+            params.append(self.selected_extrema[0])
+        if self.selected_extrema[1] is not None:
+            clauses.append(f'"{self.source_columns[0]}" <= ?')
+            params.append(self.selected_extrema[1])
+        return ' and '.join(clauses), params
+
+
+class Page(BaseModel):
+    rows: List[Dict[str, Any]]
+    total: int
+    offset: int
+    limit: int
+    sort_by: List[str] = []
+    next_offset: Optional[int] = None
+    next_after: Optional[Any] = None
+
 
 class FilterTable(BaseModel):
-    base_dataframe: pandas.DataFrame
-    current_view: Optional[pandas.DataFrame] = None
+    # One session's view of a shared BaseTable: its filter selections and the positions of the rows they let through
+    table: BaseTable
     filters: Optional[List[Any]] = []
+    _view_indices: Optional[numpy.ndarray] = PrivateAttr(default=None)
 
     class Config:
         arbitrary_types_allowed = True
 
-    def __init__(self, **data):
+    def __init__(self, base_dataframe: Optional[pandas.DataFrame] = None, key_column: str = 'id', **data):
+        if base_dataframe is not None:
+            data['table'] = BaseTable(base_dataframe, key_column=key_column)
         super().__init__(**data)
-        self.base_dataframe = self.base_dataframe.set_axis([Column(col_name) for col_name in self.base_dataframe.columns], axis='columns')
-        if self.current_view is None:
-            self.current_view = self.base_dataframe
 
+    @property
+    def base_dataframe(self) -> pandas.DataFrame:
+        return self.table.dataframe
+
+    @property
+    def current_view(self) -> pandas.DataFrame:
+        if self._view_indices is None:
+            return self.table.dataframe
+        return self.table.dataframe.take(self._view_indices)
+
+    def select(self, params: Mapping[str, List[str]]):
+        for filter in self.filters:
+            filter.select(self.table.dataframe, params)
+
+    def fragment_key(self) -> Tuple:
+        # Identifies what this view renders as a filter sidebar: the table version and every filter's selection
+        return (self.table.version,) + tuple((filter.index_key(), filter.display_key()) for filter in self.filters)
+
+    def apply(self) -> pandas.DataFrame:
+        masks = [filter.get_mask(self.table) for filter in self.filters]
+        selection_keys = [(filter.index_key(), filter.selection_key()) for filter in self.filters]
+        for filter_index, filter in enumerate(self.filters):
+            other_masks = [mask for mask_index, mask in enumerate(masks) if mask_index != filter_index and mask is not None]
+            other_key = tuple(key for key_index, key in enumerate(selection_keys) if key_index != filter_index and key[1] is not None)
+            filter.refresh_facet(self.table, other_masks, other_key)
+        view_key = tuple(key for key, mask in zip(selection_keys, masks) if mask is not None)
+        if len(view_key) == 0:
+            self._view_indices = None
+        else:
+            masks = [mask for mask in masks if mask is not None]
+            self._view_indices = self.table.derive(('view', view_key), lambda: numpy.flatnonzero(numpy.logical_and.reduce(masks)))
+        return self.current_view
+
+    def _get_sort_order(self, sort_by: Tuple[str, ...]) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        # Row positions in sort order, and each row's rank in it; shared for the life of the base table.
+        # The key column breaks ties, so the order is total and keyset pagination is stable.
+        def build() -> Tuple[numpy.ndarray, numpy.ndarray]:
+            sort_keys = []
+            for sort_column in reversed(sort_by + (self.table.key_column,)):
+                descending = sort_column.startswith('-')
+                codes, _ = pandas.factorize(self.table.dataframe[sort_column.lstrip('-')], sort=True)
+                sort_keys.append(-codes if descending else codes)
+            order = numpy.lexsort(sort_keys)
+            rank = numpy.empty(len(order), dtype=numpy.int64)
+            rank[order] = numpy.arange(len(order))
+            return order, rank
+        return self.table.derive(('sort', sort_by), build)
+
+    def get_page(self, sort_by: List[str] = [], offset: int = 0, limit: int = 50, after: Optional[Any] = None) -> Page:
+        dataframe = self.table.dataframe
+        key_column = self.table.key_column
+        sort_by = tuple(sort_column for sort_column in sort_by if sort_column.lstrip('-') in dataframe.columns)
+        order, rank = self._get_sort_order(sort_by)
+        if self._view_indices is None:
+            selected = order
+        else:
+            # Sort just the rows in view by their rank, rather than walking the whole table's order
+            selected = self._view_indices[numpy.argsort(rank[self._view_indices], kind='stable')]
+        if after is not None:
+            # Keyset: start just past the row with key after, wherever it now falls in the filtered order
+            key_index = self.table.derive(('key_index',), lambda: pandas.Index(dataframe[key_column]))
+            try:
+                offset = int(numpy.searchsorted(rank[selected], rank[key_index.get_loc(after)], side='right'))
+            except KeyError:
+                offset = 0
+        page_indices = selected[offset:offset + limit]
+        page_frame = dataframe.iloc[page_indices]
+        page_frame = page_frame.astype(object).where(page_frame.notna(), None)
+        rows = page_frame.to_dict(orient='records')
+        has_next = offset + limit < len(selected)
+        return Page(
+            rows=rows,
+            total=len(selected),
+            offset=offset,
+            limit=limit,
+            sort_by=list(sort_by),
+            next_offset=offset + limit if has_next else None,
+            next_after=rows[-1][key_column] if has_next and len(rows) > 0 else None
+        )
+
+
+class SqlSource(BaseModel):
+    # A table query that filters, sorting and paging can be pushed down into, so only the requested page leaves SQLite
+    select_stmt: str
+    params: Tuple = ()
+    columns: List[str]
+    key_column: str = 'id'
+
+    def compile_where(self, filters: List[Filter]) -> Tuple[str, List[Any], List[Filter]]:
+        clauses = []
+        params = []
+        memory_filters = []
+        for filter in filters:
+            if filter.selection_key() is None:
+                continue
+            compiled = filter.to_sql(self.columns)
+            if compiled is None:
+                memory_filters.append(filter)
+            else:
+                clauses.append(compiled[0])
+                params.extend(compiled[1])
+        where_clause = f'WHERE {" and ".join(clauses)}' if len(clauses) > 0 else ''
+        return where_clause, params, memory_filters
+
+    def compile_keyset(self, sort_by: List[str], cursor: Sequence[Any]) -> Tuple[str, List[Any]]:
+        # Rows after the cursor row in ORDER BY order, with NULLs sorting first as SQLite does:
+        # (a > x) or (a is x and b < y) or (a is x and b is y and id > z)
+        alternatives = []
+        params = []
+        for sort_index, sort_column in enumerate(sort_by):
+            column = sort_column.lstrip('-')
+            clauses = [f'"{previous_column.lstrip("-")}" IS ?' for previous_column in sort_by[:sort_index]]
+            params.extend(cursor[:sort_index])
+            if sort_column.startswith('-'):
+                clauses.append(f'(("{column}" IS NULL and ? IS NOT NULL) or "{column}" < ?)')
+            else:
+                clauses.append(f'(("{column}" IS NOT NULL and ? IS NULL) or "{column}" > ?)')
+            params.extend([cursor[sort_index], cursor[sort_index]])
+            alternatives.append(' and '.join(clauses))
+        return f'({" or ".join(alternatives)})', params
+
+    def query_page(self, db: Any, filters: List[Filter], sort_by: List[str] = [], offset: int = 0, limit: int = 50,
+            after: Optional[Any] = None, formatter: Optional[Callable[[pandas.DataFrame], pandas.DataFrame]] = None) -> Page:
+        where_clause, params, memory_filters = self.compile_where(filters)
+        from_stmt = f'FROM ({self.select_stmt}) {where_clause}'
+        params = list(self.params) + params
+        if len(memory_filters) > 0 or any(sort_column.lstrip('-') not in self.columns for sort_column in sort_by):
+            # Fall back to memory for whatever SQL can't express, still having SQL narrow the rows first
+            dataframe = pandas.read_sql_query(f'SELECT * {from_stmt}', db.reader, params=params)
+            filter_table = FilterTable(base_dataframe=formatter(dataframe) if formatter is not None else dataframe,
+                filters=memory_filters, key_column=self.key_column)
+            filter_table.apply()
+            return filter_table.get_page(sort_by=sort_by, offset=offset, limit=limit, after=after)
+
+        sort_by = sort_by + [self.key_column]
+        keyset_clause = ''
+        keyset_params = []
+        if after is not None:
+            cursor_columns = ', '.join(f'"{sort_column.lstrip("-")}"' for sort_column in sort_by)
+            select_stmt = f'SELECT {cursor_columns} FROM ({self.select_stmt}) WHERE "{self.key_column}" = ?'
+            cursor = db.reader.execute(select_stmt, list(self.params) + [after]).fetchone()
+            if cursor is not None:
+                keyset_clause, keyset_params = self.compile_keyset(sort_by, cursor)
+        if keyset_clause:
+            # One pass counts both the whole result and what is left after the cursor
+            count_stmt = f'SELECT COUNT(*), COALESCE(SUM(CASE WHEN {keyset_clause} THEN 1 ELSE 0 END), 0) {from_stmt}'
+            total, remaining = db.reader.execute(count_stmt, keyset_params + params).fetchone()
+            offset = total - remaining
+            page_where = f'{where_clause} and {keyset_clause}' if where_clause else f'WHERE {keyset_clause}'
+            page_params = params + keyset_params + [limit]
+            limit_clause = 'LIMIT ?'
+        else:
+            total = db.reader.execute(f'SELECT COUNT(*) {from_stmt}', params).fetchone()[0]
+            page_where = where_clause
+            page_params = params + [limit, offset]
+            limit_clause = 'LIMIT ? OFFSET ?'
+        order_clause = ', '.join(f'"{sort_column.lstrip("-")}" {"DESC" if sort_column.startswith("-") else "ASC"}' for sort_column in sort_by)
+        page_stmt = f'SELECT * FROM ({self.select_stmt}) {page_where} ORDER BY {order_clause} {limit_clause}'
+        dataframe = pandas.read_sql_query(page_stmt, db.reader, params=page_params)
+        if formatter is not None:
+            dataframe = formatter(dataframe)
+        dataframe = dataframe.astype(object).where(dataframe.notna(), None)
+        rows = dataframe.to_dict(orient='records')
+        has_next = offset + limit < total
+        return Page(
+            rows=rows,
+            total=total,
+            offset=offset,
+            limit=limit,
+            sort_by=sort_by[:-1],
+            next_offset=offset + limit if has_next else None,
+            next_after=rows[-1][self.key_column] if has_next and len(rows) > 0 else None
+        )
@@ -0,0 +1,44 @@
+import os, hashlib
+from typing import Any, Hashable
+from markupsafe import Markup
+from cache import LRUCache
+
+
+class FragmentCache:
+    # Rendered HTML for template fragments whose output depends only on their key, e.g. the navigation for a set of
+    # roles or a filter sidebar for a table version and selection. A fragment sees only the context passed to it.
+    def __init__(self, env: Any, max_size: int = 1024):
+        self.env = env
+        self.cache = LRUCache(max_size=max_size)
+        self.version = ''
+
+    def render(self, template_name: str, key: Hashable, **context) -> Markup:
+        cache_key = (template_name, key)
+        html = self.cache.get(cache_key)
+        if html is None:
+            html = Markup(self.env.get_template(template_name).render(**context))
+            self.cache.put(cache_key, html)
+        return html
+
+    def invalidate(self, template_name: str, key: Hashable):
+        self.cache.invalidate((template_name, key))
+
+    def clear(self):
+        self.cache.clear()
+
+    def precompile(self) -> int:
+        # Compile every template up front, so the first requests after a deploy don't pay for it. The fingerprint of
+        # their sources is the same in every worker of one deploy, and changes with the next.
+        template_names = self.env.list_templates(extensions=['html'])
+        digest = hashlib.sha1()
+        for template_name in template_names:
+            digest.update(self.env.loader.get_source(self.env, template_name)[0].encode())
+            self.env.get_template(template_name)
+        self.version = digest.hexdigest()[:16]
+        return len(template_names)
+
+
+def install_fragment_cache(env: Any) -> FragmentCache:
+    fragments = FragmentCache(env, max_size=int(os.environ.get("FRAGMENT_CACHE_SIZE") or 1024))
+    env.globals['fragment'] = fragments.render
+    return fragments
@@ -0,0 +1,104 @@
+import os, re, time, asyncio
+from abc import ABC, abstractmethod
+from typing import Any, Optional, Dict, Tuple
+
+
+GOOGLE_DISCOVERY_URL = os.environ.get("GOOGLE_DISCOVERY_URL") or "https://accounts.google.com/.well-known/openid-configuration"
+DEFAULT_DISCOVERY_TTL = 3600
+
+
+class HttpTransport(ABC):
+    # Anything with this interface can stand in for the network, e.g. a local fake in benchmarks and tests
+    @property
+    def errors(self) -> Tuple[type, ...]:
+        # What request_json raises when the other end can't be reached
+        return (OSError,)
+
+    @abstractmethod
+    async def request_json(self, method: str, url: str, headers: Optional[Dict[str, str]] = None, data: Any = None) -> Tuple[Any, Dict[str, str]]:
+        pass
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+class AiohttpTransport(HttpTransport):
+    # aiohttp is only imported once a request is made, so workers that never handle a sign-in don't pay for it
+    def __init__(self, max_connections: int = 20):
+        self.max_connections = max_connections
+        self.session: Optional[Any] = None
+
+    @property
+    def errors(self) -> Tuple[type, ...]:
+        import aiohttp
+        return (aiohttp.ClientError,)
+
+    async def open(self):
+        # One long-lived session, so sign-ins reuse pooled keep-alive connections instead of new TCP/TLS handshakes
+        import aiohttp
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, ttl_dns_cache=300)
+            self.session = aiohttp.ClientSession(connector=connector)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def request_json(self, method: str, url: str, headers: Optional[Dict[str, str]] = None, data: Any = None) -> Tuple[Any, Dict[str, str]]:
+        await self.open()
+        async with self.session.request(method, url, headers=headers, data=data) as response:
+            return await response.json(), dict(response.headers)
+
+
+def get_cache_ttl(headers: Dict[str, str], default_ttl: float = DEFAULT_DISCOVERY_TTL) -> float:
+    headers = {key.lower(): value for key, value in headers.items()}
+    cache_control = headers.get('cache-control', '').lower()
+    if 'no-store' in cache_control or 'no-cache' in cache_control:
+        return 0
+    max_age = re.search(r'max-age=(\d+)', cache_control)
+    if max_age is None:
+        return default_ttl
+    age = headers.get('age', '0')
+    return max(0, int(max_age.group(1)) - (int(age) if age.isdigit() else 0))
+
+
+class DiscoveryCache:
+    def __init__(self, transport: HttpTransport, url: str = GOOGLE_DISCOVERY_URL, default_ttl: float = DEFAULT_DISCOVERY_TTL):
+        self.transport = transport
+        self.url = url
+        self.default_ttl = default_ttl
+        self.document: Optional[dict] = None
+        self.expires_at = 0.0
+        self.fetches = 0
+        self._lock = asyncio.Lock()
+
+    async def get(self) -> dict:
+        if self.document is not None and time.monotonic() < self.expires_at:
+            return self.document
+        async with self._lock:
+            # Concurrent sign-ins wait for a single refresh rather than each fetching the document
+            if self.document is not None and time.monotonic() < self.expires_at:
+                return self.document
+            try:
+                document, headers = await self.transport.request_json('GET', self.url)
+            except self.transport.errors:
+                if self.document is None:
+                    raise
+                return self.document # serve the stale copy; the endpoints in it change very rarely
+            self.fetches += 1
+            self.document = document
+            self.expires_at = time.monotonic() + get_cache_ttl(headers, self.default_ttl)
+            return self.document
+
+    def clear(self):
+        self.document = None
+        self.expires_at = 0.0
+
+
+def make_oauth_client(client_id: Optional[str]) -> Any:
+    from oauthlib.oauth2 import WebApplicationClient
+    return WebApplicationClient(client_id)
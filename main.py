@@ -1,59 +1,98 @@
-import os, aiohttp, json, db
-from fastapi import FastAPI, Request, APIRouter, HTTPException, Form
-from fastapi.responses import RedirectResponse
+import os, json, db, cache, google_auth, session, fragments, bulk
+from fastapi import FastAPI, Request, APIRouter, HTTPException, Form, Depends, Body
+from fastapi.responses import RedirectResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from oauthlib.oauth2 import WebApplicationClient
-from user import User, load_all_roles, load_all_users_by_role
-from student import StudentData, Student
-from program import Program, Level, GradeLevel
-from camp import Camp, load_camps_table
+from user import User, RoleIndex, load_all_roles, load_users_by_role
+from student import StudentData, Student, STUDENT_EXPORT_FIELDS
+from program import Program, Level, GradeLevel, PROGRAM_EXPORT_FIELDS, LEVEL_EXPORT_FIELDS, load_program
+from camp import Camp, load_camp, load_camps_table, load_camps_page_async
 from datetime import date
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence
 
 
 app = FastAPI()
 app.mount("/static", StaticFiles(directory="static"), name="static")
 app.mount("/images", StaticFiles(directory="images"), name="images")
-app.secret_key = os.environ.get("SECRET_KEY") or os.urandom(24)
-app.user = None
+app.secret_key = os.environ.get("SECRET_KEY") # or, once the database is open, the key shared through it
 app.db = None
 app.db_path = os.environ.get("DB_PATH") or os.path.join(os.path.dirname(__file__), 'app.db')
-app.db = db.get_db(app)
-app.roles = load_all_roles(db = app.db)
-app.instructors = {}
+app.roles = RoleIndex({})
 app.promoted_programs = {}
-app.camps = {}
+app.sessions = None
+app.add_middleware(session.SessionMiddleware)
+app.add_middleware(db.ExternalChangeMiddleware) # outermost, so caches are current before the session is resolved
 
 templates = Jinja2Templates(directory="templates")
+app.fragments = fragments.install_fragment_cache(templates.env)
 api_router = APIRouter()
 
 GOOGLE_CLIENT_ID = os.environ.get("GOOGLE_CLIENT_ID", None)
 GOOGLE_CLIENT_SECRET = os.environ.get("GOOGLE_CLIENT_SECRET", None)
-GOOGLE_DISCOVERY_URL = "https://accounts.google.com/.well-known/openid-configuration"
-client = WebApplicationClient(GOOGLE_CLIENT_ID)
+PAGE_SIZE = int(os.environ.get("PAGE_SIZE") or 50)
+MAX_PAGE_SIZE = 500
+# The tables each conditionally fetched page reads, including the signed-in user and roles the navigation shows
+PROGRAMS_PAGE_TABLES = ('user', 'user_x_roles', 'user_x_programs', 'program', 'program_x_tags')
+SCHEDULE_PAGE_TABLES = PROGRAMS_PAGE_TABLES + ('camp', 'camp_x_instructors', 'camp_listing')
+STUDENTS_PAGE_TABLES = ('user', 'user_x_roles', 'user_x_students', 'student')
+app.http_transport = google_auth.AiohttpTransport()
+app.google_discovery = google_auth.DiscoveryCache(app.http_transport)
+
+
+def open_app():
+    # Database work waits for startup rather than import, so spawning a worker or collecting tests stays cheap
+    if app.db is not None and app.sessions is not None:
+        return
+    app.db = db.get_db(app)
+    with app.db.connection() as connection:
+        app.roles = load_all_roles(db = connection)
+    app.fragments.clear() # the navigation is cached by role names, so drop it whenever the roles are reloaded
+    app.fragments.precompile()
+    app.secret_key = app.secret_key or session.load_secret_key(app.db)
+    app.sessions = session.get_session_store(app.secret_key, app.db)
+    cache.watch(app.db)
 
 
 async def get_google_provider_cfg() -> dict:
-    ret_json = {}
-    async with aiohttp.ClientSession() as session:
-        async with session.get(GOOGLE_DISCOVERY_URL) as response:
-            ret_json = await response.json()
-    return ret_json
+    return await app.google_discovery.get()
+
+
+def get_query_lists(request: Request) -> Dict[str, List[str]]:
+    return {key: request.query_params.getlist(key) for key in request.query_params.keys()}
+
+
+def get_page_args(request: Request) -> dict:
+    query_params = request.query_params
+    page_args = {'sort_by': query_params.getlist('sort'), 'offset': 0, 'limit': PAGE_SIZE, 'after': query_params.get('after')}
+    if query_params.get('offset', '').isdigit():
+        page_args['offset'] = int(query_params['offset'])
+    if query_params.get('limit', '').isdigit():
+        page_args['limit'] = max(1, min(int(query_params['limit']), MAX_PAGE_SIZE))
+    if page_args['after'] is not None and page_args['after'].isdigit():
+        page_args['after'] = int(page_args['after'])
+    return page_args
+
+
+def build_page_args(request: Request, filtertable: Any, template_args: dict):
+    page = filtertable.get_page(**get_page_args(request))
+    url = request.url.remove_query_params('after')
+    template_args['page'] = page
+    template_args['prev_url'] = str(url.include_query_params(offset=max(0, page.offset - page.limit))) if page.offset > 0 else None
+    template_args['next_url'] = str(url.include_query_params(offset=page.next_offset)) if page.next_offset is not None else None
 
 
 def build_base_html_args(request: Request) -> dict:
     template_args = {"request": request}
-    if app.user is None:
+    if request.state.user is None:
         template_args['user_id'] = None
         template_args['user_name'] = None
         template_args['roles'] = None
+        template_args['nav_key'] = None
     else:
-        template_args['user_id'] = app.user.id
-        template_args['user_name'] = app.user.full_name
-        current_roles = []
-        for role_name in app.user.roles:
-            current_roles.append(app.roles[role_name])
-        template_args['roles'] = current_roles
+        template_args['user_id'] = request.state.user.id
+        template_args['user_name'] = request.state.user.full_name
+        template_args['roles'] = app.roles.get_roles(request.state.user.roles)
+        template_args['nav_key'] = tuple(role.name for role in template_args['roles'])
     return template_args
 
 
@@ -68,6 +107,7 @@ async def signin_get(request: Request):
     google_provider_cfg = await get_google_provider_cfg()
     authorization_endpoint = google_provider_cfg["authorization_endpoint"]
     redirect_uri = 'https://' + request.url.netloc + request.url.path + '/callback'
+    client = google_auth.make_oauth_client(GOOGLE_CLIENT_ID)
     request_uri = client.prepare_request_uri(
         authorization_endpoint,
         redirect_uri=redirect_uri,
@@ -77,10 +117,11 @@ async def signin_get(request: Request):
 
 
 @api_router.get("/signin/callback")
-async def signin_callback_get(request: Request, code):
+async def signin_callback_get(request: Request, code, connection: db.Connection = Depends(db.get_connection)):
     google_provider_cfg = await get_google_provider_cfg()
     token_endpoint = google_provider_cfg["token_endpoint"]
     redirect_url = 'https://' + request.url.netloc + request.url.path
+    client = google_auth.make_oauth_client(GOOGLE_CLIENT_ID)
     token_url, headers, body = client.prepare_token_request(
         token_endpoint,
         authorization_response=f'{request.url}',
@@ -88,58 +129,110 @@ async def signin_callback_get(request: Request, code):
         code=code,
         client_secret=GOOGLE_CLIENT_SECRET
     )
-    async with aiohttp.ClientSession(headers=headers) as session:
-        async with session.post(token_url, data=body) as response:
-            token_response_json = await response.json()
+    token_response_json, _ = await app.http_transport.request_json('POST', token_url, headers=headers, data=body)
     client.parse_request_body_response(json.dumps(token_response_json))
     userinfo_endpoint = google_provider_cfg["userinfo_endpoint"]
     uri, headers, body = client.add_token(userinfo_endpoint)
-    async with aiohttp.ClientSession(headers=headers) as session:
-        async with session.get(uri, data=body) as response:
-            user_info_json = await response.json()
+    user_info_json, _ = await app.http_transport.request_json('GET', uri, headers=headers, data=body)
     if user_info_json.get("email_verified"):
-        app.user = User(
-            db = app.db,
-            google_id = user_info_json["sub"],
-            given_name = user_info_json["given_name"],
-            family_name = user_info_json["family_name"],
-            full_name = user_info_json["name"],
-            picture = user_info_json["picture"]
-        )
-        app.user.add_email_address(db = app.db, email_address = user_info_json["email"])
+        def sign_in_user() -> User:
+            with db.transaction(connection):
+                user = User(
+                    db = connection,
+                    google_id = user_info_json["sub"],
+                    given_name = user_info_json["given_name"],
+                    family_name = user_info_json["family_name"],
+                    full_name = user_info_json["name"],
+                    picture = user_info_json["picture"]
+                )
+                user.add_email_address(db = connection, email_address = user_info_json["email"])
+            return user
+        user = await db.run(sign_in_user)
     else:
         return "User email not available or not verified by Google.", 400
-    return RedirectResponse(url='/')
+    response = RedirectResponse(url='/')
+    response.set_cookie(session.SESSION_COOKIE_NAME, await db.run(app.sessions.create, user, db = connection), httponly=True, secure=True, samesite='lax')
+    return response
 
 
 @api_router.get("/signout")
-async def signout_get(request: Request):
-    app.user = None
-    return RedirectResponse(url='/')
+async def signout_get(request: Request, connection: db.Connection = Depends(db.get_connection)):
+    await db.run(app.sessions.delete, app.sessions.unsign(request.cookies.get(session.SESSION_COOKIE_NAME)), db = connection)
+    response = RedirectResponse(url='/')
+    response.delete_cookie(session.SESSION_COOKIE_NAME)
+    return response
+
+
+@app.on_event("startup")
+async def startup() -> None:
+    await db.run(open_app)
 
 
 @app.on_event("shutdown")
 async def shutdown() -> None:
+    await app.http_transport.close()
     db.close_db(app)
     if os.environ.get("DEV_MODE") and os.path.isfile(app.db_path):
         os.remove(app.db_path)
 
 
-def check_basic_auth(permission_url_path):
-    if not app.user:
+def get_etag_headers(etag: str) -> Dict[str, str]:
+    # private: pages differ per user, no-cache: the browser must still ask, but may be told 304 Not Modified
+    return {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+
+
+async def check_not_modified(request: Request, connection: db.Connection, tables: Sequence[str]) -> Optional[Response]:
+    # Answers a conditional GET before anything is loaded or rendered; otherwise the ETag waits in request.state.etag.
+    # The versions live in the database, so the tag is the same from every worker process.
+    user_id = request.state.user.id if request.state.user is not None else None
+    versions = await db.run(db.get_table_versions, connection, tables)
+    request.state.etag = db.make_etag(versions, app.fragments.version, user_id, request.url.path, request.url.query)
+    if db.etag_matches(request.headers.get('if-none-match'), request.state.etag):
+        return Response(status_code=304, headers=get_etag_headers(request.state.etag))
+    # Whatever another worker committed before those versions were read must show in the page, so catch up on it now
+    if app.db.poll_external_changes():
+        await db.run(app.db.apply_external_changes, connection)
+    return None
+
+
+async def import_records(request: Request, import_func: Callable[..., int], format: Optional[str]) -> dict:
+    # The upload is spooled before a pooled connection is checked out, so a slow client never holds one. import_func
+    # then parses it a row at a time, inserting in chunks within one transaction.
+    try:
+        format = bulk.get_format(format, request.headers.get('content-type'))
+        with await bulk.spool(request.stream()) as upload:
+            async with db.connection_async(app.db) as connection:
+                count = await db.run(import_func, db = connection, records = bulk.read_records(upload, format))
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+    return {'imported': count}
+
+
+def export_records(export_func: Callable[..., Iterable], fields: Sequence[str], format: Optional[str], file_name: str) -> StreamingResponse:
+    try:
+        format = bulk.get_format(format)
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+    def generate() -> Iterator[str]:
+        # A connection of its own, held only while the rows stream off its cursor
+        with app.db.connection() as connection:
+            yield from bulk.write_records(export_func(db = connection), fields, format)
+    headers = {'Content-Disposition': f'attachment; filename="{file_name}.{format}"'}
+    return StreamingResponse(generate(), media_type=bulk.FORMATS[format], headers=headers)
+
+
+def check_basic_auth(request: Request, permission_url_path):
+    if not request.state.user:
         return RedirectResponse(url='/')
 
-    for role_name in app.user.roles:
-        role = app.roles[role_name]
-        if permission_url_path in role.permissible_endpoints:
-            return None
-
+    if permission_url_path in request.state.user.get_permitted_endpoints(app.roles):
+        return None
     raise HTTPException(status_code=403, detail=f"User does not have permission for {permission_url_path}")
 
 
 @api_router.get("/profile")
 async def profile_get(request: Request):
-    auth_check = check_basic_auth('/profile')
+    auth_check = check_basic_auth(request, '/profile')
     if auth_check is not None:
         return auth_check
     template_args = build_base_html_args(request)
@@ -148,7 +241,7 @@ async def profile_get(request: Request):
 
 @api_router.get("/camps")
 async def camps_get(request: Request):
-    auth_check = check_basic_auth('/camps')
+    auth_check = check_basic_auth(request, '/camps')
     if auth_check is not None:
         return auth_check
     template_args = build_base_html_args(request)
@@ -156,155 +249,210 @@ async def camps_get(request: Request):
 
 
 @api_router.get("/students")
-async def get_students_page(request: Request):
-    auth_check = check_basic_auth('/students')
+async def get_students_page(request: Request, connection: db.Connection = Depends(db.get_connection)):
+    auth_check = check_basic_auth(request, '/students')
     if auth_check is not None:
         return auth_check
+    not_modified = await check_not_modified(request, connection, STUDENTS_PAGE_TABLES)
+    if not_modified is not None:
+        return not_modified
     template_args = build_base_html_args(request)
     student_names = {}
-    if app.user is not None:
-        app.user.load_students(db = app.db)
-        for student_id, student in app.user.students.items():
+    if request.state.user is not None:
+        await db.run(request.state.user.load_students, db = connection)
+        for student_id, student in request.state.user.students.items():
             student_names[student_id] = student.name
     template_args['student_names'] = student_names
-    return templates.TemplateResponse("students.html", template_args)
+    return templates.TemplateResponse("students.html", template_args, headers=get_etag_headers(request.state.etag))
 
 @api_router.get("/students/{student_id}", response_model=StudentData)
-async def get_one_student(student_id: int):
-    if check_basic_auth('/students') is not None:
+async def get_one_student(request: Request, response: Response, student_id: int, connection: db.Connection = Depends(db.get_connection)):
+    if check_basic_auth(request, '/students') is not None:
         return StudentData()
-    student = app.user.students.get(student_id)
+    not_modified = await check_not_modified(request, connection, STUDENTS_PAGE_TABLES)
+    if not_modified is not None:
+        return not_modified
+    await db.run(request.state.user.load_students, db = connection)
+    student = request.state.user.students.get(student_id)
     if student is None:
         raise HTTPException(status_code=403, detail=f"User does not have permission for student id={student_id}")
+    response.headers.update(get_etag_headers(request.state.etag))
     return student
 
 @api_router.put("/students/{student_id}", response_model = StudentData)
-async def put_update_student(student_id: int, updated_student: StudentData):
-    if check_basic_auth('/students') is not None:
+async def put_update_student(request: Request, student_id: int, updated_student: StudentData, connection: db.Connection = Depends(db.get_connection)):
+    if check_basic_auth(request, '/students') is not None:
         return StudentData()
-    student = app.user.students.get(student_id)
+    await db.run(request.state.user.load_students, db = connection)
+    student = request.state.user.students.get(student_id)
     if student is None:
         raise HTTPException(status_code=403, detail=f"User does not have permission for student id={student_id}")
     student = student.copy(update=updated_student.dict())
-    await student.update_basic(app.db)
-    app.user.students[student_id] = student
+    await db.run(student.update_basic, db = connection)
+    request.state.user.students[student_id] = student
     return student
 
 @api_router.post("/students", response_model = StudentData)
-async def post_new_student(new_student_data: StudentData):
-    if check_basic_auth('/students') is not None:
+async def post_new_student(request: Request, new_student_data: StudentData, connection: db.Connection = Depends(db.get_connection)):
+    if check_basic_auth(request, '/students') is not None:
         return StudentData()
-    # TODO: there's got to be a slicker way to do this
-    new_student = Student(
-        db = app.db,
-        id = None,
-        name = new_student_data.name,
-        birthdate = new_student_data.birthdate,
-        grade_level = new_student_data.grade_level
-    )
-    app.user.add_student(db = app.db, student = new_student)
-    return new_student
+    def add_new_student() -> Student:
+        with db.transaction(connection):
+            # TODO: there's got to be a slicker way to do this
+            new_student = Student(
+                db = connection,
+                id = None,
+                name = new_student_data.name,
+                birthdate = new_student_data.birthdate,
+                grade_level = new_student_data.grade_level
+            )
+            request.state.user.add_student(db = connection, student = new_student)
+        return new_student
+    return await db.run(add_new_student)
 
 @api_router.delete("/students/{student_id}")
-async def delete_student(student_id: int):
-    if check_basic_auth('/students') is not None:
+async def delete_student(request: Request, student_id: int, connection: db.Connection = Depends(db.get_connection)):
+    if check_basic_auth(request, '/students') is not None:
         return None
-    app.user.remove_student(db = app.db, student_id = student_id)
+    await db.run(request.state.user.remove_student, db = connection, student_id = student_id)
+
+
+@api_router.post("/import/students")
+async def students_import(request: Request, format: Optional[str] = None):
+    auth_check = check_basic_auth(request, '/students')
+    if auth_check is not None:
+        return auth_check
+    return await import_records(request, request.state.user.import_students, format)
+
+
+@api_router.get("/export/students")
+async def students_export(request: Request, format: Optional[str] = None):
+    auth_check = check_basic_auth(request, '/students')
+    if auth_check is not None:
+        return auth_check
+    return export_records(request.state.user.export_students, STUDENT_EXPORT_FIELDS, format, 'students')
 
 
 @api_router.get("/teach")
 async def programs_teach_get(request: Request):
-    auth_check = check_basic_auth('/teach')
+    auth_check = check_basic_auth(request, '/teach')
     if auth_check is not None:
         return auth_check
     template_args = build_base_html_args(request)
     return templates.TemplateResponse("teach.html", template_args)
 
 
-def programs_get(request: Request):
+async def programs_get(request: Request, connection: db.Connection):
     template_args = build_base_html_args(request)
     filtertable = None
-    if app.user is not None:
-        filtertable = app.user.load_programs_table(db = app.db)
+    if request.state.user is not None:
+        # Masking, facets, paging and turning the page into rows are all pandas work, so none of it runs on the loop
+        def load_programs_page():
+            filtertable = request.state.user.load_programs_table(db = connection)
+            filtertable.select(get_query_lists(request))
+            filtertable.apply()
+            build_page_args(request, filtertable, template_args)
+            return filtertable
+        filtertable = await db.run(load_programs_page)
     template_args['filtertable'] = filtertable
     return templates.TemplateResponse("programs.html", template_args)
 
 
 @api_router.get("/programs")
-async def programs_get_all(request: Request):
-    auth_check = check_basic_auth('/programs')
+async def programs_get_all(request: Request, connection: db.Connection = Depends(db.get_connection)):
+    auth_check = check_basic_auth(request, '/programs')
     if auth_check is not None:
         return auth_check
-    return programs_get(request)
+    not_modified = await check_not_modified(request, connection, PROGRAMS_PAGE_TABLES)
+    if not_modified is not None:
+        return not_modified
+    response = await programs_get(request, connection)
+    response.headers.update(get_etag_headers(request.state.etag))
+    return response
+
+
+@api_router.get("/programs/rows")
+async def programs_get_rows(request: Request, connection: db.Connection = Depends(db.get_connection)):
+    auth_check = check_basic_auth(request, '/programs')
+    if auth_check is not None:
+        return auth_check
+    return await request.state.user.load_programs_page_async(connection, get_query_lists(request), **get_page_args(request))
+
+
+async def load_program_or_404(connection: db.Connection, program_id: int) -> Program:
+    # A program can be deleted between the permission check and its load, e.g. from another tab
+    program = await db.run(load_program, db = connection, program_id = program_id)
+    if program is None:
+        raise HTTPException(status_code=404, detail=f"Program id={program_id} not found")
+    return program
 
 
-def programs_get_one(request: Request, program_id: int, level_id = None):
+async def programs_get_one(request: Request, connection: db.Connection, program_id: int, level_id = None):
     template_args = build_base_html_args(request)
     current_program = None
     current_level = None
-    sorted_levels = None
-    if app.user is not None:
-        if program_id not in app.user.program_ids:
+    if request.state.user is not None:
+        if program_id not in request.state.user.program_ids:
             return RedirectResponse(url='/programs')
-        current_program = Program(db = app.db, id = program_id)
-        current_program.load_levels(db = app.db)
-        sorted_levels = [None] * len(current_program.levels)
-        for level in current_program.levels.values():
-            sorted_levels[level.list_index-1] = level
+        current_program = await load_program_or_404(connection, program_id)
+        await db.run(current_program.load_levels, db = connection)
     if current_program is not None and level_id is not None:
         current_level = current_program.levels.get(level_id)
     template_args['current_program'] = current_program
     template_args['current_level']  = current_level
-    template_args['sorted_levels']  = sorted_levels
     return templates.TemplateResponse("program.html", template_args)
 
 
 @api_router.get("/programs/{program_id}")
-async def programs_get_one_nolevel(request: Request, program_id: int):
-    auth_check = check_basic_auth('/programs')
+async def programs_get_one_nolevel(request: Request, program_id: int, connection: db.Connection = Depends(db.get_connection)):
+    auth_check = check_basic_auth(request, '/programs')
     if auth_check is not None:
         return auth_check
-    return programs_get_one(request, program_id, level_id=None)
+    return await programs_get_one(request, connection, program_id, level_id=None)
 
 
 @api_router.get("/programs/{program_id}/{level_id}")
-async def programs_get_one_withlevel(request: Request, program_id: int, level_id: int):
-    auth_check = check_basic_auth('/programs')
+async def programs_get_one_withlevel(request: Request, program_id: int, level_id: int, connection: db.Connection = Depends(db.get_connection)):
+    auth_check = check_basic_auth(request, '/programs')
     if auth_check is not None:
         return auth_check
-    return programs_get_one(request, program_id, level_id)
+    return await programs_get_one(request, connection, program_id, level_id)
 
 
 @api_router.post("/programs")
-async def programs_post_new(request: Request, title: str = Form(), from_grade: int = Form(), to_grade: int = Form()):
-    auth_check = check_basic_auth('/programs')
+async def programs_post_new(request: Request, title: str = Form(), from_grade: int = Form(), to_grade: int = Form(), connection: db.Connection = Depends(db.get_connection)):
+    auth_check = check_basic_auth(request, '/programs')
     if auth_check is not None:
         return auth_check
     form = await request.form()
-    new_program = Program(
-        db = app.db,
-        title = title,
-        grade_range = (GradeLevel(from_grade), GradeLevel(to_grade)),
-        tags = form.get('tags')
-    )
-    app.user.add_program(db = app.db, program_id = new_program.id)
-    return await programs_get_one(request, new_program.id, level_id=None)
+    def add_new_program() -> Program:
+        with db.transaction(connection):
+            new_program = Program(
+                db = connection,
+                title = title,
+                grade_range = (GradeLevel(from_grade), GradeLevel(to_grade)),
+                tags = form.get('tags')
+            )
+            request.state.user.add_program(db = connection, program_id = new_program.id)
+        return new_program
+    new_program = await db.run(add_new_program)
+    return await programs_get_one(request, connection, new_program.id, level_id=None)
 
 
 @api_router.post("/programs/{program_id}")
-async def program_post_update(request: Request, program_id: int):
-    auth_check = check_basic_auth('/programs')
+async def program_post_update(request: Request, program_id: int, connection: db.Connection = Depends(db.get_connection)):
+    auth_check = check_basic_auth(request, '/programs')
     if auth_check is not None:
         return auth_check
     level_id = None
-    if program_id in app.user.program_ids:
-        program = Program(db = app.db, id = program_id)
+    if program_id in request.state.user.program_ids:
+        program = await load_program_or_404(connection, program_id)
         form = await request.form()
         level_title = form.get('level_title')
         if level_title is None:
             # Updating a program
-            program.update_basic(
-                db = app.db,
+            await db.run(program.update_basic,
+                db = connection,
                 title = form.get('program_title'),
                 tags = form.get('program_tags'),
                 from_grade = form.get('program_from_grade'),
@@ -313,60 +461,125 @@ async def program_post_update(request: Request, program_id: int):
             )
         else:
             # New level
-            new_level = Level(
-                db = app.db,
-                title = level_title,
-                description = form.get('level_desc'),
-                list_index = program.get_next_level_index()
-            )
-            program.add_level(db = app.db, level_id = new_level.id)
+            def add_new_level() -> Level:
+                with db.transaction(connection):
+                    new_level = Level(
+                        db = connection,
+                        title = level_title,
+                        description = form.get('level_desc'),
+                        list_index = program.get_next_level_index()
+                    )
+                    program.add_level(db = connection, level_id = new_level.id)
+                return new_level
+            new_level = await db.run(add_new_level)
             level_id = new_level.id
-    return await programs_get_one(request, program_id, level_id=level_id)
+    return await programs_get_one(request, connection, program_id, level_id=level_id)
 
 
 @api_router.post("/programs/{program_id}/{level_id}")
-async def level_post_update(request: Request, program_id: int, level_id: int):
-    auth_check = check_basic_auth('/programs')
+async def level_post_update(request: Request, program_id: int, level_id: int, connection: db.Connection = Depends(db.get_connection)):
+    auth_check = check_basic_auth(request, '/programs')
     if auth_check is not None:
         return auth_check
-    if program_id in app.user.program_ids:
-        program = Program(db = app.db, id = program_id)
-        program.load_levels(db = app.db)
+    if program_id in request.state.user.program_ids:
+        program = await load_program_or_404(connection, program_id)
+        await db.run(program.load_levels, db = connection)
         level = program.levels.get(level_id)
         if level is not None:
             form = await request.form()
-            level.update_basic(
-                db = app.db,
-                title = form.get('level_title'),
-                description = form.get('level_desc')
-            )
-            level_list_index = form.get('level_list_index')
-            if level_list_index is not None:
-                program.move_level_index(db = app.db, level_id = level_id, new_list_index = int(level_list_index))
-    return await programs_get_one(request, program_id, level_id)
+            def update_level():
+                with db.transaction(connection):
+                    level.update_basic(
+                        db = connection,
+                        title = form.get('level_title'),
+                        description = form.get('level_desc')
+                    )
+                    level_list_index = form.get('level_list_index')
+                    if level_list_index is not None:
+                        program.move_level_index(db = connection, level_id = level_id, new_list_index = int(level_list_index))
+            await db.run(update_level)
+    return await programs_get_one(request, connection, program_id, level_id)
+
+
+@api_router.put("/programs/{program_id}/levels")
+async def levels_put_order(request: Request, program_id: int, level_ids: List[int] = Body(), connection: db.Connection = Depends(db.get_connection)):
+    auth_check = check_basic_auth(request, '/programs')
+    if auth_check is not None:
+        return auth_check
+    if program_id not in request.state.user.program_ids:
+        raise HTTPException(status_code=403, detail=f"User does not have permission for program id={program_id}")
+    program = await load_program_or_404(connection, program_id)
+    await db.run(program.load_levels, db = connection)
+    if not await db.run(program.set_level_order, db = connection, level_ids = level_ids):
+        raise HTTPException(status_code=400, detail=f"Level ids must list every level of program id={program_id} exactly once.")
+    await db.run(program.load_levels, db = connection)
+    return [level.dict() for level in program.ordered_levels]
 
 
 @api_router.delete("/programs/{program_id}")
-async def program_delete(request: Request, program_id: int):
-    auth_check = check_basic_auth('/programs')
+async def program_delete(request: Request, program_id: int, connection: db.Connection = Depends(db.get_connection)):
+    auth_check = check_basic_auth(request, '/programs')
     if auth_check is not None:
         return auth_check
-    app.user.remove_program(db = app.db, program_id = program_id)
+    await db.run(request.state.user.remove_program, db = connection, program_id = program_id)
 
 
 @api_router.delete("/programs/{program_id}/{level_id}")
-async def level_delete(request: Request, program_id: int, level_id: int):
-    auth_check = check_basic_auth('/programs')
+async def level_delete(request: Request, program_id: int, level_id: int, connection: db.Connection = Depends(db.get_connection)):
+    auth_check = check_basic_auth(request, '/programs')
+    if auth_check is not None:
+        return auth_check
+    if program_id in request.state.user.program_ids:
+        program = await load_program_or_404(connection, program_id)
+        await db.run(program.remove_level, db = connection, level_id = level_id)
+
+
+@api_router.post("/import/programs")
+async def programs_import(request: Request, format: Optional[str] = None):
+    auth_check = check_basic_auth(request, '/programs')
+    if auth_check is not None:
+        return auth_check
+    return await import_records(request, request.state.user.import_programs, format)
+
+
+@api_router.get("/export/programs")
+async def programs_export(request: Request, format: Optional[str] = None):
+    auth_check = check_basic_auth(request, '/programs')
+    if auth_check is not None:
+        return auth_check
+    return export_records(request.state.user.export_programs, PROGRAM_EXPORT_FIELDS, format, 'programs')
+
+
+@api_router.post("/import/programs/{program_id}/levels")
+async def levels_import(request: Request, program_id: int, format: Optional[str] = None):
+    auth_check = check_basic_auth(request, '/programs')
+    if auth_check is not None:
+        return auth_check
+    if program_id not in request.state.user.program_ids:
+        raise HTTPException(status_code=403, detail=f"User does not have permission for program id={program_id}")
+    def import_levels(db: Any, records: Iterator[dict]) -> int:
+        program = load_program(db = db, program_id = program_id)
+        if program is None:
+            raise HTTPException(status_code=404, detail=f"Program id={program_id} not found")
+        program.load_levels(db = db)
+        return program.import_levels(db = db, records = records)
+    return await import_records(request, import_levels, format)
+
+
+@api_router.get("/export/programs/{program_id}/levels")
+async def levels_export(request: Request, program_id: int, format: Optional[str] = None, connection: db.Connection = Depends(db.get_connection)):
+    auth_check = check_basic_auth(request, '/programs')
     if auth_check is not None:
         return auth_check
-    if program_id in app.user.program_ids:
-        program = Program(db = app.db, id = program_id)
-        program.remove_level(db = app.db, level_id = level_id)
+    if program_id not in request.state.user.program_ids:
+        raise HTTPException(status_code=403, detail=f"User does not have permission for program id={program_id}")
+    program = await load_program_or_404(connection, program_id)
+    return export_records(program.export_levels, LEVEL_EXPORT_FIELDS, format, f'program_{program_id}_levels')
 
 
 @api_router.get("/members")
 async def members_get(request: Request):
-    auth_check = check_basic_auth('/members')
+    auth_check = check_basic_auth(request, '/members')
     if auth_check is not None:
         return auth_check
     template_args = build_base_html_args(request)
@@ -375,57 +588,86 @@ async def members_get(request: Request):
 
 @api_router.get("/database")
 async def database_get(request: Request):
-    auth_check = check_basic_auth('/database')
+    auth_check = check_basic_auth(request, '/database')
     if auth_check is not None:
         return auth_check
     template_args = build_base_html_args(request)
     return templates.TemplateResponse("database.html", template_args)
 
 
-async def schedule_get_all_camps(request: Request, template_args: dict):
-    user_program_titles = app.user.load_program_titles(db = app.db)
-    load_all_users_by_role(db = app.db, role="INSTRUCTOR", users = app.instructors)
-    template_args['filtertable'] = load_camps_table(db = app.db)
+@api_router.get("/database/stats")
+async def database_stats_get(request: Request):
+    auth_check = check_basic_auth(request, '/database')
+    if auth_check is not None:
+        return auth_check
+    return {'statement_cache': app.db.statement_stats.as_dict(), 'identity_map': cache.identity_map.stats()}
+
+
+async def schedule_get_all_camps(request: Request, connection: db.Connection, template_args: dict):
+    user_program_titles = await db.run(request.state.user.load_program_titles, db = connection)
+    instructors = await db.run(load_users_by_role, db = connection, role="INSTRUCTOR")
+    def load_schedule_page():
+        filtertable = load_camps_table(db = connection)
+        filtertable.select(get_query_lists(request))
+        filtertable.apply()
+        build_page_args(request, filtertable, template_args)
+        return filtertable
+    template_args['filtertable'] = await db.run(load_schedule_page)
     template_args['promoted_programs'] = app.promoted_programs
     template_args['user_program_titles'] = user_program_titles
-    template_args['instructors'] = app.instructors
+    template_args['instructors'] = instructors
     return templates.TemplateResponse("schedule.html", template_args)
 
 
 @api_router.get("/schedule")
-async def schedule_get(request: Request):
-    auth_check = check_basic_auth('/schedule')
+async def schedule_get(request: Request, connection: db.Connection = Depends(db.get_connection)):
+    auth_check = check_basic_auth(request, '/schedule')
     if auth_check is not None:
         return auth_check
+    not_modified = await check_not_modified(request, connection, SCHEDULE_PAGE_TABLES)
+    if not_modified is not None:
+        return not_modified
     template_args = build_base_html_args(request)
-    return await schedule_get_all_camps(request, template_args)
+    response = await schedule_get_all_camps(request, connection, template_args)
+    response.headers.update(get_etag_headers(request.state.etag))
+    return response
+
+
+@api_router.get("/schedule/rows")
+async def schedule_get_rows(request: Request, connection: db.Connection = Depends(db.get_connection)):
+    auth_check = check_basic_auth(request, '/schedule')
+    if auth_check is not None:
+        return auth_check
+    return await load_camps_page_async(connection, get_query_lists(request), **get_page_args(request))
 
 
 @api_router.post("/schedule")
-async def schedule_post_new_camp(request: Request, camp_program_id: int = Form(), camp_instructor_id: int = Form()):
-    auth_check = check_basic_auth('/schedule')
+async def schedule_post_new_camp(request: Request, camp_program_id: int = Form(), camp_instructor_id: int = Form(), connection: db.Connection = Depends(db.get_connection)):
+    auth_check = check_basic_auth(request, '/schedule')
     if auth_check is not None:
         return auth_check
     template_args = build_base_html_args(request)
-    new_camp = Camp(db = app.db, program_id = camp_program_id)
-    new_camp.add_instructor(db = app.db, user_id = camp_instructor_id)
-    return await schedule_get_all_camps(request, template_args)
+    def add_new_camp():
+        with db.transaction(connection):
+            new_camp = Camp(db = connection, program_id = camp_program_id)
+            new_camp.add_instructor(db = connection, user_id = camp_instructor_id)
+    await db.run(add_new_camp)
+    return await schedule_get_all_camps(request, connection, template_args)
 
 
 @api_router.delete("/schedule/{camp_id}")
-async def camp_delete(request: Request, camp_id: int):
-    auth_check = check_basic_auth('/schedule')
+async def camp_delete(request: Request, camp_id: int, connection: db.Connection = Depends(db.get_connection)):
+    auth_check = check_basic_auth(request, '/schedule')
     if auth_check is not None:
         return auth_check
-    load_all_camps(db = app.db, camps = app.camps)
-    camp = app.camps.pop(camp_id)
+    camp = await db.run(load_camp, db = connection, camp_id = camp_id)
     if camp is not None:
-        camp.delete(db = app.db)
+        await db.run(camp.delete, db = connection)
 
 
 @api_router.get("/instructor/{user_id}")
 async def instructor_get_one(request: Request, user_id: int):
-    auth_check = check_basic_auth('/instructor')
+    auth_check = check_basic_auth(request, '/instructor')
     if auth_check is not None:
         return auth_check
     template_args = build_base_html_args(request)
@@ -0,0 +1,23 @@
+-- Drop duplicate link rows so the unique indexes below can be created
+DELETE FROM role_permissions WHERE rowid NOT IN (SELECT MIN(rowid) FROM role_permissions GROUP BY role, endpoint);
+DELETE FROM user_x_roles WHERE rowid NOT IN (SELECT MIN(rowid) FROM user_x_roles GROUP BY user_id, role);
+DELETE FROM user_x_email_addresses WHERE rowid NOT IN (SELECT MIN(rowid) FROM user_x_email_addresses GROUP BY user_id, email_address);
+DELETE FROM user_x_students WHERE rowid NOT IN (SELECT MIN(rowid) FROM user_x_students GROUP BY user_id, student_id);
+DELETE FROM user_x_programs WHERE rowid NOT IN (SELECT MIN(rowid) FROM user_x_programs GROUP BY user_id, program_id);
+DELETE FROM program_x_levels WHERE rowid NOT IN (SELECT MIN(rowid) FROM program_x_levels GROUP BY program_id, level_id);
+DELETE FROM camp_x_instructors WHERE rowid NOT IN (SELECT MIN(rowid) FROM camp_x_instructors GROUP BY camp_id, user_id);
+
+CREATE UNIQUE INDEX IF NOT EXISTS user_google_id ON user (google_id);
+CREATE UNIQUE INDEX IF NOT EXISTS role_permissions_role_endpoint ON role_permissions (role, endpoint);
+CREATE UNIQUE INDEX IF NOT EXISTS user_x_roles_user_role ON user_x_roles (user_id, role);
+CREATE INDEX IF NOT EXISTS user_x_roles_role ON user_x_roles (role);
+CREATE UNIQUE INDEX IF NOT EXISTS user_x_email_addresses_user_email ON user_x_email_addresses (user_id, email_address);
+CREATE UNIQUE INDEX IF NOT EXISTS user_x_students_user_student ON user_x_students (user_id, student_id);
+CREATE INDEX IF NOT EXISTS user_x_students_student ON user_x_students (student_id);
+CREATE UNIQUE INDEX IF NOT EXISTS user_x_programs_user_program ON user_x_programs (user_id, program_id);
+CREATE INDEX IF NOT EXISTS user_x_programs_program ON user_x_programs (program_id);
+CREATE UNIQUE INDEX IF NOT EXISTS program_x_levels_program_level ON program_x_levels (program_id, level_id);
+CREATE INDEX IF NOT EXISTS program_x_levels_level ON program_x_levels (level_id);
+CREATE INDEX IF NOT EXISTS camp_program ON camp (program_id);
+CREATE UNIQUE INDEX IF NOT EXISTS camp_x_instructors_camp_user ON camp_x_instructors (camp_id, user_id);
+CREATE INDEX IF NOT EXISTS camp_x_instructors_user ON camp_x_instructors (user_id);
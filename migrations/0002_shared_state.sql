@@ -0,0 +1,14 @@
+-- Sessions and cache invalidations shared between worker processes
+CREATE TABLE IF NOT EXISTS session (
+	id TEXT PRIMARY KEY,
+	user_id INTEGER NOT NULL,
+	last_seen REAL NOT NULL,
+	FOREIGN KEY (user_id) REFERENCES user(id)
+);
+CREATE INDEX IF NOT EXISTS session_last_seen ON session (last_seen);
+
+CREATE TABLE IF NOT EXISTS cache_invalidation (
+	seq INTEGER PRIMARY KEY AUTOINCREMENT,
+	cache_key TEXT NOT NULL,
+	source INTEGER NOT NULL
+);
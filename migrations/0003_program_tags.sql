@@ -0,0 +1,19 @@
+-- One row per program tag, instead of the free-text program.tags string
+CREATE TABLE IF NOT EXISTS program_x_tags (
+	program_id INTEGER NOT NULL,
+	tag TEXT NOT NULL,
+	FOREIGN KEY (program_id) REFERENCES program(id)
+);
+CREATE UNIQUE INDEX IF NOT EXISTS program_x_tags_program_tag ON program_x_tags (program_id, tag);
+CREATE INDEX IF NOT EXISTS program_x_tags_tag ON program_x_tags (tag);
+
+-- Split the existing comma separated tags the same way Program does
+WITH RECURSIVE split_tags(program_id, tag, rest) AS (
+	SELECT id, '', lower(COALESCE(tags, '')) || ',' FROM program
+	UNION ALL
+	SELECT program_id, trim(substr(rest, 1, instr(rest, ',') - 1)), substr(rest, instr(rest, ',') + 1)
+		FROM split_tags
+		WHERE rest <> ''
+)
+INSERT OR IGNORE INTO program_x_tags (program_id, tag)
+	SELECT program_id, tag FROM split_tags WHERE tag <> '';
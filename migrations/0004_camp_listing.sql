@@ -0,0 +1,17 @@
+-- The schedule's camp listing, kept up to date on writes instead of joined on every read
+CREATE TABLE IF NOT EXISTS camp_listing (
+	id INTEGER PRIMARY KEY,
+	program_id INTEGER NOT NULL,
+	title TEXT,
+	tags TEXT,
+	primary_instructor_id INTEGER NOT NULL,
+	primary_instructor TEXT,
+	FOREIGN KEY (id) REFERENCES camp(id)
+);
+CREATE INDEX IF NOT EXISTS camp_listing_program ON camp_listing (program_id);
+CREATE INDEX IF NOT EXISTS camp_listing_primary_instructor ON camp_listing (primary_instructor_id);
+
+INSERT OR REPLACE INTO camp_listing (id, program_id, title, tags, primary_instructor_id, primary_instructor)
+	SELECT t1.id, t1.program_id, t2.title, t2.tags, t4.id, t4.full_name
+		FROM camp as t1, program as t2, camp_x_instructors as t3, user as t4
+		WHERE t1.program_id = t2.id and t1.id = t3.camp_id and t3.is_primary and t3.user_id = t4.id;
@@ -0,0 +1,5 @@
+-- Secrets every worker process must agree on, e.g. the session cookie signing key, generated once by whichever starts first
+CREATE TABLE IF NOT EXISTS app_secret (
+	name TEXT PRIMARY KEY,
+	value TEXT NOT NULL
+);
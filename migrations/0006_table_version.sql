@@ -0,0 +1,5 @@
+-- A change counter per table, bumped in the same transaction as every write to it, so ETags agree across worker processes
+CREATE TABLE IF NOT EXISTS table_version (
+	table_name TEXT PRIMARY KEY,
+	version INTEGER NOT NULL
+);
@@ -1,7 +1,13 @@
+import json
 from enum import Enum
 from pydantic import BaseModel
-from typing import Dict, List, Optional, Any
-from db import execute_read, execute_write
+from typing import Dict, List, Optional, Any, Iterable, Iterator, Mapping, Tuple, TYPE_CHECKING
+from db import execute_read, execute_write, execute_many, execute_inserts, iterate_read, transaction
+from cache import identity_map, invalidate
+from bulk import chunked, parse_records
+
+if TYPE_CHECKING:
+    from filtertable import TagIndex
 
 
 class GradeLevel(Enum):
@@ -25,6 +31,40 @@ class GradeLevel(Enum):
         return str(self.value)
 
 
+# Display labels indexed by GradeLevel value, so whole columns of grades can be formatted with one lookup
+GRADE_LEVEL_LABELS = tuple(grade_level.html_display() for grade_level in GradeLevel)
+
+TAG_INDEX_KEY = ('TagIndex',)
+IMPORT_CHUNK_SIZE = 1000
+PROGRAM_EXPORT_FIELDS = ('id', 'title', 'from_grade', 'to_grade', 'tags', 'description')
+LEVEL_EXPORT_FIELDS = ('id', 'title', 'description', 'list_index')
+
+
+def parse_tags(tags: Optional[str]) -> List[str]:
+    # Comma separated, case-insensitive, each tag once: "Robotics, python" and "python,robotics" are the same tags
+    parsed_tags = []
+    for tag in (tags or '').lower().split(','):
+        tag = tag.strip()
+        if tag and tag not in parsed_tags:
+            parsed_tags.append(tag)
+    return parsed_tags
+
+
+def parse_program_record(record: Mapping[str, Any]) -> Tuple[str, int, int, str, str]:
+    # An imported row as (title, from_grade, to_grade, tags, description), with the tags normalized as in Program
+    if not record.get('title'):
+        raise ValueError('title is required')
+    from_grade = GradeLevel(int(record.get('from_grade'))).value
+    to_grade = GradeLevel(int(record.get('to_grade'))).value
+    return (record['title'], from_grade, to_grade, ', '.join(parse_tags(record.get('tags'))), record.get('description') or '')
+
+
+def parse_level_record(record: Mapping[str, Any]) -> Tuple[str, str]:
+    if not record.get('title'):
+        raise ValueError('title is required')
+    return (record['title'], record.get('description') or '')
+
+
 class Level(BaseModel):
     id: Optional[int]
     title: Optional[str]
@@ -32,26 +72,29 @@ class Level(BaseModel):
     list_index: Optional[int] = 0
 
     def _load(self, db: Any) -> bool:
-        select_stmt = f'''
+        select_stmt = '''
             SELECT *
                 FROM level
-                WHERE id = {self.id}
+                WHERE id = ?
         '''
-        result = execute_read(db, select_stmt)
+        result = execute_read(db, select_stmt, (self.id,))
         if result is None:
             return False;
-        row = result[0] # should only be one
+        self._load_basic(result[0]) # should only be one
+        return True
+
+    def _load_basic(self, row: Any):
+        self.id = row['id']
         self.title = row['title']
         self.description = row['description']
         self.list_index = row['list_index']
-        return True
 
     def _create(self, db: Any):
-        insert_stmt = f'''
+        insert_stmt = '''
             INSERT INTO level (title, description, list_index)
-                VALUES ("{self.title}", "{self.description}", {self.list_index});
+                VALUES (?, ?, ?);
         '''
-        self.id = execute_write(db, insert_stmt)
+        self.id = execute_write(db, insert_stmt, (self.title, self.description, self.list_index))
 
     def __init__(self, db: Any, **data):
         super().__init__(**data)
@@ -71,26 +114,39 @@ class Level(BaseModel):
             self.description = description
         if list_index is not None:
             self.list_index = list_index
-        update_stmt = f'''
+        update_stmt = '''
             UPDATE level
-                SET title="{self.title}",
-                    description="{self.description}",
-                    list_index={self.list_index}
-                WHERE id = {self.id};
+                SET title=?,
+                    description=?,
+                    list_index=?
+                WHERE id = ?;
         '''
-        execute_write(db, update_stmt)
+        execute_write(db, update_stmt, (self.title, self.description, self.list_index, self.id))
+        invalidate(db, (Level, self.id))
 
     def delete(self, db: Any):
-        delete_stmt = f'''
-            DELETE FROM program_x_levels
-                WHERE level_id = {self.id};
-        '''
-        execute_write(db, delete_stmt)
-        delete_stmt = f'''
-            DELETE FROM level
-                WHERE id = {self.id};
-        '''
-        execute_write(db, delete_stmt)
+        with transaction(db):
+            delete_stmt = '''
+                DELETE FROM program_x_levels
+                    WHERE level_id = ?;
+            '''
+            execute_write(db, delete_stmt, (self.id,))
+            delete_stmt = '''
+                DELETE FROM level
+                    WHERE id = ?;
+            '''
+            execute_write(db, delete_stmt, (self.id,))
+            invalidate(db, (Level, self.id))
+
+
+def load_level(db: Any, level_id: int) -> Optional[Level]:
+    level = identity_map.get((Level, level_id))
+    if level is None:
+        level = Level.construct(id = level_id)
+        if not level._load(db = db):
+            return None
+        identity_map.put((Level, level_id), level)
+    return level
 
 
 class Program(BaseModel):
@@ -102,12 +158,12 @@ class Program(BaseModel):
     levels: Optional[Dict[int, Level]] = {}
 
     def _load(self, db: Any) -> bool:
-        select_stmt = f'''
+        select_stmt = '''
             SELECT *
                 FROM program
-                WHERE id = {self.id}
+                WHERE id = ?
         '''
-        result = execute_read(db, select_stmt)
+        result = execute_read(db, select_stmt, (self.id,))
         if result is None:
             return False;
         row = result[0] # should only be one
@@ -116,25 +172,41 @@ class Program(BaseModel):
         self.tags = row['tags']
         self.description = row['description']
 
-        select_stmt = f'''
+        select_stmt = '''
             SELECT level_id
                 FROM program_x_levels
-                WHERE program_id = {self.id}
+                WHERE program_id = ?
         '''
-        result = execute_read(db, select_stmt)
+        result = execute_read(db, select_stmt, (self.id,))
         self.levels.clear()
         if result is not None:
             for row in result:
                 self.levels[row['level_id']] = None
         return True
 
-    def _create(self, db: Any):
-        self.tags = self.tags.lower()
-        insert_stmt = f'''
-            INSERT INTO program (title, from_grade, to_grade, tags, description)
-                VALUES ("{self.title}", {self.grade_range[0].value}, {self.grade_range[1].value}, "{self.tags}", "{self.description}");
+    def _save_tags(self, db: Any):
+        tags = parse_tags(self.tags)
+        delete_stmt = '''
+            DELETE FROM program_x_tags
+                WHERE program_id = ?;
+        '''
+        execute_write(db, delete_stmt, (self.id,))
+        insert_stmt = '''
+            INSERT INTO program_x_tags (program_id, tag)
+                SELECT ?, value FROM json_each(?);
         '''
-        self.id = execute_write(db, insert_stmt)
+        execute_write(db, insert_stmt, (self.id, json.dumps(tags)))
+        invalidate(db, TAG_INDEX_KEY)
+
+    def _create(self, db: Any):
+        self.tags = ', '.join(parse_tags(self.tags))
+        with transaction(db):
+            insert_stmt = '''
+                INSERT INTO program (title, from_grade, to_grade, tags, description)
+                    VALUES (?, ?, ?, ?, ?);
+            '''
+            self.id = execute_write(db, insert_stmt, (self.title, self.grade_range[0].value, self.grade_range[1].value, self.tags, self.description))
+            self._save_tags(db = db)
 
     def __init__(self, db: Any, **data):
         super().__init__(**data)
@@ -167,74 +239,221 @@ class Program(BaseModel):
             else:
                 self.grade_range[1] = to_grade
         if tags is not None:
-            self.tags = tags.lower()
+            self.tags = ', '.join(parse_tags(tags))
         if description is not None:
             self.description = description
-        update_stmt = f'''
-            UPDATE program
-                SET title="{self.title}",
-                    from_grade={self.grade_range[0].value},
-                    to_grade={self.grade_range[1].value},
-                    tags="{self.tags}",
-                    description="{self.description}"
-                WHERE id = {self.id};
-        '''
-        execute_write(db, update_stmt)
+        with transaction(db):
+            update_stmt = '''
+                UPDATE program
+                    SET title=?,
+                        from_grade=?,
+                        to_grade=?,
+                        tags=?,
+                        description=?
+                    WHERE id = ?;
+            '''
+            execute_write(db, update_stmt, (self.title, self.grade_range[0].value, self.grade_range[1].value, self.tags, self.description, self.id))
+            if tags is not None:
+                self._save_tags(db = db)
+            update_stmt = '''
+                UPDATE camp_listing
+                    SET title=?,
+                        tags=?
+                    WHERE program_id = ?;
+            '''
+            execute_write(db, update_stmt, (self.title, self.tags, self.id))
+            invalidate(db, (Program, self.id))
 
     def delete(self, db: Any):
-        # Levels are not shared across programs, so they are safe to delete when we delete the program
-        delete_stmt = f'''
-            DELETE FROM user_x_programs
-                WHERE program_id = {self.id};
-        '''
-        execute_write(db, delete_stmt)
-        delete_stmt = f'''
-            DELETE FROM program_x_levels
-                WHERE program_id = {self.id};
-        '''
-        execute_write(db, delete_stmt)
-        delete_stmt = f'''
-            DELETE FROM program
-                WHERE id = {self.id};
-        '''
-        execute_write(db, delete_stmt)
+        with transaction(db):
+            delete_stmt = '''
+                DELETE FROM user_x_programs
+                    WHERE program_id = ?;
+            '''
+            execute_write(db, delete_stmt, (self.id,))
+            # Levels are not shared across programs, so they are safe to delete when we delete the program
+            delete_stmt = '''
+                DELETE FROM level
+                    WHERE id IN (SELECT level_id FROM program_x_levels WHERE program_id = ?);
+            '''
+            execute_write(db, delete_stmt, (self.id,))
+            delete_stmt = '''
+                DELETE FROM program_x_levels
+                    WHERE program_id = ?;
+            '''
+            execute_write(db, delete_stmt, (self.id,))
+            delete_stmt = '''
+                DELETE FROM program_x_tags
+                    WHERE program_id = ?;
+            '''
+            execute_write(db, delete_stmt, (self.id,))
+            delete_stmt = '''
+                DELETE FROM camp_listing
+                    WHERE program_id = ?;
+            '''
+            execute_write(db, delete_stmt, (self.id,))
+            delete_stmt = '''
+                DELETE FROM program
+                    WHERE id = ?;
+            '''
+            execute_write(db, delete_stmt, (self.id,))
+            invalidate(db, (Program, self.id), TAG_INDEX_KEY, *[(Level, level_id) for level_id in self.levels.keys()])
 
     def load_levels(self, db: Any):
-        for level_id in self.levels.keys():
-            self.levels[level_id] = Level(db = db, id = level_id)
+        if len(self.levels) > 0 and None not in self.levels.values():
+            return # already loaded - any level change would have evicted this program
+        select_stmt = '''
+            SELECT t2.*
+                FROM program_x_levels as t1, level as t2
+                WHERE t1.program_id = ? and t1.level_id = t2.id
+                ORDER BY t2.list_index
+        '''
+        result = execute_read(db, select_stmt, (self.id,))
+        self.levels.clear()
+        if result is not None:
+            for row in result:
+                level = Level.construct()
+                level._load_basic(row)
+                self.levels[level.id] = level
+                identity_map.put((Level, level.id), level)
+                identity_map.add_dependency((Level, level.id), (Program, self.id))
+
+    @property
+    def ordered_levels(self) -> List[Level]:
+        return sorted(self.levels.values(), key=lambda level: level.list_index)
 
     def add_level(self, db: Any, level_id: int):
         self.levels[level_id] = None
-        insert_stmt = f'''
+        insert_stmt = '''
             INSERT INTO program_x_levels (program_id, level_id)
-                VALUES ({self.id}, "{level_id}");
+                VALUES (?, ?);
+        '''
+        execute_write(db, insert_stmt, (self.id, level_id))
+        invalidate(db, (Program, self.id))
+
+    def _reset_levels(self, db: Any):
+        # list_index values were shifted in SQL, so evict the cached levels and reload them on next use
+        invalidate(db, (Program, self.id), *[(Level, level_id) for level_id in self.levels.keys()])
+        for level_id in self.levels.keys():
+            self.levels[level_id] = None
+
+    def _get_level_index(self, db: Any, level_id: int) -> Optional[int]:
+        select_stmt = '''
+            SELECT t2.list_index
+                FROM program_x_levels as t1, level as t2
+                WHERE t1.program_id = ? and t1.level_id = ? and t1.level_id = t2.id
         '''
-        execute_write(db, insert_stmt)
+        result = execute_read(db, select_stmt, (self.id, level_id))
+        if result is None:
+            return None
+        return result[0]['list_index']
 
     def remove_level(self, db: Any, level_id: int):
-        self.load_levels(db = db)
-        del_level = self.levels.pop(level_id)
-        if del_level is not None:
-            for level in self.levels.values():
-                if level.list_index > del_level.list_index:
-                    level.update_basic(db = db, list_index = level.list_index - 1)
-            del_level.delete(db = db)
+        with transaction(db):
+            del_list_index = self._get_level_index(db = db, level_id = level_id)
+            if del_list_index is not None:
+                Level.construct(id = level_id).delete(db = db)
+                update_stmt = '''
+                    UPDATE level
+                        SET list_index = list_index - 1
+                        WHERE id IN (SELECT level_id FROM program_x_levels WHERE program_id = ?)
+                            and list_index > ?
+                '''
+                execute_write(db, update_stmt, (self.id, del_list_index))
+                self.levels.pop(level_id, None)
+                self._reset_levels(db = db)
 
     def get_next_level_index(self):
         return len(self.levels)+1
 
     def move_level_index(self, db: Any, level_id: int, new_list_index: int):
-        self.load_levels(db = db)
-        move_level = self.levels[level_id]
-        if move_level is not None and new_list_index != move_level.list_index:
-            for level in self.levels.values():
-                if new_list_index <= level.list_index < move_level.list_index:
-                    level.update_basic(db = db, list_index = level.list_index + 1)
-                elif move_level.list_index < level.list_index <= new_list_index:
-                    level.update_basic(db = db, list_index = level.list_index - 1)
-            move_level.update_basic(db = db, list_index = new_list_index)
+        with transaction(db):
+            old_list_index = self._get_level_index(db = db, level_id = level_id)
+            new_list_index = max(1, min(new_list_index, len(self.levels)))
+            if old_list_index is not None and new_list_index != old_list_index:
+                # Shift every level between the old and new positions by one, and drop the moved level into place
+                update_stmt = '''
+                    UPDATE level
+                        SET list_index = CASE WHEN id = ? THEN ? ELSE list_index + ? END
+                        WHERE id IN (SELECT level_id FROM program_x_levels WHERE program_id = ?)
+                            and list_index BETWEEN ? AND ?
+                '''
+                shift = 1 if new_list_index < old_list_index else -1
+                execute_write(db, update_stmt, (level_id, new_list_index, shift, self.id,
+                    min(old_list_index, new_list_index), max(old_list_index, new_list_index)))
+                self._reset_levels(db = db)
 
+    def set_level_order(self, db: Any, level_ids: List[int]) -> bool:
+        if sorted(level_ids) != sorted(self.levels.keys()):
+            return False
+        with transaction(db):
+            update_stmt = '''
+                UPDATE level
+                    SET list_index = (SELECT key + 1 FROM json_each(?) WHERE value = level.id)
+                    WHERE id IN (SELECT level_id FROM program_x_levels WHERE program_id = ?)
+            '''
+            execute_write(db, update_stmt, (json.dumps(level_ids), self.id))
+            self._reset_levels(db = db)
+        return True
 
+    def import_levels(self, db: Any, records: Iterable[Mapping[str, Any]], chunk_size: int = IMPORT_CHUNK_SIZE) -> int:
+        # Appends every row as a new level, in file order, with one executemany per chunk for their links
+        insert_stmt = '''
+            INSERT INTO level (title, description, list_index)
+                VALUES (?, ?, ?);
+        '''
+        link_stmt = '''
+            INSERT INTO program_x_levels (program_id, level_id)
+                VALUES (?, ?);
+        '''
+        level_ids = []
+        with transaction(db):
+            list_index = self.get_next_level_index()
+            for chunk in chunked(parse_records(records, parse_level_record), chunk_size):
+                rows = [(title, description, list_index + row_index) for row_index, (title, description) in enumerate(chunk)]
+                list_index += len(rows)
+                chunk_ids = execute_inserts(db, insert_stmt, rows)
+                execute_many(db, link_stmt, [(self.id, level_id) for level_id in chunk_ids])
+                level_ids.extend(chunk_ids)
+            invalidate(db, (Program, self.id))
+        for level_id in level_ids:
+            self.levels[level_id] = None
+        return len(level_ids)
 
+    def export_levels(self, db: Any) -> Iterator[Any]:
+        select_stmt = '''
+            SELECT t2.id, t2.title, t2.description, t2.list_index
+                FROM program_x_levels as t1, level as t2
+                WHERE t1.program_id = ? and t1.level_id = t2.id
+                ORDER BY t2.list_index
+        '''
+        return iterate_read(db, select_stmt, (self.id,))
 
 
+def load_program(db: Any, program_id: int) -> Optional[Program]:
+    program = identity_map.get((Program, program_id))
+    if program is None:
+        program = Program.construct(id = program_id)
+        if not program._load(db = db):
+            return None
+        identity_map.put((Program, program_id), program)
+    return program
+
+
+def load_tag_index(db: Any) -> 'TagIndex':
+    # Inverted index from each tag to the ids of the programs that carry it, evicted whenever any program's tags change
+    tag_index = identity_map.get(TAG_INDEX_KEY)
+    if tag_index is None:
+        from filtertable import TagIndex
+        select_stmt = '''
+            SELECT tag, program_id
+                FROM program_x_tags
+        '''
+        result = execute_read(db, select_stmt)
+        program_ids = {}
+        if result is not None:
+            for row in result:
+                program_ids.setdefault(row['tag'], set()).add(row['program_id'])
+        tag_index = TagIndex((tag, frozenset(ids)) for tag, ids in program_ids.items())
+        identity_map.put(TAG_INDEX_KEY, tag_index)
+    return tag_index
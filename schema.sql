@@ -88,6 +88,13 @@ create table program_x_levels (
 	FOREIGN KEY (level_id) REFERENCES level(id)
 );
 
+DROP TABLE IF EXISTS program_x_tags;
+create table program_x_tags (
+	program_id INTEGER NOT NULL,
+	tag TEXT NOT NULL,
+	FOREIGN KEY (program_id) REFERENCES program(id)
+);
+
 DROP TABLE IF EXISTS camp;
 create table camp (
 	id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -103,3 +110,64 @@ create table camp_x_instructors (
 	FOREIGN KEY (camp_id) REFERENCES camp(id),
 	FOREIGN KEY (user_id) REFERENCES user(id)
 );
+
+DROP TABLE IF EXISTS camp_listing;
+create table camp_listing (
+	id INTEGER PRIMARY KEY,
+	program_id INTEGER NOT NULL,
+	title TEXT,
+	tags TEXT,
+	primary_instructor_id INTEGER NOT NULL,
+	primary_instructor TEXT,
+	FOREIGN KEY (id) REFERENCES camp(id)
+);
+
+DROP TABLE IF EXISTS session;
+CREATE TABLE session (
+	id TEXT PRIMARY KEY,
+	user_id INTEGER NOT NULL,
+	last_seen REAL NOT NULL,
+	FOREIGN KEY (user_id) REFERENCES user(id)
+);
+
+DROP TABLE IF EXISTS cache_invalidation;
+CREATE TABLE cache_invalidation (
+	seq INTEGER PRIMARY KEY AUTOINCREMENT,
+	cache_key TEXT NOT NULL,
+	source INTEGER NOT NULL
+);
+
+DROP TABLE IF EXISTS app_secret;
+CREATE TABLE app_secret (
+	name TEXT PRIMARY KEY,
+	value TEXT NOT NULL
+);
+
+DROP TABLE IF EXISTS table_version;
+CREATE TABLE table_version (
+	table_name TEXT PRIMARY KEY,
+	version INTEGER NOT NULL
+);
+
+CREATE UNIQUE INDEX user_google_id ON user (google_id);
+CREATE UNIQUE INDEX role_permissions_role_endpoint ON role_permissions (role, endpoint);
+CREATE UNIQUE INDEX user_x_roles_user_role ON user_x_roles (user_id, role);
+CREATE INDEX user_x_roles_role ON user_x_roles (role);
+CREATE UNIQUE INDEX user_x_email_addresses_user_email ON user_x_email_addresses (user_id, email_address);
+CREATE UNIQUE INDEX user_x_students_user_student ON user_x_students (user_id, student_id);
+CREATE INDEX user_x_students_student ON user_x_students (student_id);
+CREATE UNIQUE INDEX user_x_programs_user_program ON user_x_programs (user_id, program_id);
+CREATE INDEX user_x_programs_program ON user_x_programs (program_id);
+CREATE UNIQUE INDEX program_x_levels_program_level ON program_x_levels (program_id, level_id);
+CREATE INDEX program_x_levels_level ON program_x_levels (level_id);
+CREATE UNIQUE INDEX program_x_tags_program_tag ON program_x_tags (program_id, tag);
+CREATE INDEX program_x_tags_tag ON program_x_tags (tag);
+CREATE INDEX camp_program ON camp (program_id);
+CREATE UNIQUE INDEX camp_x_instructors_camp_user ON camp_x_instructors (camp_id, user_id);
+CREATE INDEX camp_x_instructors_user ON camp_x_instructors (user_id);
+CREATE INDEX camp_listing_program ON camp_listing (program_id);
+CREATE INDEX camp_listing_primary_instructor ON camp_listing (primary_instructor_id);
+CREATE INDEX session_last_seen ON session (last_seen);
+
+-- Keep in step with the newest file in migrations/, so new databases skip straight past them
+PRAGMA user_version = 6;
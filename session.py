@@ -0,0 +1,174 @@
+import os, time, hmac, hashlib, secrets
+from typing import Any, Callable, Optional, Union
+from starlette.requests import HTTPConnection
+from db import ConnectionPool, execute_read, execute_write, transaction, run, connection_async
+from user import User, load_user
+from cache import identity_map, invalidate
+
+
+SESSION_COOKIE_NAME = 'session'
+
+
+class Session:
+    def __init__(self, session_id: str, user: User, last_seen: float):
+        self.id = session_id
+        self.user = user
+        self.last_seen = last_seen
+        self.last_saved = last_seen
+
+
+class SessionStore:
+    # Sessions live in SQLite so every worker process sees them; hydrated sessions are cached in the
+    # identity map, depending on their user, so any change to the user (in any process) evicts them too
+    def __init__(self, secret_key: Union[str, bytes], pool: ConnectionPool,
+            idle_timeout: float = 8 * 60 * 60, save_interval: float = 60, clock: Callable[[], float] = time.time):
+        self.secret_key = secret_key.encode() if isinstance(secret_key, str) else secret_key
+        self.pool = pool
+        self.idle_timeout = idle_timeout
+        self.save_interval = save_interval
+        self.clock = clock
+
+    def _sign(self, session_id: str) -> str:
+        return hmac.new(self.secret_key, session_id.encode(), hashlib.sha256).hexdigest()
+
+    def unsign(self, cookie: Optional[str]) -> Optional[str]:
+        if not cookie or '.' not in cookie:
+            return None
+        session_id, signature = cookie.rsplit('.', 1)
+        if not hmac.compare_digest(signature, self._sign(session_id)):
+            return None
+        return session_id
+
+    def _remember(self, session: Session):
+        identity_map.put((Session, session.id), session, depends_on=[(User, session.user.id)])
+
+    def create(self, user: User, db: Any) -> str:
+        session_id = secrets.token_urlsafe(32)
+        now = self.clock()
+        with transaction(db):
+            delete_stmt = '''
+                DELETE FROM session
+                    WHERE last_seen < ?
+            '''
+            execute_write(db, delete_stmt, (now - self.idle_timeout,))
+            insert_stmt = '''
+                INSERT INTO session (id, user_id, last_seen)
+                    VALUES (?, ?, ?);
+            '''
+            execute_write(db, insert_stmt, (session_id, user.id, now))
+        identity_map.put((User, user.id), user)
+        self._remember(Session(session_id, user, now))
+        return f'{session_id}.{self._sign(session_id)}'
+
+    def get(self, session_id: str) -> Optional[Session]:
+        # Memory only: returns None whenever the database has to be consulted
+        session = identity_map.get((Session, session_id))
+        now = self.clock()
+        if session is None or now - session.last_seen > self.idle_timeout:
+            return None
+        session.last_seen = now
+        if now - session.last_saved >= self.save_interval:
+            return None
+        return session
+
+    def load(self, session_id: str, db: Any) -> Optional[Session]:
+        now = self.clock()
+        session = identity_map.get((Session, session_id))
+        if session is not None and now - session.last_seen > self.idle_timeout:
+            session = None # idle here, but another process may have seen it since
+        if session is None:
+            select_stmt = '''
+                SELECT *
+                    FROM session
+                    WHERE id = ?
+            '''
+            result = execute_read(db, select_stmt, (session_id,))
+            if result is None:
+                return None
+            row = result[0]
+            user = load_user(db = db, user_id = row['user_id'])
+            if user is None:
+                return None
+            session = Session(session_id, user, row['last_seen'])
+        if now - session.last_seen > self.idle_timeout:
+            self.delete(session_id, db = db)
+            return None
+        if now - session.last_saved >= self.save_interval:
+            # Another process may have seen this session more recently, so only ever move last_seen forward
+            update_stmt = '''
+                UPDATE session
+                    SET last_seen = MAX(last_seen, ?)
+                    WHERE id = ?;
+            '''
+            execute_write(db, update_stmt, (now, session_id))
+            session.last_saved = now
+        session.last_seen = now
+        self._remember(session)
+        return session
+
+    def get_user(self, cookie: Optional[str]) -> Optional[User]:
+        session_id = self.unsign(cookie)
+        if session_id is None:
+            return None
+        session = self.get(session_id)
+        if session is None:
+            with self.pool.connection() as connection:
+                session = self.load(session_id, db = connection)
+        return session.user if session is not None else None
+
+    def delete(self, session_id: Optional[str], db: Any):
+        if session_id is None:
+            return
+        delete_stmt = '''
+            DELETE FROM session
+                WHERE id = ?;
+        '''
+        execute_write(db, delete_stmt, (session_id,))
+        invalidate(db, (Session, session_id))
+
+
+class SessionMiddleware:
+    # Plain ASGI middleware that resolves the signed-in user once per request into request.state.user.
+    # Without a store of its own it uses the app's, which may only be opened at startup.
+    def __init__(self, app: Any, sessions: Optional[SessionStore] = None):
+        self.app = app
+        self.sessions = sessions
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] in ('http', 'websocket'):
+            user = None
+            sessions = self.sessions or getattr(scope.get('app'), 'sessions', None)
+            session_id = sessions.unsign(HTTPConnection(scope).cookies.get(SESSION_COOKIE_NAME)) if sessions is not None else None
+            if session_id is not None:
+                session = sessions.get(session_id)
+                if session is None:
+                    async with connection_async(sessions.pool) as connection:
+                        session = await run(sessions.load, session_id, db = connection)
+                if session is not None:
+                    user = session.user
+            scope.setdefault('state', {})['user'] = user
+        await self.app(scope, receive, send)
+
+
+def load_secret_key(pool: ConnectionPool) -> str:
+    # Every worker process must sign cookies with the same key, so the first to start generates it into the database
+    with pool.connection() as connection:
+        insert_stmt = '''
+            INSERT OR IGNORE INTO app_secret (name, value)
+                VALUES ('session', ?);
+        '''
+        execute_write(connection, insert_stmt, (secrets.token_hex(32),))
+        select_stmt = '''
+            SELECT value
+                FROM app_secret
+                WHERE name = 'session'
+        '''
+        return execute_read(connection, select_stmt)[0]['value']
+
+
+def get_session_store(secret_key: Union[str, bytes], pool: ConnectionPool) -> SessionStore:
+    return SessionStore(
+        secret_key,
+        pool=pool,
+        idle_timeout=float(os.environ.get("SESSION_IDLE_TIMEOUT") or 8 * 60 * 60)
+    )
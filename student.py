@@ -1,8 +1,12 @@
-from db import execute_read, execute_write
+from db import execute_read, execute_write, transaction
 from pydantic import BaseModel
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Mapping, Tuple
 from datetime import date
 from program import GradeLevel
+from cache import identity_map, invalidate
+
+
+STUDENT_EXPORT_FIELDS = ('id', 'name', 'birthdate', 'grade_level')
 
 
 class StudentData(BaseModel):
@@ -12,14 +16,25 @@ class StudentData(BaseModel):
     grade_level: Optional[int] = None
 
 
+def parse_student_record(record: Mapping[str, Any]) -> Tuple[str, str, Optional[int]]:
+    # An imported row as (name, birthdate, grade_level); blank CSV cells count as missing, and any id is ignored
+    if not record.get('name'):
+        raise ValueError('name is required')
+    if not record.get('birthdate'):
+        raise ValueError('birthdate is required')
+    grade_level = record.get('grade_level')
+    grade_level = int(grade_level) if grade_level not in (None, '') else None
+    return (str(record['name']), date.fromisoformat(record['birthdate']).strftime('%Y-%m-%d'), grade_level)
+
+
 class Student(StudentData):
     def _load(self, db: Any) -> bool:
-        select_stmt = f'''
+        select_stmt = '''
             SELECT *
                 FROM student
-                WHERE id = {self.id}
+                WHERE id = ?
         '''
-        result = execute_read(db, select_stmt)
+        result = execute_read(db, select_stmt, (self.id,))
         if result is None:
             return False;
         row = result[0] # should only be one
@@ -31,11 +46,11 @@ class Student(StudentData):
 
     def _create(self, db: Any):
         sql_date = self.birthdate.strftime('%Y-%m-%d')
-        insert_stmt = f'''
+        insert_stmt = '''
             INSERT INTO student (name, birthdate, grade_level)
-                VALUES ("{self.name}", "{sql_date}", {self.grade_level});
+                VALUES (?, ?, ?);
         '''
-        self.id = execute_write(db, insert_stmt)
+        self.id = execute_write(db, insert_stmt, (self.name, sql_date, self.grade_level))
 
     def __init__(self, db: Any, **data):
         super().__init__(**data)
@@ -44,26 +59,38 @@ class Student(StudentData):
         elif not self._load(db = db):
             self._create(db = db)
 
-    async def update_basic(self, db: Any):
+    def update_basic(self, db: Any):
         sql_date = self.birthdate.strftime('%Y-%m-%d')
-        update_stmt = f'''
-            UPDATE student
-                SET name="{self.name}", birthdate="{sql_date}",
-                    grade_level={self.grade_level}
-                WHERE id = {self.id};
-        '''
-        execute_write(db, update_stmt)
+        with transaction(db):
+            update_stmt = '''
+                UPDATE student
+                    SET name=?, birthdate=?,
+                        grade_level=?
+                    WHERE id = ?;
+            '''
+            execute_write(db, update_stmt, (self.name, sql_date, self.grade_level, self.id))
+            invalidate(db, (Student, self.id))
 
     def delete(self, db: Any):
-        delete_stmt = f'''
-            DELETE FROM user_x_students
-                WHERE student_id = {self.id};
-        '''
-        execute_write(db, delete_stmt)
-        delete_stmt = f'''
-            DELETE FROM student
-                WHERE id = {self.id};
-        '''
-        execute_write(db, delete_stmt)
+        with transaction(db):
+            delete_stmt = '''
+                DELETE FROM user_x_students
+                    WHERE student_id = ?;
+            '''
+            execute_write(db, delete_stmt, (self.id,))
+            delete_stmt = '''
+                DELETE FROM student
+                    WHERE id = ?;
+            '''
+            execute_write(db, delete_stmt, (self.id,))
+            invalidate(db, (Student, self.id))
 
 
+def load_student(db: Any, student_id: int) -> Optional[Student]:
+    student = identity_map.get((Student, student_id))
+    if student is None:
+        student = Student.construct(id = student_id)
+        if not student._load(db = db):
+            return None
+        identity_map.put((Student, student_id), student)
+    return student
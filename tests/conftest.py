@@ -0,0 +1,18 @@
+import os, pytest, db
+from cache import identity_map
+
+
+@pytest.fixture
+def pool(tmp_path):
+    identity_map.clear()
+    connection_pool = db.ConnectionPool(os.path.join(tmp_path, 'test.db'), max_readers=2)
+    yield connection_pool
+    connection_pool.close()
+    identity_map.clear()
+
+
+@pytest.fixture
+def count_statements():
+    def count(pool: db.ConnectionPool) -> int:
+        return pool.statement_stats.hits + pool.statement_stats.misses
+    return count
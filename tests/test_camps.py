@@ -0,0 +1,70 @@
+import db
+from user import User
+from program import Program, GradeLevel
+from camp import Camp, load_camps_table
+
+
+def create_instructor(connection: db.Connection, google_id: int) -> User:
+    user = User(db = connection, google_id = google_id, given_name = 'Steve', family_name = 'Tester', full_name = f'Steve Tester {google_id}', picture = '')
+    user.add_role(db = connection, role = 'INSTRUCTOR')
+    return user
+
+
+def join_camps(connection: db.Connection) -> list:
+    select_stmt = '''
+        SELECT t1.id, t1.program_id, t2.title, t2.tags, t4.id as primary_instructor_id, t4.full_name as primary_instructor
+            FROM camp as t1, program as t2, camp_x_instructors as t3, user as t4
+            WHERE t1.program_id = t2.id and t1.id = t3.camp_id and t3.is_primary and t3.user_id = t4.id
+            ORDER BY t1.id
+    '''
+    return [tuple(row) for row in db.execute_read(connection, select_stmt) or []]
+
+
+def list_camps(connection: db.Connection) -> list:
+    return [tuple(row) for row in db.execute_read(connection, 'SELECT * FROM camp_listing ORDER BY id') or []]
+
+
+# Test that camp_listing matches the full join after every kind of write that can change it
+def test_camp_listing(pool: db.ConnectionPool):
+    with pool.connection() as connection:
+        first_instructor = create_instructor(connection, google_id = 1)
+        second_instructor = create_instructor(connection, google_id = 2)
+        robotics = Program(db = connection, title = 'Robotics', grade_range = (GradeLevel(3), GradeLevel(5)), tags = 'robotics')
+        chess = Program(db = connection, title = 'Chess', grade_range = (GradeLevel(1), GradeLevel(8)), tags = 'chess')
+        robotics_camp = Camp(db = connection, program_id = robotics.id)
+        chess_camp = Camp(db = connection, program_id = chess.id)
+        writes = [
+            lambda: robotics_camp.add_instructor(db = connection, user_id = first_instructor.id),
+            lambda: robotics_camp.add_instructor(db = connection, user_id = second_instructor.id),
+            lambda: chess_camp.add_instructor(db = connection, user_id = second_instructor.id),
+            lambda: robotics_camp.make_instructor_primary(db = connection, user_id = second_instructor.id),
+            lambda: robotics.update_basic(db = connection, title = 'Robotics 2', tags = 'robotics, python'),
+            lambda: second_instructor.update_basic(db = connection, full_name = 'Steven Tester'),
+            lambda: robotics_camp.remove_instructor(db = connection, user_id = second_instructor.id),
+            lambda: chess_camp.remove_instructor(db = connection, user_id = second_instructor.id),
+            lambda: robotics_camp.delete(db = connection)
+        ]
+        for write in writes:
+            write()
+            assert list_camps(connection) == join_camps(connection)
+        assert list_camps(connection) == []
+
+
+# Test that the shared camps table is rebuilt after a camp, a listed program or a listed instructor changes
+def test_camps_table_cache(pool: db.ConnectionPool):
+    with pool.connection() as connection:
+        instructor = create_instructor(connection, google_id = 1)
+        robotics = Program(db = connection, title = 'Robotics', grade_range = (GradeLevel(3), GradeLevel(5)), tags = 'robotics')
+        camp = Camp(db = connection, program_id = robotics.id)
+        camp.add_instructor(db = connection, user_id = instructor.id)
+        filter_table = load_camps_table(db = connection)
+        assert load_camps_table(db = connection).table is filter_table.table
+
+        Camp(db = connection, program_id = robotics.id).add_instructor(db = connection, user_id = instructor.id)
+        filter_table = load_camps_table(db = connection)
+        assert len(filter_table.base_dataframe) == 2
+        robotics.update_basic(db = connection, title = 'Robotics 2')
+        filter_table = load_camps_table(db = connection)
+        assert filter_table.base_dataframe['title'].tolist() == ['Robotics 2', 'Robotics 2']
+        instructor.update_basic(db = connection, full_name = 'Steven Tester')
+        assert load_camps_table(db = connection).base_dataframe['primary_instructor'].tolist() == ['Steven Tester', 'Steven Tester']
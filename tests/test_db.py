@@ -0,0 +1,165 @@
+import os, sqlite3, threading, asyncio, pytest, db
+
+
+# Test that the pool is in WAL mode and reader connections are read-only
+def test_pool_wal_and_readers(pool: db.ConnectionPool):
+    assert pool.writer.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    with pool.connection() as connection:
+        with pytest.raises(sqlite3.OperationalError):
+            connection.reader.execute('INSERT INTO student (name) VALUES ("Karen Tester")')
+        student_id = db.execute_write(connection, 'INSERT INTO student (name) VALUES (?)', ('Karen Tester',))
+        result = db.execute_read(connection, 'SELECT name FROM student WHERE id = ?', (student_id,))
+        assert result[0]['name'] == 'Karen Tester'
+
+
+# Test that repeated fixed statement text is counted as statement cache hits
+def test_statement_cache_stats(pool: db.ConnectionPool):
+    with pool.connection() as connection:
+        for name in ('Karen Tester', 'Cheri Tester', 'Renee Tester'):
+            db.execute_write(connection, 'INSERT INTO student (name) VALUES (?)', (name,))
+            db.execute_read(connection, 'SELECT id FROM student WHERE name = ?', (name,))
+    stats = pool.statement_stats.as_dict()
+    assert stats['misses'] == 2
+    assert stats['hits'] == 4
+    assert stats['hit_rate'] == pytest.approx(4 / 6)
+
+
+# Test that readers are returned to the pool and reused
+def test_pool_checkout_checkin(pool: db.ConnectionPool):
+    first = pool.checkout()
+    second = pool.checkout()
+    first_reader = first.reader
+    pool.checkin(first)
+    assert first.reader is None
+    third = pool.checkout()
+    assert third.reader is first_reader
+    pool.checkin(second)
+    pool.checkin(third)
+
+
+# Test that the awaitable API runs queries off the event loop thread
+def test_execute_async(pool: db.ConnectionPool):
+    async def add_and_read_student():
+        with pool.connection() as connection:
+            student_id = await db.execute_write_async(connection, 'INSERT INTO student (name) VALUES (?)', ('Cheri Tester',))
+            result = await db.execute_read_async(connection, 'SELECT name FROM student WHERE id = ?', (student_id,))
+            thread_name = await db.run(lambda: threading.current_thread().name)
+        return result, thread_name
+    result, thread_name = asyncio.run(add_and_read_student())
+    assert result[0]['name'] == 'Cheri Tester'
+    assert thread_name.startswith('db')
+
+
+# Test that waiting for a reader never takes a database executor thread from requests that already hold one
+def test_connection_async(pool: db.ConnectionPool):
+    async def read_one():
+        async with db.connection_async(pool) as connection:
+            return await db.execute_read_async(connection, 'SELECT 1 AS one')
+    async def read_while_waiting():
+        held = [pool.checkout() for _ in range(pool.max_readers)]
+        waiting = asyncio.gather(*[read_one() for _ in range(32)]) # more waiters than executor threads
+        await asyncio.sleep(0.05)
+        results = [await db.execute_read_async(connection, 'SELECT 1 AS one') for connection in held]
+        for connection in held:
+            pool.checkin(connection)
+        return results + await asyncio.wait_for(waiting, timeout=10)
+    results = asyncio.run(read_while_waiting())
+    assert [result[0]['one'] for result in results] == [1] * (pool.max_readers + 32)
+
+
+
+# Test that nested writes are committed once, at the end of the outermost transaction
+def test_transaction_commit(pool: db.ConnectionPool):
+    with pool.connection() as connection:
+        with db.transaction(connection):
+            student_id = db.execute_write(connection, 'INSERT INTO student (name) VALUES (?)', ('Karen Tester',))
+            with db.transaction(connection):
+                db.execute_write(connection, 'UPDATE student SET grade_level = ? WHERE id = ?', (6, student_id))
+            assert connection.writer.in_transaction
+            assert db.execute_read(connection, 'SELECT grade_level FROM student WHERE id = ?', (student_id,))[0]['grade_level'] == 6
+            assert connection.reader.execute('SELECT * FROM student').fetchall() == []
+        assert not connection.writer.in_transaction
+        assert db.execute_read(connection, 'SELECT grade_level FROM student WHERE id = ?', (student_id,))[0]['grade_level'] == 6
+
+
+# Test that an exception rolls back every write in the transaction
+def test_transaction_rollback(pool: db.ConnectionPool):
+    with pool.connection() as connection:
+        with pytest.raises(ValueError):
+            with db.transaction(connection):
+                db.execute_write(connection, 'INSERT INTO student (name) VALUES (?)', ('Karen Tester',))
+                db.execute_write(connection, 'INSERT INTO student (name) VALUES (?)', ('Cheri Tester',))
+                raise ValueError('abort')
+        assert db.execute_read(connection, 'SELECT * FROM student') is None
+        assert not pool.write_lock.locked()
+
+
+# Test that table versions, and the ETags made from them, move when a write commits and are the same for every pool
+def test_table_versions(pool: db.ConnectionPool):
+    other_pool = db.ConnectionPool(pool.db_path)
+    try:
+        with pool.connection() as connection, other_pool.connection() as other_connection:
+            with db.transaction(connection):
+                db.execute_write(connection, 'INSERT INTO student (name) VALUES (?)', ('Karen Tester',))
+                db.execute_write(connection, 'INSERT OR IGNORE INTO user_x_students (user_id, student_id) VALUES (?, ?)', (1, 1))
+                assert db.get_table_versions(other_connection, ['student']) == (0,)
+            assert db.get_table_versions(connection, ['student', 'user_x_students', 'program']) == (1, 1, 0)
+            with pytest.raises(ValueError):
+                with db.transaction(other_connection):
+                    db.execute_write(other_connection, 'INSERT INTO student (name) VALUES (?)', ('Cheri Tester',))
+                    raise ValueError('abort')
+            db.execute_write(other_connection, 'UPDATE student SET grade_level = ?', (6,))
+            assert db.get_table_versions(connection, ['student', 'user_x_students']) == (2, 1)
+
+            etag = db.make_etag(db.get_table_versions(connection, ['student']), 1)
+            assert etag == db.make_etag(db.get_table_versions(other_connection, ['student']), 1)
+            assert etag != db.make_etag(db.get_table_versions(connection, ['student']), 2)
+            assert db.etag_matches(f'"other", {etag[2:]}', etag)
+            assert not db.etag_matches(db.make_etag((1,), 1), etag)
+    finally:
+        other_pool.close()
+
+
+# Test that another process's commit is noticed even while this process holds the write lock
+def test_poll_while_writing(pool: db.ConnectionPool):
+    other_pool = db.ConnectionPool(pool.db_path)
+    try:
+        with other_pool.connection() as connection:
+            db.execute_write(connection, 'INSERT INTO student (name) VALUES (?)', ('Karen Tester',))
+        with pool.write_lock:
+            assert pool.poll_external_changes()
+            assert not pool.poll_external_changes()
+        assert pool.poll_external_changes() # the writer has its own view, so it reports the same change once more
+        assert not pool.poll_external_changes()
+    finally:
+        other_pool.close()
+
+
+# Test that a database created from the old, index-less schema is upgraded in place
+def test_migrate_old_schema(tmp_path):
+    db_path = os.path.join(tmp_path, 'test_migrate.db')
+    old_db = sqlite3.connect(db_path)
+    with open(os.path.join(os.path.dirname(db.__file__), 'schema.sql'), encoding='utf-8') as schema_file:
+        old_db.executescript(schema_file.read())
+    for (index_name,) in old_db.execute('SELECT name FROM sqlite_master WHERE type = "index" AND sql IS NOT NULL').fetchall():
+        old_db.execute(f'DROP INDEX {index_name}')
+    old_db.execute('INSERT INTO user_x_roles (user_id, role) VALUES (1, "GUARDIAN"), (1, "GUARDIAN"), (2, "GUARDIAN")')
+    old_db.execute('DROP TABLE program_x_tags')
+    old_db.execute('INSERT INTO program (tags) VALUES ("Robotics, python,robotics, ")')
+    old_db.execute('PRAGMA user_version = 0')
+    old_db.commit()
+    old_db.close()
+
+    connection_pool = db.ConnectionPool(db_path)
+    try:
+        latest_version = db.list_migrations()[-1][0]
+        assert connection_pool.writer.execute('PRAGMA user_version').fetchone()[0] == latest_version
+        assert connection_pool.writer.execute('SELECT COUNT(*) FROM user_x_roles').fetchone()[0] == 2
+        assert connection_pool.writer.execute('SELECT tag FROM program_x_tags ORDER BY tag').fetchall() == [('python',), ('robotics',)]
+        plan = connection_pool.writer.execute('EXPLAIN QUERY PLAN SELECT role FROM user_x_roles WHERE user_id = ?', (1,)).fetchall()
+        assert 'USING' in plan[0][-1] and 'INDEX' in plan[0][-1]
+        with pytest.raises(sqlite3.IntegrityError):
+            connection_pool.writer.execute('INSERT INTO user_x_roles (user_id, role) VALUES (1, "GUARDIAN")')
+        connection_pool.writer.rollback()
+    finally:
+        connection_pool.close()
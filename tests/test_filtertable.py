@@ -0,0 +1,250 @@
+import sqlite3, pandas, pytest
+from types import SimpleNamespace
+from filtertable import Filter, FilterTable, TagIndex, Checkboxes, Tags, Range, DoubleRange, SqlSource
+
+
+def build_filter_table() -> FilterTable:
+    dataframe = pandas.DataFrame({
+        'id': [1, 2, 3, 4, 5],
+        'title': ['Robotics', 'Python', 'Scratch', 'Chess', 'Lego'],
+        'tags': ['robotics', 'python', 'scratch', 'chess', 'robotics'],
+        'from_grade': [3, 6, 1, 0, 2],
+        'to_grade': [5, 8, 3, 12, 4],
+        'price': [100, 200, 50, 75, 125]
+    })
+    filter_table = FilterTable(base_dataframe=dataframe)
+    filter_table.filters.append(Checkboxes(display_column='tags', source_column='tags'))
+    filter_table.filters.append(Range(display_column='price', source_column='price', selected_extrema=[]))
+    filter_table.filters.append(DoubleRange(display_column='grade_range', source_columns=('from_grade','to_grade')))
+    return filter_table
+
+
+# Test that query string selections combine into the current view
+@pytest.mark.parametrize(('params', 'expected_titles'), (
+    ({}, ['Robotics', 'Python', 'Scratch', 'Chess', 'Lego']),
+    ({'tags': ['robotics', 'chess']}, ['Robotics', 'Chess', 'Lego']),
+    ({'price_min': ['75'], 'price_max': ['125']}, ['Robotics', 'Chess', 'Lego']),
+    ({'grade_range_min': ['6'], 'grade_range_max': ['']}, ['Python', 'Chess']),
+    ({'tags': ['robotics'], 'grade_range_min': ['4'], 'grade_range_max': ['4']}, ['Robotics', 'Lego']),
+    ({'tags': ['robotics'], 'price_max': ['not a number']}, ['Robotics', 'Lego'])
+))
+def test_apply(params: dict, expected_titles: list):
+    filter_table = build_filter_table()
+    filter_table.select(params)
+    assert filter_table.apply()['title'].tolist() == expected_titles
+    assert filter_table.current_view.columns is filter_table.base_dataframe.columns
+
+
+# Test that a filter missing part of the interface fails as soon as it is created, not in the middle of a request
+def test_filter_interface():
+    class Incomplete(Filter):
+        pass
+    with pytest.raises(TypeError, match = 'build_facet, build_facet_index, build_mask, select, selection_key, set_facet'):
+        Incomplete(display_column='tags')
+
+
+# Test that changing one selection only rebuilds that filter's mask
+def test_mask_cache():
+    filter_table = build_filter_table()
+    filter_table.select({'tags': ['robotics', 'python'], 'price_min': ['100']})
+    filter_table.apply()
+    tags_mask = filter_table.filters[0].get_mask(filter_table.table)
+    price_mask = filter_table.filters[1].get_mask(filter_table.table)
+    filter_table.select({'tags': ['python', 'robotics'], 'price_min': ['150']})
+    assert filter_table.apply()['title'].tolist() == ['Python']
+    assert filter_table.filters[0].get_mask(filter_table.table) is tags_mask
+    assert filter_table.filters[1].get_mask(filter_table.table) is not price_mask
+
+
+# Test that views of one base table share its rows and derived data, while keeping their own selections
+def test_shared_base_table():
+    base_table = build_filter_table().table
+    base_table.columns['title'].display = True
+    views = [FilterTable(table=base_table, filters=build_filter_table().filters) for _ in range(2)]
+    views[0].select({'tags': ['robotics'], 'price_max': ['110']})
+    views[1].select({'tags': ['robotics']})
+    assert views[0].apply()['title'].tolist() == ['Robotics']
+    assert views[1].apply()['title'].tolist() == ['Robotics', 'Lego']
+    assert views[0].base_dataframe is views[1].base_dataframe
+    assert views[0].filters[0].get_mask(base_table) is views[1].filters[0].get_mask(base_table)
+    assert views[0].filters[1].facet_extrema == [100, 125]
+
+    derived_count = len(base_table.derived)
+    view = FilterTable(table=base_table, filters=build_filter_table().filters)
+    view.select({'tags': ['robotics'], 'price_max': ['110']})
+    view.apply()
+    assert len(base_table.derived) == derived_count
+    assert view.filters[0].facet_counts is views[0].filters[0].facet_counts
+    assert view.get_page(sort_by=['-price']).rows == views[0].get_page(sort_by=['-price']).rows
+    assert [column.display_name for column in base_table.columns.values() if column.display] == ['Title']
+
+
+# Test that facets count what each filter would show given every other filter's selection, and are only rebuilt when those change
+def test_facets():
+    filter_table = build_filter_table()
+    filter_table.apply()
+    tags_filter, price_filter, grade_filter = filter_table.filters
+    assert tags_filter.facet_counts == {'chess': 1, 'python': 1, 'robotics': 2, 'scratch': 1}
+    assert price_filter.facet_extrema == [50, 200]
+    assert grade_filter.facet_extrema == [0, 12]
+
+    filter_table.select({'tags': ['robotics'], 'price_max': ['110']})
+    filter_table.apply()
+    assert tags_filter.facet_counts == {'chess': 1, 'python': 0, 'robotics': 1, 'scratch': 1}
+    assert price_filter.facet_extrema == [100, 125]
+    assert grade_filter.facet_extrema == [3, 5]
+
+    tags_facet_counts = tags_filter.facet_counts
+    filter_table.select({'tags': ['robotics'], 'price_max': ['110'], 'grade_range_max': ['1']})
+    filter_table.apply()
+    assert tags_filter.facet_counts is not tags_facet_counts
+    assert price_filter.facet_extrema == [None, None]
+    assert grade_filter.facet_extrema == [3, 5]
+    grade_facet_extrema = grade_filter.facet_extrema
+    filter_table.select({'tags': ['robotics'], 'price_max': ['110'], 'grade_range_max': ['2']})
+    filter_table.apply()
+    assert grade_filter.facet_extrema is grade_facet_extrema
+
+
+# Test that pages follow the sort order, and that offset and keyset pagination agree
+@pytest.mark.parametrize(('sort_by', 'expected_titles'), (
+    ([], ['Robotics', 'Python', 'Scratch', 'Chess', 'Lego']),
+    (['title'], ['Chess', 'Lego', 'Python', 'Robotics', 'Scratch']),
+    (['tags', '-price'], ['Chess', 'Python', 'Lego', 'Robotics', 'Scratch']),
+    (['-from_grade', 'not_a_column'], ['Python', 'Robotics', 'Lego', 'Scratch', 'Chess'])
+))
+def test_get_page(sort_by: list, expected_titles: list):
+    filter_table = build_filter_table()
+    filter_table.apply()
+    offset_titles = []
+    keyset_titles = []
+    next_offset = 0
+    while next_offset is not None:
+        page = filter_table.get_page(sort_by = sort_by, offset = next_offset, limit = 2)
+        offset_titles.extend(row['title'] for row in page.rows)
+        next_offset = page.next_offset
+    page = filter_table.get_page(sort_by = sort_by, limit = 2)
+    keyset_titles.extend(row['title'] for row in page.rows)
+    while page.next_after is not None:
+        page = filter_table.get_page(sort_by = sort_by, limit = 2, after = page.next_after)
+        keyset_titles.extend(row['title'] for row in page.rows)
+    assert offset_titles == expected_titles
+    assert keyset_titles == expected_titles
+    assert page.total == 5
+
+
+# Test that pages only hold rows in the current view
+def test_get_page_filtered():
+    filter_table = build_filter_table()
+    filter_table.select({'tags': ['robotics', 'chess']})
+    filter_table.apply()
+    page = filter_table.get_page(sort_by = ['title'], limit = 2)
+    assert [row['title'] for row in page.rows] == ['Chess', 'Lego']
+    assert page.total == 3 and page.next_offset == 2 and page.next_after == 5
+    page = filter_table.get_page(sort_by = ['title'], limit = 2, after = page.next_after)
+    assert [row['title'] for row in page.rows] == ['Robotics']
+    assert page.next_offset is None and page.next_after is None
+
+
+def walk_pages(get_page, keyset: bool) -> list:
+    page = get_page(offset = 0, after = None)
+    titles = [row['title'] for row in page.rows]
+    while page.next_offset is not None:
+        page = get_page(offset = 0, after = page.next_after) if keyset else get_page(offset = page.next_offset, after = None)
+        titles.extend(row['title'] for row in page.rows)
+    return titles
+
+
+# Test that filters, sorting and both kinds of pagination pushed down into SQL match the in-memory engine
+@pytest.mark.parametrize(('params', 'sort_by'), (
+    ({}, []),
+    ({'tags': ['robotics', 'chess']}, ['title']),
+    ({'price_min': ['60'], 'grade_range_max': ['4']}, ['-price']),
+    ({'grade_range_min': ['3']}, ['-tags', 'price']),
+    ({}, ['rating', '-title']),
+    ({}, ['-rating']),
+    ({'tags': ['robotics', 'python', 'scratch']}, ['tags', '-rating']),
+    ({'price_min': ['not a number'], 'price_max': ['1000']}, ['grade_label'])
+))
+@pytest.mark.parametrize(('keyset'), (False, True))
+def test_sql_pushdown(params: dict, sort_by: list, keyset: bool):
+    dataframe = build_filter_table().base_dataframe
+    dataframe['rating'] = [4, None, 5, None, 4]
+    connection = sqlite3.connect(':memory:')
+    dataframe.to_sql('program', connection, index=False)
+    db = SimpleNamespace(reader=connection)
+    source = SqlSource(select_stmt='SELECT * FROM program', columns=list(dataframe.columns))
+    def add_grade_label(dataframe: pandas.DataFrame) -> pandas.DataFrame:
+        dataframe['grade_label'] = dataframe['from_grade'].astype(str) + ' to ' + dataframe['to_grade'].astype(str)
+        return dataframe
+
+    filter_table = build_filter_table()
+    filter_table.base_dataframe['rating'] = dataframe['rating']
+    filter_table.base_dataframe['grade_label'] = add_grade_label(dataframe.copy())['grade_label']
+    filter_table.select(params)
+    filter_table.apply()
+    expected_titles = walk_pages(lambda offset, after: filter_table.get_page(sort_by = sort_by, offset = offset, limit = 2, after = after), keyset)
+
+    filters = build_filter_table().filters
+    for filter in filters:
+        filter.select(None, params)
+    titles = walk_pages(lambda offset, after: source.query_page(db, filters, sort_by = sort_by, offset = offset, limit = 2,
+        after = after, formatter = add_grade_label), keyset)
+    assert titles == expected_titles
+
+
+# Test that filters SQL can't express are applied in memory after the rest are pushed down
+def test_sql_pushdown_fallback():
+    dataframe = build_filter_table().base_dataframe
+    connection = sqlite3.connect(':memory:')
+    dataframe.to_sql('program', connection, index=False)
+    source = SqlSource(select_stmt='SELECT id, title, tags, price FROM program', columns=['id', 'title', 'tags', 'price'])
+    filters = build_filter_table().filters
+    for filter in filters:
+        filter.select(None, {'tags': ['robotics', 'chess'], 'grade_range_min': ['5']})
+    where_clause, params, memory_filters = source.compile_where(filters)
+    assert where_clause == 'WHERE "tags" IN (SELECT value FROM json_each(?))'
+    assert memory_filters == [filters[2]]
+    def add_grades(page_dataframe: pandas.DataFrame) -> pandas.DataFrame:
+        return page_dataframe.merge(dataframe[['id', 'from_grade', 'to_grade']], on='id')
+    page = source.query_page(SimpleNamespace(reader=connection), filters, sort_by = ['title'], formatter = add_grades)
+    assert [row['title'] for row in page.rows] == ['Chess', 'Robotics']
+
+
+# Test that tag filters match any or all of the selected tags through the inverted index, and facet rows sharing a key
+@pytest.mark.parametrize(('params', 'expected_titles', 'expected_counts'), (
+    ({}, ['Robotics', 'Python', 'Scratch', 'Chess', 'Lego'], {'chess': 1, 'games': 2, 'python': 2, 'robotics': 3}),
+    ({'tags': ['robotics', 'games']}, ['Robotics', 'Scratch', 'Lego'], {'chess': 1, 'games': 2, 'python': 2, 'robotics': 3}),
+    ({'tags': ['Robotics', 'games'], 'tags_match': ['all']}, ['Scratch', 'Lego'], {'chess': 1, 'games': 2, 'python': 2, 'robotics': 3}),
+    ({'tags': ['python'], 'price_max': ['100']}, ['Robotics'], {'chess': 1, 'games': 1, 'python': 1, 'robotics': 2})
+))
+def test_tags(params: dict, expected_titles: list, expected_counts: dict):
+    filter_table = build_filter_table()
+    filter_table.base_dataframe['program_id'] = [1, 2, 3, 4, 3]
+    tag_index = {'robotics': frozenset({1, 3}), 'python': frozenset({1, 2}), 'games': frozenset({3}), 'chess': frozenset({4}), 'art': frozenset({9})}
+    filter_table.filters[0] = Tags(display_column='tags', key_column='program_id', tag_index=tag_index)
+    filter_table.select(params)
+    assert filter_table.apply()['title'].tolist() == expected_titles
+    assert filter_table.filters[0].facet_counts == expected_counts
+
+    connection = sqlite3.connect(':memory:')
+    filter_table.base_dataframe.to_sql('camp', connection, index=False)
+    source = SqlSource(select_stmt='SELECT * FROM camp', columns=list(filter_table.base_dataframe.columns))
+    page = source.query_page(SimpleNamespace(reader=connection), filter_table.filters)
+    assert [row['title'] for row in page.rows] == expected_titles
+
+
+# Test that a shared table never serves masks or facets built from a tag index that has since been replaced
+def test_tag_index_version():
+    filter_table = build_filter_table()
+    old_index = TagIndex({'robotics': frozenset({1, 5})})
+    filter_table.filters[0] = Tags(display_column='tags', key_column='id', tag_index=old_index)
+    filter_table.select({'tags': ['robotics']})
+    assert filter_table.apply()['title'].tolist() == ['Robotics', 'Lego']
+
+    new_index = TagIndex({'robotics': frozenset({1})})
+    assert new_index.version != old_index.version
+    other_view = FilterTable(table=filter_table.table, filters=[Tags(display_column='tags', key_column='id', tag_index=new_index)])
+    other_view.select({'tags': ['robotics']})
+    assert other_view.apply()['title'].tolist() == ['Robotics']
+    assert other_view.filters[0].facet_counts == {'robotics': 1}
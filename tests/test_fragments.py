@@ -0,0 +1,53 @@
+import os, jinja2
+from fragments import install_fragment_cache
+from filtertable import FilterTable
+from test_filtertable import build_filter_table
+
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'templates')
+
+
+def build_env() -> jinja2.Environment:
+    return jinja2.Environment(loader=jinja2.FileSystemLoader(TEMPLATE_DIR), autoescape=True)
+
+
+def build_sidebar_table() -> FilterTable:
+    # The sidebar names each filter by its column, and grade_range is only formatted by the real tables
+    filter_table = build_filter_table()
+    filter_table.filters = [filter for filter in filter_table.filters if filter.display_column in filter_table.table.columns]
+    return filter_table
+
+
+def render_sidebar(fragments, filter_table: FilterTable, params: dict) -> str:
+    filter_table.select(params)
+    filter_table.apply()
+    return fragments.render('filter_sidebar.html', filter_table.fragment_key(), filtertable=filter_table)
+
+
+# Test that a fragment renders once per key, and renders again once invalidated
+def test_fragment_cache():
+    env = build_env()
+    fragments = install_fragment_cache(env)
+    assert fragments.precompile() == len(os.listdir(TEMPLATE_DIR))
+    html = fragments.render('nav.html', None, user_id=None, roles=None)
+    assert 'Sign in with Google' in html
+    assert fragments.render('nav.html', None, user_id=None, roles=[]) is html
+    assert '<a href="/signin">' in env.from_string("{{ fragment('nav.html', None, user_id=None, roles=None) }}").render()
+
+    fragments.invalidate('nav.html', None)
+    assert fragments.render('nav.html', None, user_id=1, roles=[]).strip() == ''
+
+
+# Test that views of a table share sidebars while their selections match, and a rebuilt table renders its own
+def test_sidebar_fragment():
+    fragments = install_fragment_cache(build_env())
+    filter_table = build_sidebar_table()
+    html = render_sidebar(fragments, filter_table, {'tags': ['robotics']})
+    assert 'value=\'robotics\' checked' in html
+    other_view = FilterTable(table=filter_table.table, filters=build_sidebar_table().filters)
+    assert render_sidebar(fragments, other_view, {'tags': ['robotics']}) is html
+    assert render_sidebar(fragments, other_view, {'tags': ['chess']}) != html
+
+    rebuilt_table = build_sidebar_table()
+    assert rebuilt_table.fragment_key() != filter_table.fragment_key()
+    assert render_sidebar(fragments, rebuilt_table, {'tags': ['robotics']}) is not html
@@ -0,0 +1,40 @@
+import asyncio, pytest, google_auth
+
+
+class FakeTransport(google_auth.HttpTransport):
+    def __init__(self, headers: dict):
+        self.headers = headers
+        self.requests = 0
+
+    async def request_json(self, method, url, headers = None, data = None):
+        self.requests += 1
+        await asyncio.sleep(0.01)
+        return {'authorization_endpoint': f'https://test.com/auth/{self.requests}'}, self.headers
+
+
+# Test that the TTL follows Cache-Control, falling back to the default when it is absent
+@pytest.mark.parametrize(('headers', 'expected_ttl'), (
+    ({'Cache-Control': 'public, max-age=3600'}, 3600),
+    ({'cache-control': 'public, max-age=3600', 'Age': '600'}, 3000),
+    ({'Cache-Control': 'no-cache'}, 0),
+    ({}, 60)
+))
+def test_get_cache_ttl(headers: dict, expected_ttl: int):
+    assert google_auth.get_cache_ttl(headers, default_ttl = 60) == expected_ttl
+
+
+# Test that concurrent sign-ins share one fetch, and that an uncacheable document is fetched every time
+def test_discovery_cache():
+    async def get_documents(discovery: google_auth.DiscoveryCache) -> list:
+        return await asyncio.gather(*[discovery.get() for i in range(10)])
+
+    transport = FakeTransport({'Cache-Control': 'public, max-age=3600'})
+    discovery = google_auth.DiscoveryCache(transport)
+    documents = asyncio.run(get_documents(discovery))
+    assert transport.requests == 1
+    assert all(document is documents[0] for document in documents)
+
+    transport = FakeTransport({'Cache-Control': 'no-store'})
+    discovery = google_auth.DiscoveryCache(transport)
+    asyncio.run(get_documents(discovery))
+    assert transport.requests == 10
@@ -0,0 +1,109 @@
+import pytest, db
+from program import Program, Level, GradeLevel, load_program, load_tag_index
+from cache import identity_map
+
+
+def create_program(connection: db.Connection, level_count: int) -> Program:
+    program = Program(db = connection, title = 'Robotics', grade_range = (GradeLevel(3), GradeLevel(5)), tags = 'robotics')
+    for level_index in range(level_count):
+        level = Level(db = connection, title = f'Level {level_index + 1}', list_index = program.get_next_level_index())
+        program.add_level(db = connection, level_id = level.id)
+    return program
+
+
+# Test that all levels load in list_index order with one query, and not at all once cached
+def test_load_levels(pool: db.ConnectionPool, count_statements):
+    with pool.connection() as connection:
+        program = create_program(connection, level_count = 12)
+        identity_map.clear()
+        program = load_program(db = connection, program_id = program.id)
+        statement_count = count_statements(pool)
+        program.load_levels(db = connection)
+        assert count_statements(pool) - statement_count == 1
+        assert [level.list_index for level in program.ordered_levels] == list(range(1, 13))
+        assert list(program.levels.values()) == program.ordered_levels
+
+        statement_count = count_statements(pool)
+        load_program(db = connection, program_id = program.id).load_levels(db = connection)
+        assert count_statements(pool) == statement_count
+
+
+def load_level_titles(connection: db.Connection, program_id: int) -> list:
+    identity_map.clear()
+    program = load_program(db = connection, program_id = program_id)
+    program.load_levels(db = connection)
+    return [(level.list_index, level.title) for level in program.ordered_levels]
+
+
+# Test that moving a level shifts the levels in between with one update, in either direction
+@pytest.mark.parametrize(('level_id', 'new_list_index', 'expected_order'), (
+    (4, 2, [1, 4, 2, 3, 5]),
+    (2, 4, [1, 3, 4, 2, 5]),
+    (5, 1, [5, 1, 2, 3, 4]),
+    (1, 99, [2, 3, 4, 5, 1])
+))
+def test_move_level_index(pool: db.ConnectionPool, count_statements, level_id: int, new_list_index: int, expected_order: list):
+    with pool.connection() as connection:
+        program = create_program(connection, level_count = 5)
+        program.load_levels(db = connection)
+        statement_count = count_statements(pool)
+        program.move_level_index(db = connection, level_id = level_id, new_list_index = new_list_index)
+        assert count_statements(pool) - statement_count == 2
+        assert load_level_titles(connection, program.id) == [(list_index + 1, f'Level {title_index}') for list_index, title_index in enumerate(expected_order)]
+
+
+# Test that removing a level closes the gap in list_index
+def test_remove_level(pool: db.ConnectionPool):
+    with pool.connection() as connection:
+        program = create_program(connection, level_count = 5)
+        program.remove_level(db = connection, level_id = 2)
+        assert load_level_titles(connection, program.id) == [(1, 'Level 1'), (2, 'Level 3'), (3, 'Level 4'), (4, 'Level 5')]
+        assert program.get_next_level_index() == 5
+
+
+# Test that a full reorder is applied with one update, and rejected unless it lists every level once
+def test_set_level_order(pool: db.ConnectionPool, count_statements):
+    with pool.connection() as connection:
+        program = create_program(connection, level_count = 5)
+        assert not program.set_level_order(db = connection, level_ids = [5, 4, 3, 2])
+        assert not program.set_level_order(db = connection, level_ids = [5, 4, 3, 2, 2])
+        statement_count = count_statements(pool)
+        assert program.set_level_order(db = connection, level_ids = [3, 5, 1, 4, 2])
+        assert count_statements(pool) - statement_count == 1
+        assert load_level_titles(connection, program.id) == [(1, 'Level 3'), (2, 'Level 5'), (3, 'Level 1'), (4, 'Level 4'), (5, 'Level 2')]
+
+
+# Test that tags are normalized into program_x_tags, and the inverted index follows every change
+def test_tag_index(pool: db.ConnectionPool, count_statements):
+    with pool.connection() as connection:
+        robotics = Program(db = connection, title = 'Robotics', grade_range = (GradeLevel(3), GradeLevel(5)), tags = 'Robotics, python,robotics, ')
+        scratch = Program(db = connection, title = 'Scratch', grade_range = (GradeLevel(1), GradeLevel(3)), tags = 'python,Scratch')
+        assert robotics.tags == 'robotics, python'
+        assert load_tag_index(db = connection) == {'robotics': {robotics.id}, 'python': {robotics.id, scratch.id}, 'scratch': {scratch.id}}
+        statement_count = count_statements(pool)
+        load_tag_index(db = connection)
+        assert count_statements(pool) == statement_count
+
+        scratch.update_basic(db = connection, tags = 'scratch, games')
+        assert load_tag_index(db = connection) == {'robotics': {robotics.id}, 'python': {robotics.id}, 'scratch': {scratch.id}, 'games': {scratch.id}}
+        robotics.delete(db = connection)
+        assert load_tag_index(db = connection) == {'scratch': {scratch.id}, 'games': {scratch.id}}
+
+
+# Test that imported levels are appended in file order across chunks, and a bad row leaves no level behind
+def test_import_levels(pool: db.ConnectionPool):
+    with pool.connection() as connection:
+        program = create_program(connection, level_count = 2)
+        program.load_levels(db = connection)
+        records = [{'title': f'Imported {level_index}', 'description': ''} for level_index in range(5)]
+        assert program.import_levels(db = connection, records = records, chunk_size = 2) == 5
+        program = load_program(db = connection, program_id = program.id)
+        program.load_levels(db = connection)
+        assert [level.title for level in program.ordered_levels] == ['Level 1', 'Level 2'] + [record['title'] for record in records]
+        assert [level.list_index for level in program.ordered_levels] == list(range(1, 8))
+        exported_levels = [dict(row) for row in program.export_levels(db = connection)]
+        assert [(level['id'], level['title']) for level in exported_levels] == [(level.id, level.title) for level in program.ordered_levels]
+
+        with pytest.raises(ValueError, match = 'Row 3: title is required'):
+            program.import_levels(db = connection, records = records[:2] + [{'description': 'untitled'}], chunk_size = 2)
+        assert db.execute_read(connection, 'SELECT COUNT(*) AS count FROM level')[0]['count'] == 7
@@ -0,0 +1,76 @@
+import db
+from session import SessionStore, load_secret_key
+from user import User
+from cache import identity_map
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def create_session(sessions: SessionStore, user: User) -> str:
+    with sessions.pool.connection() as connection:
+        return sessions.create(user, db = connection)
+
+
+def create_user(pool: db.ConnectionPool) -> User:
+    with pool.connection() as connection:
+        return User(db = connection, google_id = 1, given_name = 'Steve', family_name = 'Tester', full_name = 'Steve Tester', picture = '')
+
+
+# Test that a session resolves from its signed cookie, and that a tampered or foreign cookie does not
+def test_session_cookie(pool: db.ConnectionPool):
+    user = create_user(pool)
+    sessions = SessionStore('secret', pool)
+    cookie = create_session(sessions, user)
+    assert sessions.get_user(cookie) is user
+    session_id, signature = cookie.rsplit('.', 1)
+    assert sessions.get_user(f'{session_id}x.{signature}') is None
+    assert sessions.get_user(session_id) is None
+    assert sessions.get_user(None) is None
+    assert SessionStore('other secret', pool).get_user(cookie) is None
+    with pool.connection() as connection:
+        sessions.delete(sessions.unsign(cookie), db = connection)
+    assert sessions.get_user(cookie) is None
+
+
+# Test that another worker, with nothing cached, resolves the same session from the database
+def test_session_shared(pool: db.ConnectionPool):
+    user = create_user(pool)
+    cookie = create_session(SessionStore('secret', pool), user)
+    identity_map.clear()
+    other_user = SessionStore('secret', pool).get_user(cookie)
+    assert other_user is not None and other_user.id == user.id and other_user is not user
+
+
+# Test that every worker process loads the same generated signing key, so cookies verify on any of them
+def test_shared_secret_key(pool: db.ConnectionPool):
+    other_pool = db.ConnectionPool(pool.db_path)
+    try:
+        secret_key = load_secret_key(pool)
+        assert load_secret_key(other_pool) == secret_key
+        cookie = create_session(SessionStore(secret_key, pool), create_user(pool))
+        assert SessionStore(load_secret_key(other_pool), other_pool).unsign(cookie) is not None
+    finally:
+        other_pool.close()
+
+
+# Test that sessions expire when idle, counting activity seen by other workers
+def test_session_expiry(pool: db.ConnectionPool):
+    user = create_user(pool)
+    clock = Clock()
+    sessions = SessionStore(b'secret', pool, idle_timeout = 60, save_interval = 10, clock = clock)
+    cookie = create_session(sessions, user)
+    clock.now += 50
+    assert sessions.get_user(cookie) is user
+    clock.now += 50
+    assert sessions.get_user(cookie) is user
+    identity_map.clear()
+    clock.now += 61
+    assert sessions.get_user(cookie) is None
+    with pool.connection() as connection:
+        assert db.execute_read(connection, 'SELECT * FROM session') is None
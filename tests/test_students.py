@@ -1,4 +1,4 @@
-import os, pytest, json
+import os, pytest, json, db, session
 from fastapi import status
 from fastapi.testclient import TestClient
 from user import User
@@ -9,21 +9,25 @@ db_path = os.path.join(os.path.dirname(__file__), 'test_students.db')
 if os.path.isfile(db_path):
     os.remove(db_path)
 os.environ['DB_PATH'] = db_path
-from main import app
+from main import app, open_app
+
+open_app()
 
 client = TestClient(app)
 
 all_students_json = {}
 
 # Create test user
-app.user = User(
-    db = app.db,
-    google_id = 1,
-    given_name = 'Steve',
-    family_name = 'Tester',
-    full_name = 'Steve Tester',
-    picture = ''
-)
+with app.db.connection() as connection:
+    user = User(
+        db = connection,
+        google_id = 1,
+        given_name = 'Steve',
+        family_name = 'Tester',
+        full_name = 'Steve Tester',
+        picture = ''
+    )
+    client.cookies.set(session.SESSION_COOKIE_NAME, app.sessions.create(user, db = connection))
 
 # Test webpage read
 def test_get_students_html():
@@ -87,7 +91,68 @@ def test_student_permission():
     assert returned_json == student_error_json
 
 
+# Test that unchanged pages and students are answered 304 Not Modified, until a student changes
+def test_conditional_get():
+    student_json = next(iter(all_students_json.values()))
+    for path in ('/students', '/students/' + str(student_json['id'])):
+        response = client.get(path)
+        etag = response.headers['etag']
+        response = client.get(path, headers={'If-None-Match': etag})
+        assert response.status_code == status.HTTP_304_NOT_MODIFIED
+        assert response.content == b''
+        assert response.headers['etag'] == etag
+    student_json = dict(student_json, grade_level=4)
+    assert client.put('/students/' + str(student_json['id']), json=student_json).status_code == status.HTTP_200_OK
+    response = client.get('/students/' + str(student_json['id']), headers={'If-None-Match': etag})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()['grade_level'] == 4
+    assert response.headers['etag'] != etag
+
+
+# Test that students import from CSV and NDJSON uploads and stream back out, and that a bad row imports nothing
+def test_import_export_students():
+    csv_upload = 'name,birthdate,grade_level\nAmy Tester,2015-01-02,3\n"Tester, Bo",2016-03-04,\n'
+    response = client.post('/import/students', data=csv_upload, headers={'Content-Type': 'text/csv'})
+    assert response.json() == {'imported': 2}
+    ndjson_upload = '{"name": "Cy Tester", "birthdate": "2017-05-06", "grade_level": 1}\n\n'
+    response = client.post('/import/students?format=ndjson', data=ndjson_upload)
+    assert response.json() == {'imported': 1}
+
+    response = client.get('/export/students?format=ndjson')
+    assert response.headers['content-type'].startswith('application/x-ndjson')
+    exported_students = [json.loads(line) for line in response.text.splitlines()]
+    assert [student['name'] for student in exported_students[-3:]] == ['Amy Tester', 'Tester, Bo', 'Cy Tester']
+    assert exported_students[-2]['grade_level'] is None
+    response = client.get('/export/students')
+    assert response.text.splitlines()[0] == 'id,name,birthdate,grade_level'
+    assert response.text.splitlines()[-2].endswith(',"Tester, Bo",2016-03-04,')
+
+    response = client.post('/import/students', data='name,birthdate\nDee Tester,2015-01-02\nEd Tester,not a date\n')
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert response.json()['detail'].startswith('Row 2:')
+    assert len(client.get('/export/students?format=ndjson').text.splitlines()) == len(exported_students)
+
+
+# Test that a program that no longer exists is a 404 on every route that loads it, whether or not an upload is valid
+def test_missing_program():
+    session_user = app.sessions.get_user(client.cookies.get(session.SESSION_COOKIE_NAME))
+    session_user.program_ids.append(999)
+    try:
+        response = client.post('/import/programs/999/levels', data='title,description\nLevel 1,\n')
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+        assert client.get('/export/programs/999/levels').status_code == status.HTTP_404_NOT_FOUND
+        assert client.get('/programs/999').status_code == status.HTTP_404_NOT_FOUND
+        assert client.get('/programs/999/1').status_code == status.HTTP_404_NOT_FOUND
+        assert client.post('/programs/999', data={'program_title': 'Robotics'}).status_code == status.HTTP_404_NOT_FOUND
+        assert client.post('/programs/999/1', data={'level_title': 'Level 1'}).status_code == status.HTTP_404_NOT_FOUND
+        assert client.put('/programs/999/levels', json=[1]).status_code == status.HTTP_404_NOT_FOUND
+        assert client.delete('/programs/999/1').status_code == status.HTTP_404_NOT_FOUND
+    finally:
+        session_user.program_ids.remove(999)
+
+
 # Remove temporary database
 def test_clean_up():
+    db.close_db(app)
     os.remove(db_path)
 
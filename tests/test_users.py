@@ -0,0 +1,197 @@
+import os, asyncio, pytest, db, cache
+from user import User, Role, RoleIndex, load_users, load_users_by_role, load_all_roles
+from program import Program, GradeLevel, load_tag_index
+from cache import identity_map
+
+
+# Test that bulk loading matches per-user loading, costs a constant number of queries, and then hits the identity map
+@pytest.mark.parametrize(('user_count'), (1, 5, 20))
+def test_load_users(pool: db.ConnectionPool, count_statements, user_count: int):
+    with pool.connection() as connection:
+        expected_users = {}
+        for google_id in range(1, user_count + 1):
+            user = User(db = connection, google_id = google_id, given_name = 'Steve', family_name = 'Tester',
+                full_name = f'Steve Tester {google_id}', picture = '')
+            user.add_email_address(db = connection, email_address = f'steve{google_id}@test.com')
+            user.add_email_address(db = connection, email_address = f'tester{google_id}@test.com')
+            user.make_email_address_primary(db = connection, email_address = f'tester{google_id}@test.com')
+            user.add_role(db = connection, role = 'INSTRUCTOR')
+            user.add_program(db = connection, program_id = google_id)
+            expected_users[user.id] = User(db = connection, id = user.id)
+
+        statement_count = count_statements(pool)
+        users = load_users(db = connection, ids = expected_users.keys())
+        assert count_statements(pool) - statement_count == 5
+        assert users == expected_users
+        assert users[1].primary_email_address_index == 1
+
+        statement_count = count_statements(pool)
+        instructors = load_users_by_role(db = connection, role = 'INSTRUCTOR')
+        assert count_statements(pool) - statement_count == 1
+        assert instructors == expected_users
+        assert all(instructors[user_id] is users[user_id] for user_id in users)
+
+
+# Test that a write evicts the user, and any camp holding them, from the identity map
+def test_identity_map_invalidation(pool: db.ConnectionPool):
+    with pool.connection() as connection:
+        user = User(db = connection, google_id = 1, given_name = 'Steve', family_name = 'Tester', full_name = 'Steve Tester', picture = '')
+        cached_user = load_users(db = connection, ids = [user.id])[user.id]
+        identity_map.put(('Camp', 1), 'camp', depends_on = [(User, user.id)])
+        with db.transaction(connection):
+            cached_user.update_basic(db = connection, full_name = 'Steven Tester')
+            assert identity_map.get((User, user.id)) is None
+            assert identity_map.get(('Camp', 1)) is None
+        reloaded_user = load_users(db = connection, ids = [user.id])[user.id]
+        assert reloaded_user is not cached_user
+        assert reloaded_user.full_name == 'Steven Tester'
+
+
+# Test that invalidating on the event loop is refused, since logging it waits on the write lock
+def test_invalidate_on_event_loop(pool: db.ConnectionPool):
+    async def invalidate_user(connection: db.Connection):
+        cache.invalidate(connection, (User, 1))
+    with pool.connection() as connection:
+        with pytest.raises(RuntimeError):
+            asyncio.run(invalidate_user(connection))
+        asyncio.run(db.run(cache.invalidate, connection, (User, 1)))
+
+
+# Test that a write logged by another worker process evicts the stale copy from this process's identity map
+def test_cross_process_invalidation(tmp_path):
+    db_path = os.path.join(tmp_path, 'test_users.db')
+    this_pool = db.ConnectionPool(db_path, max_readers=1)
+    other_pool = db.ConnectionPool(db_path)
+    try:
+        cache.watch(this_pool)
+        cache.watch(other_pool).source = -1
+        with this_pool.connection() as connection:
+            user = User(db = connection, google_id = 1, given_name = 'Steve', family_name = 'Tester', full_name = 'Steve Tester', picture = '')
+            cached_user = load_users(db = connection, ids = [user.id])[user.id]
+        assert not this_pool.poll_external_changes()
+
+        with other_pool.connection() as connection:
+            other_user = User(db = connection, id = user.id)
+            other_user.update_basic(db = connection, full_name = 'Steven Tester')
+        identity_map.put((User, user.id), cached_user) # the other process could not evict it from ours
+
+        assert this_pool.poll_external_changes()
+        with this_pool.connection() as connection: # the only reader, so the replay must not check out another
+            this_pool.apply_external_changes(connection)
+            assert identity_map.get((User, user.id)) is None
+            assert load_users(db = connection, ids = [user.id])[user.id].full_name == 'Steven Tester'
+    finally:
+        this_pool.close()
+        other_pool.close()
+        identity_map.clear()
+
+
+# Test that the programs table is cached per user, and rebuilt only after that user's program list or any program changes
+def test_programs_table_cache(pool: db.ConnectionPool, count_statements):
+    with pool.connection() as connection:
+        user = User(db = connection, google_id = 1, given_name = 'Steve', family_name = 'Tester', full_name = 'Steve Tester', picture = '')
+        robotics = Program(db = connection, title = 'Robotics', grade_range = (GradeLevel(0), GradeLevel(5)), tags = 'robotics')
+        chess = Program(db = connection, title = 'Chess', grade_range = (GradeLevel(6), GradeLevel(12)), tags = 'chess')
+        other = Program(db = connection, title = 'Other', grade_range = (GradeLevel(1), GradeLevel(2)), tags = 'other')
+        user.add_program(db = connection, program_id = robotics.id)
+        filter_table = user.load_programs_table(db = connection)
+        assert filter_table.base_dataframe['grade_range'].tolist() == ['K to 5']
+        statement_count = count_statements(pool)
+        assert user.load_programs_table(db = connection).table is filter_table.table
+        assert count_statements(pool) == statement_count + 1 # just the version check
+
+        other.update_basic(db = connection, title = 'Other 2')
+        filter_table = user.load_programs_table(db = connection)
+        assert filter_table.base_dataframe['title'].tolist() == ['Robotics']
+        user.add_program(db = connection, program_id = chess.id)
+        filter_table = user.load_programs_table(db = connection)
+        assert filter_table.base_dataframe['grade_range'].tolist() == ['K to 5', '6 to 12']
+        robotics.update_basic(db = connection, from_grade = 1)
+        filter_table = user.load_programs_table(db = connection)
+        assert filter_table.base_dataframe['grade_range'].tolist() == ['1 to 5', '6 to 12']
+        user.remove_program(db = connection, program_id = chess.id)
+        filter_table = user.load_programs_table(db = connection)
+        assert filter_table.base_dataframe['title'].tolist() == ['Robotics']
+        robotics.delete(db = connection)
+        assert user.load_programs_table(db = connection).base_dataframe.empty
+
+
+# Test that evicting a key for space also evicts what depends on it, since its later invalidations could not reach them
+def test_eviction_cascade():
+    lru_cache = cache.LRUCache(max_size = 2)
+    lru_cache.put((User, 1), 'user')
+    lru_cache.put(('ProgramsTable', 1), 'table', depends_on = [(User, 1)])
+    lru_cache.put((User, 2), 'other user')
+    assert lru_cache.get((User, 1)) is None
+    assert lru_cache.get(('ProgramsTable', 1)) is None
+    assert lru_cache.get((User, 2)) == 'other user'
+
+
+# Test that dependency edges are pruned a logarithmic number of times, however many one entry adds
+def test_dependency_pruning(monkeypatch):
+    lru_cache = cache.LRUCache(max_size = 4)
+    prune_dependents = lru_cache._prune_dependents
+    prune_count = 0
+    def count_prunes():
+        nonlocal prune_count
+        prune_count += 1
+        prune_dependents()
+    monkeypatch.setattr(lru_cache, '_prune_dependents', count_prunes)
+    lru_cache.put('table', 'table', depends_on = [(User, user_id) for user_id in range(20000)])
+    assert prune_count <= 12
+    lru_cache.invalidate((User, 19999))
+    assert lru_cache.get('table') is None
+
+
+# Test that roles load with one query, and each user's permitted endpoints are worked out once per set of roles
+def test_permitted_endpoints(pool: db.ConnectionPool, count_statements):
+    with pool.connection() as connection:
+        statement_count = count_statements(pool)
+        role_index = load_all_roles(db = connection)
+        assert count_statements(pool) - statement_count == 1
+        assert list(role_index['GUARDIAN'].permissible_endpoints.items()) == [('/students', 'My Students'), ('/camps', 'Find Camps')]
+        assert role_index.endpoint_roles['/programs'] == {'INSTRUCTOR'}
+
+        user = User(db = connection, google_id = 1, given_name = 'Steve', family_name = 'Tester', full_name = 'Steve Tester', picture = '')
+        user.remove_role(db = connection, role = 'ADMIN')
+        user.remove_role(db = connection, role = 'INSTRUCTOR')
+        permitted_endpoints = user.get_permitted_endpoints(role_index)
+        assert permitted_endpoints == {'/students', '/camps'}
+        assert user.get_permitted_endpoints(role_index) is permitted_endpoints
+        assert [role.name for role in role_index.get_roles(user.roles)] == ['GUARDIAN']
+
+        user.add_role(db = connection, role = 'INSTRUCTOR')
+        assert user.get_permitted_endpoints(role_index) == {'/students', '/camps', '/teach', '/programs'}
+        other_user = User(db = connection, google_id = 2, given_name = 'Cheri', family_name = 'Tester', full_name = 'Cheri Tester', picture = '')
+        other_user.add_role(db = connection, role = 'INSTRUCTOR')
+        assert other_user.get_permitted_endpoints(role_index) is user.get_permitted_endpoints(role_index)
+
+        # A reloaded index takes effect at once, even if it reuses the old one's memory
+        reloaded_roles = dict(role_index.roles, INSTRUCTOR=Role(name = 'INSTRUCTOR', permissible_endpoints = {'/teach': 'Teach'}))
+        del role_index
+        reloaded_index = RoleIndex(reloaded_roles)
+        assert user.get_permitted_endpoints(reloaded_index) == {'/students', '/camps', '/teach'}
+
+
+# Test that imported programs are linked to the user and tagged, whatever the chunk size
+@pytest.mark.parametrize(('chunk_size'), (1, 2, 1000))
+def test_import_programs(pool: db.ConnectionPool, chunk_size: int):
+    with pool.connection() as connection:
+        user = User(db = connection, google_id = 1, given_name = 'Steve', family_name = 'Tester', full_name = 'Steve Tester', picture = '')
+        existing = Program(db = connection, title = 'Chess', grade_range = (GradeLevel(1), GradeLevel(8)), tags = 'chess')
+        user.add_program(db = connection, program_id = existing.id)
+        records = [
+            {'title': 'Robotics', 'from_grade': '3', 'to_grade': '5', 'tags': 'Robotics, python'},
+            {'title': 'Scratch', 'from_grade': 1, 'to_grade': 3, 'tags': '', 'description': 'Blocks'},
+            {'title': 'Lego', 'from_grade': '0', 'to_grade': '4', 'tags': 'robotics'}
+        ]
+        assert user.import_programs(db = connection, records = records, chunk_size = chunk_size) == 3
+        programs = [dict(row) for row in user.export_programs(db = connection)]
+        assert [program['title'] for program in programs] == ['Chess', 'Robotics', 'Scratch', 'Lego']
+        assert programs[1]['tags'] == 'robotics, python'
+        assert user.program_ids == [program['id'] for program in programs]
+        assert load_tag_index(db = connection)['robotics'] == {programs[1]['id'], programs[3]['id']}
+
+        with pytest.raises(ValueError, match = 'Row 2'):
+            user.import_programs(db = connection, records = [records[0], dict(records[1], to_grade = '13')], chunk_size = chunk_size)
+        assert len(list(user.export_programs(db = connection))) == 4
@@ -1,40 +1,78 @@
-import pandas
-from db import execute_read, execute_write
-from pydantic import BaseModel
-from typing import Dict, List, Optional, Any
-from student import Student
-from program import Program, GradeLevel
-from filtertable import FilterTable, Checkboxes, DoubleRange
+import json, itertools
+from db import execute_read, execute_write, execute_many, execute_inserts, iterate_read, transaction, run, get_table_versions
+from pydantic import BaseModel, PrivateAttr
+from types import MappingProxyType
+from typing import Dict, List, Optional, Any, Iterable, Iterator, Mapping, AbstractSet, FrozenSet, Tuple, TYPE_CHECKING
+from student import Student, load_student, parse_student_record
+from program import GRADE_LEVEL_LABELS, TAG_INDEX_KEY, IMPORT_CHUNK_SIZE, load_program, load_tag_index, parse_program_record
+from bulk import chunked, parse_records
+from cache import identity_map, invalidate
+if TYPE_CHECKING:
+    import pandas
+    from filtertable import FilterTable, Filter, SqlSource, Page
 
 
 class Role(BaseModel):
     name: str
     permissible_endpoints: Optional[Dict[str, str]] = {}
 
-    def __init__(self, db: Any, **data):
-        super().__init__(**data)
-        self.permissible_endpoints.clear()
-        select_stmt = f'''
-            SELECT endpoint, endpoint_title
-                FROM role_permissions
-                WHERE role = "{self.name}"
-        '''
-        result = execute_read(db, select_stmt)
-        for row in result:
-            self.permissible_endpoints[row['endpoint']] = row['endpoint_title']
-
-
-def load_all_roles(db: Any) -> Dict[str, Role]:
-    all_roles = {}
-    select_stmt = f'''
-        SELECT DISTINCT role
+    class Config:
+        allow_mutation = False
+
+
+_role_index_versions = itertools.count(1)
+
+
+class RoleIndex:
+    # Every role and what it permits, loaded once and never modified, so requests can share it without locking.
+    # Users key what they derive from it on its version, which unlike its id() is never reused.
+    def __init__(self, roles: Dict[str, Role]):
+        self.version = next(_role_index_versions)
+        self.roles = MappingProxyType(roles)
+        endpoint_roles = {}
+        for role in roles.values():
+            for endpoint in role.permissible_endpoints.keys():
+                endpoint_roles.setdefault(endpoint, set()).add(role.name)
+        self.endpoint_roles = MappingProxyType({endpoint: frozenset(role_names) for endpoint, role_names in endpoint_roles.items()})
+        self._permitted_endpoints: Dict[FrozenSet[str], FrozenSet[str]] = {}
+        self._role_lists: Dict[Tuple[str, ...], Tuple[Role, ...]] = {}
+
+    def __getitem__(self, role_name: str) -> Role:
+        return self.roles[role_name]
+
+    def permitted_endpoints(self, role_names: Iterable[str]) -> FrozenSet[str]:
+        # Only a handful of role combinations exist, so each one's endpoints are worked out once
+        role_names = frozenset(role_names)
+        permitted_endpoints = self._permitted_endpoints.get(role_names)
+        if permitted_endpoints is None:
+            permitted_endpoints = frozenset(endpoint for endpoint, endpoint_roles in self.endpoint_roles.items()
+                if not endpoint_roles.isdisjoint(role_names))
+            self._permitted_endpoints[role_names] = permitted_endpoints
+        return permitted_endpoints
+
+    def get_roles(self, role_names: Iterable[str]) -> Tuple[Role, ...]:
+        role_names = tuple(role_names)
+        roles = self._role_lists.get(role_names)
+        if roles is None:
+            roles = tuple(self.roles[role_name] for role_name in role_names if role_name in self.roles)
+            self._role_lists[role_names] = roles
+        return roles
+
+
+def load_all_roles(db: Any) -> RoleIndex:
+    select_stmt = '''
+        SELECT role, endpoint, endpoint_title
             FROM role_permissions
+            ORDER BY rowid
     '''
     result = execute_read(db, select_stmt)
-    for row in result:
-        role_name = row['role']
-        all_roles[role_name] = Role(db = db, name = role_name)
-    return all_roles
+    permissible_endpoints = {}
+    if result is not None:
+        for row in result:
+            role_endpoints = permissible_endpoints.setdefault(row['role'], {})
+            if row['endpoint'] is not None:
+                role_endpoints[row['endpoint']] = row['endpoint_title']
+    return RoleIndex({role_name: Role(name = role_name, permissible_endpoints = endpoints) for role_name, endpoints in permissible_endpoints.items()})
 
 
 class User(BaseModel):
@@ -49,106 +87,66 @@ class User(BaseModel):
     primary_email_address_index: Optional[int] = 0
     students: Optional[Dict[int, Student]] = {}
     program_ids: Optional[List[int]] = []
+    _roles_key: Optional[Tuple] = PrivateAttr(default=None)
+    _permitted_endpoints: FrozenSet[str] = PrivateAttr(default=frozenset())
+
+    def _load_basic(self, row: Any):
+        self.id = row['id']
+        self.google_id = row['google_id']
+        self.given_name = row['given_name']
+        self.family_name = row['family_name']
+        self.full_name = row['full_name']
+        self.picture = row['picture']
 
     def _load(self, db: Any) -> bool:
         if self.id is None:
-            select_stmt = f'''
+            select_stmt = '''
                 SELECT *
                     FROM user
-                    WHERE google_id = {self.google_id}
+                    WHERE google_id = ?
             '''
-            result = execute_read(db, select_stmt)
-            if result is not None:
-                row = result[0] # should only be one
-                self.id = row['id']
+            result = execute_read(db, select_stmt, (self.google_id,))
         else:
-            select_stmt = f'''
+            select_stmt = '''
                 SELECT *
                     FROM user
-                    WHERE id = {self.id}
+                    WHERE id = ?
             '''
-            result = execute_read(db, select_stmt)
+            result = execute_read(db, select_stmt, (self.id,))
         if result is None:
             return False;
-        row = result[0] # should only be one
-        self.google_id = row['google_id']
-        self.given_name = row['given_name']
-        self.family_name = row['family_name']
-        self.full_name = row['full_name']
-        self.picture = row['picture']
-
-        select_stmt = f'''
-            SELECT role
-                FROM user_x_roles
-                WHERE user_id = {self.id}
-        '''
-        result = execute_read(db, select_stmt)
-        self.roles.clear()
-        for row in result:
-            self.roles.append(row['role'])
-
-        select_stmt = f'''
-            SELECT email_address, is_primary
-                FROM user_x_email_addresses
-                WHERE user_id = {self.id}
-        '''
-        result = execute_read(db, select_stmt)
-        self.email_addresses.clear()
-        for row_idx, row in enumerate(result):
-            self.email_addresses.append(row['email_address'])
-            if row['is_primary']:
-                self.primary_email_address_index = row_idx
-
-        select_stmt = f'''
-            SELECT student_id
-                FROM user_x_students
-                WHERE user_id = {self.id}
-        '''
-        result = execute_read(db, select_stmt)
-        self.students.clear()
-        if result is not None:
-            for row in result:
-                self.students[row['student_id']] = None
-
-        select_stmt = f'''
-            SELECT program_id
-                FROM user_x_programs
-                WHERE user_id = {self.id}
-        '''
-        result = execute_read(db, select_stmt)
-        self.program_ids.clear()
-        if result is not None:
-            for row in result:
-                self.program_ids.append(row['program_id'])
+        self._load_basic(result[0]) # should only be one
+        _load_user_relations(db, {self.id: self})
         return True
 
     def _create(self, db: Any):
-        insert_stmt = f'''
-            INSERT INTO user (google_id, given_name, family_name, full_name, picture)
-                VALUES ({self.google_id}, "{self.given_name}", "{self.family_name}", "{self.full_name}", "{self.picture}");
-        '''
-        self.id = execute_write(db, insert_stmt)
-
-        if self.id == 1:
-            # first user gets all roles
-            self.roles.clear()
-            self.roles.append("GUARDIAN")
-            self.roles.append("INSTRUCTOR")
-            self.roles.append("ADMIN")
-            insert_stmt = f'''
-                INSERT INTO user_x_roles (user_id, role)
-                    VALUES ({self.id}, "GUARDIAN"), ({self.id}, "INSTRUCTOR"), ({self.id}, "ADMIN");
-            '''
-            execute_write(db, insert_stmt)
-        else:
-            # new users are only guardians - admin must upgrade them
-            self.roles.clear()
-            self.roles.append("GUARDIAN")
-            insert_stmt = f'''
-                INSERT INTO user_x_roles (user_id, role)
-                    VALUES ({self.id}, "GUARDIAN");
+        with transaction(db):
+            insert_stmt = '''
+                INSERT INTO user (google_id, given_name, family_name, full_name, picture)
+                    VALUES (?, ?, ?, ?, ?);
             '''
-            execute_write(db, insert_stmt)
+            self.id = execute_write(db, insert_stmt, (self.google_id, self.given_name, self.family_name, self.full_name, self.picture))
+
+            if self.id == 1:
+                # first user gets all roles
+                self.roles.clear()
+                self.roles.append("GUARDIAN")
+                self.roles.append("INSTRUCTOR")
+                self.roles.append("ADMIN")
+                insert_stmt = '''
+                    INSERT INTO user_x_roles (user_id, role)
+                        VALUES (?, "GUARDIAN"), (?, "INSTRUCTOR"), (?, "ADMIN");
+                '''
+                execute_write(db, insert_stmt, (self.id, self.id, self.id))
+            else:
+                # new users are only guardians - admin must upgrade them
+                self.roles.clear()
+                self.roles.append("GUARDIAN")
+                insert_stmt = '''
+                    INSERT INTO user_x_roles (user_id, role)
+                        VALUES (?, "GUARDIAN");
+                '''
+                execute_write(db, insert_stmt, (self.id,))
 
     def __init__(self, db: Any, **data):
         super().__init__(**data)
@@ -169,72 +167,94 @@ class User(BaseModel):
             self.full_name = full_name
         if picture is not None:
             self.picture = picture
-        update_stmt = f'''
-            UPDATE user
-                SET given_name="{self.given_name}", family_name="{self.family_name}",
-                    full_name="{self.full_name}", picture="{self.picture}"
-                WHERE id = {self.id};
-        '''
-        execute_write(db, update_stmt)
+        with transaction(db):
+            update_stmt = '''
+                UPDATE user
+                    SET given_name=?, family_name=?,
+                        full_name=?, picture=?
+                    WHERE id = ?;
+            '''
+            execute_write(db, update_stmt, (self.given_name, self.family_name, self.full_name, self.picture, self.id))
+            update_stmt = '''
+                UPDATE camp_listing
+                    SET primary_instructor=?
+                    WHERE primary_instructor_id = ?;
+            '''
+            execute_write(db, update_stmt, (self.full_name, self.id))
+            invalidate(db, (User, self.id))
 
     def delete(self, db: Any):
-        delete_stmt = f'''
-            DELETE FROM user_x_roles
-                WHERE user_id = {self.id};
-        '''
-        execute_write(db, delete_stmt)
-        delete_stmt = f'''
-            DELETE FROM user_x_email_addresses
-                WHERE user_id = {self.id};
-        '''
-        execute_write(db, delete_stmt)
-        delete_stmt = f'''
-            DELETE FROM user_x_students
-                WHERE user_id = {self.id};
-        '''
-        execute_write(db, delete_stmt)
-        delete_stmt = f'''
-            DELETE FROM user
-                WHERE id = {self.id};
-        '''
-        execute_write(db, delete_stmt)
+        with transaction(db):
+            delete_stmt = '''
+                DELETE FROM user_x_roles
+                    WHERE user_id = ?;
+            '''
+            execute_write(db, delete_stmt, (self.id,))
+            delete_stmt = '''
+                DELETE FROM user_x_email_addresses
+                    WHERE user_id = ?;
+            '''
+            execute_write(db, delete_stmt, (self.id,))
+            delete_stmt = '''
+                DELETE FROM user_x_students
+                    WHERE user_id = ?;
+            '''
+            execute_write(db, delete_stmt, (self.id,))
+            delete_stmt = '''
+                DELETE FROM camp_listing
+                    WHERE primary_instructor_id = ?;
+            '''
+            execute_write(db, delete_stmt, (self.id,))
+            delete_stmt = '''
+                DELETE FROM user
+                    WHERE id = ?;
+            '''
+            execute_write(db, delete_stmt, (self.id,))
+            invalidate(db, (User, self.id))
 
     def add_role(self, db: Any, role: str):
         if role not in self.roles:
             self.roles.append(role)
-            insert_stmt = f'''
+            insert_stmt = '''
                 INSERT INTO user_x_roles (user_id, role)
-                    VALUES ({self.id}, "{role}");
+                    VALUES (?, ?);
             '''
-            execute_write(db, insert_stmt)
+            execute_write(db, insert_stmt, (self.id, role))
+            invalidate(db, (User, self.id))
 
     def remove_role(self, db: Any, role: str):
-        del_role = self.roles.pop(role)
-        if del_role is not None:
-            delete_stmt = f'''
-                DELETE FROM user_x_roles WHERE user_id={self.id} and role="{role}";
+        if role in self.roles:
+            self.roles.remove(role)
+            delete_stmt = '''
+                DELETE FROM user_x_roles WHERE user_id=? and role=?;
             '''
-            execute_write(db, delete_stmt)
+            execute_write(db, delete_stmt, (self.id, role))
+            invalidate(db, (User, self.id))
+
+    def get_permitted_endpoints(self, role_index: RoleIndex) -> FrozenSet[str]:
+        # Kept on the user, which the session caches, and only redone if the roles themselves change
+        roles_key = (role_index.version,) + tuple(self.roles)
+        if self._roles_key != roles_key:
+            self._permitted_endpoints = role_index.permitted_endpoints(self.roles)
+            self._roles_key = roles_key
+        return self._permitted_endpoints
 
     def make_email_address_primary(self, db: Any, email_address: str):
-        try:
-            old_primary_address = self.email_addresses[self.primary_email_address_index]
-            email_address_index = self.email_addresses.index(email_address)
-            update_stmt = f'''
-                UPDATE user
-                    SET is_primary=FALSE
-                    WHERE ser_id={self.id} and email_address="{old_primary_address}";
-            '''
-            execute_write(db, update_stmt)
-            update_stmt = f'''
-                UPDATE user
-                    SET is_primary=TRUE
-                    WHERE ser_id={self.id} and email_address="{email_address}";
-            '''
-            execute_write(db, update_stmt)
-            self.primary_email_address_index = email_address_index
-        except ValueError:
-            pass # not found - do nothing
+        with transaction(db):
+            try:
+                old_primary_address = self.email_addresses[self.primary_email_address_index]
+                email_address_index = self.email_addresses.index(email_address)
+                update_stmt = '''
+                    UPDATE user_x_email_addresses
+                        SET is_primary=?
+                        WHERE user_id=? and email_address=?;
+                '''
+                execute_write(db, update_stmt, (False, self.id, old_primary_address))
+                execute_write(db, update_stmt, (True, self.id, email_address))
+                invalidate(db, (User, self.id))
+                self.primary_email_address_index = email_address_index
+            except ValueError:
+                pass # not found - do nothing
 
     def add_email_address(self, db: Any, email_address: str):
         if email_address not in self.email_addresses:
@@ -244,126 +264,331 @@ class User(BaseModel):
             else:
                 is_primary = False
             self.email_addresses.append(email_address)
-            insert_stmt = f'''
+            insert_stmt = '''
                 INSERT INTO user_x_email_addresses (user_id, email_address, is_primary)
-                    VALUES ({self.id}, "{email_address}", {is_primary});
+                    VALUES (?, ?, ?);
             '''
-            execute_write(db, insert_stmt)
+            execute_write(db, insert_stmt, (self.id, email_address, is_primary))
+            invalidate(db, (User, self.id))
 
     def remove_email_address(self, db: Any, email_address: str):
-        del_email_address = self.email_addresses.pop(email_address)
-        if del_email_address is not None:
-            delete_stmt = f'''
-                DELETE FROM user_x_email_addresses WHERE user_id={self.id} and email_address="{email_address}";
+        if email_address in self.email_addresses:
+            self.email_addresses.remove(email_address)
+            delete_stmt = '''
+                DELETE FROM user_x_email_addresses WHERE user_id=? and email_address=?;
             '''
-            execute_write(db, delete_stmt)
+            execute_write(db, delete_stmt, (self.id, email_address))
+            invalidate(db, (User, self.id))
 
     def load_students(self, db: Any):
         for student_id in self.students.keys():
-            self.students[student_id] = Student(id=student_id, db=db)
+            self.students[student_id] = load_student(db = db, student_id = student_id)
+            identity_map.add_dependency((Student, student_id), (User, self.id))
 
     def add_student(self, db: Any, student: Student):
         self.students[student.id] = student
-        insert_stmt = f'''
+        insert_stmt = '''
+            INSERT INTO user_x_students (user_id, student_id)
+                VALUES (?, ?);
+        '''
+        execute_write(db, insert_stmt, (self.id, student.id))
+        invalidate(db, (User, self.id))
+
+    def import_students(self, db: Any, records: Iterable[Mapping[str, Any]], chunk_size: int = IMPORT_CHUNK_SIZE) -> int:
+        # Every row becomes a student of this user, inserted a chunk at a time with one executemany for each chunk's
+        # links, all in a single transaction, so a bad row anywhere leaves nothing behind
+        insert_stmt = '''
+            INSERT INTO student (name, birthdate, grade_level)
+                VALUES (?, ?, ?);
+        '''
+        link_stmt = '''
             INSERT INTO user_x_students (user_id, student_id)
-                VALUES ({self.id}, "{student.id}");
+                VALUES (?, ?);
         '''
-        execute_write(db, insert_stmt)
+        student_ids = []
+        with transaction(db):
+            for rows in chunked(parse_records(records, parse_student_record), chunk_size):
+                chunk_ids = execute_inserts(db, insert_stmt, rows)
+                execute_many(db, link_stmt, [(self.id, student_id) for student_id in chunk_ids])
+                student_ids.extend(chunk_ids)
+            invalidate(db, (User, self.id))
+        for student_id in student_ids:
+            self.students[student_id] = None
+        return len(student_ids)
+
+    def export_students(self, db: Any) -> Iterator[Any]:
+        select_stmt = '''
+            SELECT t2.id, t2.name, t2.birthdate, t2.grade_level
+                FROM user_x_students as t1, student as t2
+                WHERE t1.user_id = ? and t1.student_id = t2.id
+                ORDER BY t2.id
+        '''
+        return iterate_read(db, select_stmt, (self.id,))
 
     def remove_student(self, db: Any, student_id: int):
-        self.load_students(db = db)
-        student = self.students.pop(student_id)
-        if student is not None:
-            delete_stmt = f'''
-                DELETE FROM user_x_students
-                    WHERE user_id = {self.id} and student_id = {student_id};
-            '''
-            execute_write(db, delete_stmt)
-
-            # If no other guardians have this student, fully delete them
-            select_stmt = f'''
-                SELECT student_id
-                    FROM user_x_students
-                    WHERE student_id = {student_id}
-            '''
-            result = execute_read(db, select_stmt)
-            if result is None:
-                student.delete(db = db)
+        with transaction(db):
+            self.load_students(db = db)
+            student = self.students.pop(student_id)
+            if student is not None:
+                delete_stmt = '''
+                    DELETE FROM user_x_students
+                        WHERE user_id = ? and student_id = ?;
+                '''
+                execute_write(db, delete_stmt, (self.id, student_id))
+                invalidate(db, (User, self.id))
+
+                # If no other guardians have this student, fully delete them
+                select_stmt = '''
+                    SELECT student_id
+                        FROM user_x_students
+                        WHERE student_id = ?
+                '''
+                result = execute_read(db, select_stmt, (student_id,))
+                if result is None:
+                    student.delete(db = db)
 
     def load_program_titles(self, db: Any) -> Dict:
-        select_stmt = f'''
+        select_stmt = '''
             SELECT t2.id, t2.title
                 FROM user_x_programs as t1, program as t2
-                WHERE t1.user_id = {self.id} and t1.program_id = t2.id
+                WHERE t1.user_id = ? and t1.program_id = t2.id
         '''
-        result = execute_read(db, select_stmt)
+        result = execute_read(db, select_stmt, (self.id,))
         program_titles = {}
         if result is not None:
             for row in result:
                 program_titles[row['id']] = row['title']
         return program_titles
 
-    def load_programs_table(self, db: Any) -> FilterTable:
-        select_stmt = f'''
-            SELECT t2.*
-                FROM user_x_programs as t1, program as t2
-                WHERE t1.user_id = {self.id} and t1.program_id = t2.id
-        '''
-        dataframe = pandas.read_sql_query(select_stmt, db)
-        dataframe['grade_range'] = dataframe['from_grade'].copy()
-        for row_idx, row in dataframe.iterrows():
-            grade_range = f'{GradeLevel(row["grade_range"]).html_display()} to {GradeLevel(row["to_grade"]).html_display()}'
-            dataframe.at[row_idx,'grade_range'] = grade_range
-        filter_table = FilterTable(base_dataframe=dataframe)
-        dataframe = filter_table.base_dataframe
-        dataframe.columns[dataframe.columns.get_loc('title')].display = True
-        dataframe.columns[dataframe.columns.get_loc('tags')].display = True
-        dataframe.columns[dataframe.columns.get_loc('grade_range')].display = True
-        filter_table.filters.append(Checkboxes(display_column='tags', source_column='tags'))
-        filter_table.filters.append(DoubleRange(display_column='grade_range', source_columns=('from_grade','to_grade')))
-        return filter_table
+    def _programs_source(self) -> 'SqlSource':
+        from filtertable import SqlSource
+        return SqlSource(
+            select_stmt = '''
+                SELECT t2.*
+                    FROM user_x_programs as t1, program as t2
+                    WHERE t1.user_id = ? and t1.program_id = t2.id
+            ''',
+            params = (self.id,),
+            columns = ['id', 'title', 'from_grade', 'to_grade', 'tags', 'description']
+        )
+
+    def load_programs_table(self, db: Any) -> 'FilterTable':
+        # The rows are cached until this user's program list changes, or the program table's version moves on; one
+        # version rather than a dependency per program keeps caching cheap however many programs the user has. The
+        # version is read before the rows, so rows newer than their version only cost a rebuild, never a stale table.
+        # Each call gets its own view. pandas is imported here rather than with this module, as only table pages need it.
+        import pandas
+        from filtertable import BaseTable, FilterTable
+        versions = get_table_versions(db, ('program',))
+        cached = identity_map.get(('ProgramsTable', self.id))
+        if cached is not None and cached[0] == versions:
+            table = cached[1]
+        else:
+            source = self._programs_source()
+            dataframe = pandas.read_sql_query(source.select_stmt, db.reader, params=source.params)
+            table = BaseTable(_format_programs_table(dataframe), display_columns=['title', 'tags', 'grade_range'])
+            identity_map.put(('ProgramsTable', self.id), (versions, table), depends_on=[(User, self.id)])
+        return FilterTable(table=table, filters=_build_programs_filters(load_tag_index(db = db)))
+
+    async def load_programs_table_async(self, db: Any) -> 'FilterTable':
+        return await run(self.load_programs_table, db = db)
+
+    def load_programs_page(self, db: Any, params: Mapping[str, List[str]], **page_args) -> 'Page':
+        filters = _build_programs_filters(load_tag_index(db = db))
+        for filter in filters:
+            filter.select(None, params)
+        return self._programs_source().query_page(db, filters, formatter=_format_programs_table, **page_args)
+
+    async def load_programs_page_async(self, db: Any, params: Mapping[str, List[str]], **page_args) -> 'Page':
+        return await run(self.load_programs_page, db, params, **page_args)
 
     def add_program(self, db: Any, program_id: int):
         if program_id not in self.program_ids:
             self.program_ids.append(program_id)
-            insert_stmt = f'''
+            insert_stmt = '''
                 INSERT INTO user_x_programs (user_id, program_id)
-                    VALUES ({self.id}, "{program_id}");
+                    VALUES (?, ?);
             '''
-            execute_write(db, insert_stmt)
-
-    def remove_program(self, db: Any, program_id: int):
-        try:
-            self.program_ids.remove(program_id)
-        except ValueError:
-            return # not found is okay, but we should leave
-
-        delete_stmt = f'''
-            DELETE FROM user_x_programs
-                WHERE user_id = {self.id} and program_id = {program_id};
+            execute_write(db, insert_stmt, (self.id, program_id))
+            invalidate(db, (User, self.id))
+
+    def import_programs(self, db: Any, records: Iterable[Mapping[str, Any]], chunk_size: int = IMPORT_CHUNK_SIZE) -> int:
+        # As import_students, with each chunk's tags inserted into program_x_tags by one more executemany
+        insert_stmt = '''
+            INSERT INTO program (title, from_grade, to_grade, tags, description)
+                VALUES (?, ?, ?, ?, ?);
         '''
-        execute_write(db, delete_stmt)
-        # If no other instructors have this program, fully delete it
-        select_stmt = f'''
-            SELECT program_id
-                FROM user_x_programs
-                WHERE program_id = {program_id}
+        tag_stmt = '''
+            INSERT INTO program_x_tags (program_id, tag)
+                VALUES (?, ?);
         '''
-        result = execute_read(db, select_stmt)
-        if result is None:
-            program = Program(db = db, id = program_id)
-            program.delete(db = db)
+        link_stmt = '''
+            INSERT INTO user_x_programs (user_id, program_id)
+                VALUES (?, ?);
+        '''
+        program_ids = []
+        with transaction(db):
+            for rows in chunked(parse_records(records, parse_program_record), chunk_size):
+                chunk_ids = execute_inserts(db, insert_stmt, rows)
+                tag_rows = [(program_id, tag) for program_id, row in zip(chunk_ids, rows) for tag in row[3].split(', ') if tag]
+                if len(tag_rows) > 0:
+                    execute_many(db, tag_stmt, tag_rows)
+                execute_many(db, link_stmt, [(self.id, program_id) for program_id in chunk_ids])
+                program_ids.extend(chunk_ids)
+            invalidate(db, (User, self.id), TAG_INDEX_KEY)
+        self.program_ids.extend(program_ids)
+        return len(program_ids)
+
+    def export_programs(self, db: Any) -> Iterator[Any]:
+        select_stmt = '''
+            SELECT t2.id, t2.title, t2.from_grade, t2.to_grade, t2.tags, t2.description
+                FROM user_x_programs as t1, program as t2
+                WHERE t1.user_id = ? and t1.program_id = t2.id
+                ORDER BY t2.id
+        '''
+        return iterate_read(db, select_stmt, (self.id,))
+
+    def remove_program(self, db: Any, program_id: int):
+        with transaction(db):
+            try:
+                self.program_ids.remove(program_id)
+            except ValueError:
+                return # not found is okay, but we should leave
+
+            delete_stmt = '''
+                DELETE FROM user_x_programs
+                    WHERE user_id = ? and program_id = ?;
+            '''
+            execute_write(db, delete_stmt, (self.id, program_id))
+            invalidate(db, (User, self.id))
+            # If no other instructors have this program, fully delete it
+            select_stmt = '''
+                SELECT program_id
+                    FROM user_x_programs
+                    WHERE program_id = ?
+            '''
+            result = execute_read(db, select_stmt, (program_id,))
+            if result is None:
+                program = load_program(db = db, program_id = program_id)
+                if program is not None:
+                    program.delete(db = db)
+
+
+def _build_programs_filters(tag_index: Mapping[str, AbstractSet[int]]) -> List['Filter']:
+    from filtertable import Tags, DoubleRange
+    return [
+        Tags(display_column='tags', key_column='id', tag_index=tag_index),
+        DoubleRange(display_column='grade_range', source_columns=('from_grade','to_grade'))
+    ]
+
+
+def _format_programs_table(dataframe: 'pandas.DataFrame') -> 'pandas.DataFrame':
+    import numpy
+    grade_level_labels = numpy.array(GRADE_LEVEL_LABELS, dtype=object)
+    from_labels = grade_level_labels[dataframe['from_grade'].to_numpy(dtype=numpy.int64)]
+    to_labels = grade_level_labels[dataframe['to_grade'].to_numpy(dtype=numpy.int64)]
+    dataframe['grade_range'] = from_labels + ' to ' + to_labels
+    return dataframe
+
+
+def _load_user_relations(db: Any, users: Dict[int, User]):
+    # One query per related table, however many users are being loaded
+    user_ids = json.dumps(list(users.keys()))
+    for user in users.values():
+        user.roles.clear()
+        user.email_addresses.clear()
+        user.students.clear()
+        user.program_ids.clear()
+
+    select_stmt = '''
+        SELECT user_id, role
+            FROM user_x_roles
+            WHERE user_id IN (SELECT value FROM json_each(?))
+    '''
+    result = execute_read(db, select_stmt, (user_ids,))
+    if result is not None:
+        for row in result:
+            users[row['user_id']].roles.append(row['role'])
 
+    select_stmt = '''
+        SELECT user_id, email_address, is_primary
+            FROM user_x_email_addresses
+            WHERE user_id IN (SELECT value FROM json_each(?))
+            ORDER BY rowid
+    '''
+    result = execute_read(db, select_stmt, (user_ids,))
+    if result is not None:
+        for row in result:
+            user = users[row['user_id']]
+            user.email_addresses.append(row['email_address'])
+            if row['is_primary']:
+                user.primary_email_address_index = len(user.email_addresses) - 1
 
-def load_all_users_by_role(db: Any, role: str, users: Dict[int,User]):
-    select_stmt = f'''
-        SELECT id
-            FROM user
-            WHERE id IN (SELECT id from user_x_roles WHERE role = "{role}")
+    select_stmt = '''
+        SELECT user_id, student_id
+            FROM user_x_students
+            WHERE user_id IN (SELECT value FROM json_each(?))
     '''
-    result = execute_read(db, select_stmt)
+    result = execute_read(db, select_stmt, (user_ids,))
     if result is not None:
         for row in result:
-            user = User(db = db, id = row['id'])
+            users[row['user_id']].students[row['student_id']] = None
+
+    select_stmt = '''
+        SELECT user_id, program_id
+            FROM user_x_programs
+            WHERE user_id IN (SELECT value FROM json_each(?))
+    '''
+    result = execute_read(db, select_stmt, (user_ids,))
+    if result is not None:
+        for row in result:
+            users[row['user_id']].program_ids.append(row['program_id'])
+
+
+def _hydrate_users(db: Any, result: Any) -> Dict[int, User]:
+    users = {}
+    if result is not None:
+        for row in result:
+            user = User.construct()
+            user._load_basic(row)
             users[user.id] = user
+        _load_user_relations(db, users)
+        for user in users.values():
+            identity_map.put((User, user.id), user)
+    return users
+
+
+def load_user(db: Any, user_id: int) -> Optional[User]:
+    return load_users(db = db, ids = [user_id]).get(user_id)
 
+
+def load_users(db: Any, ids: Iterable[int]) -> Dict[int, User]:
+    users = {}
+    missing_ids = []
+    for user_id in ids:
+        user = identity_map.get((User, user_id))
+        if user is None:
+            missing_ids.append(user_id)
+        else:
+            users[user_id] = user
+    if len(missing_ids) > 0:
+        select_stmt = '''
+            SELECT *
+                FROM user
+                WHERE id IN (SELECT value FROM json_each(?))
+        '''
+        result = execute_read(db, select_stmt, (json.dumps(missing_ids),))
+        users.update(_hydrate_users(db, result))
+    return dict(sorted(users.items()))
+
+
+def load_users_by_role(db: Any, role: str) -> Dict[int, User]:
+    select_stmt = '''
+        SELECT user_id
+            FROM user_x_roles
+            WHERE role = ?
+    '''
+    result = execute_read(db, select_stmt, (role,))
+    if result is None:
+        return {}
+    return load_users(db = db, ids = [row['user_id'] for row in result])